@@ -0,0 +1,425 @@
+"""Offline benchmark for Emergency Upgrader.
+
+Builds a synthetic Unifier tree and local bare git repositories that stand in
+for check_endpoint, files_endpoint and plugin repositories, then drives
+emergency_upgrade through a fake bot, context and guild. Reports end-to-end
+and per-stage timings so scaling can be tracked across changes.
+
+Usage:
+    python benchmarks/bench_upgrade.py [--target system|all|<plugin id>]
+        [--cogs N] [--utils N] [--plugins N] [--emojis N] [--data-mb N]
+        [--runs N] [--prefetch] [--reboot] [--bundle] [--json results.json]
+
+The first run starts with cold caches, later runs force the same upgrade
+again on the same tree with warm caches. Nothing leaves the machine."""
+
+import argparse
+import asyncio
+import importlib
+import importlib.util
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+OWNER = 1
+HOME_GUILD = 2
+
+sys.path.insert(0, ROOT)
+import eupgrader_bundle
+
+# stand-ins for the host bot's utils modules, written into the synthetic tree
+UI_STUB = '''class ActionRow:
+    def __init__(self, *items):
+        self.items = list(items)
+
+class MessageComponents:
+    def __init__(self):
+        self.rows = []
+
+    def add_row(self, row):
+        self.rows.append(row)
+
+    def add_rows(self, *rows):
+        self.rows.extend(rows)
+'''
+
+LOG_STUB = '''import logging
+
+def buildlogger(package, name, level):
+    logger = logging.getLogger(package + '.' + name)
+    logger.setLevel(level)
+    return logger
+'''
+
+EMOJI_NAMES = [
+    'back', 'prev', 'next', 'first', 'last', 'search', 'command', 'install', 'success', 'warning', 'error',
+    'rooms', 'emoji', 'leaderboard'
+]
+
+def git(*args, cwd=None):
+    subprocess.run(
+        ['git', '-c', 'user.name=bench', '-c', 'user.email=bench@localhost', '-c', 'init.defaultBranch=main',
+         *args],
+        cwd=cwd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+
+def write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb' if type(data) is bytes else 'w') as file:
+        file.write(data)
+
+def module_source(name, revision, imports=(), padding=2048):
+    lines = [f'import utils.{util}' for util in imports]
+    lines.append(f'REVISION = {revision}')
+    lines.append(f'NAME = {name!r}')
+    lines.append('PADDING = ' + repr('x' * padding))
+    lines.append('def setup(bot):\n    pass')
+    return '\n'.join(lines) + '\n'
+
+def publish(path, files, tag=None):
+    """Creates a bare repository at path whose main branch holds files."""
+    work = path + '.work'
+    os.makedirs(work)
+    for name, data in files.items():
+        write(work + '/' + name, data)
+    git('init', '-q', cwd=work)
+    git('add', '-A', cwd=work)
+    git('commit', '-q', '-m', 'Synthetic tree', cwd=work)
+    if tag:
+        git('tag', tag, cwd=work)
+    git('clone', '-q', '--bare', work, path)
+    git('config', 'uploadpack.allowFilter', 'true', cwd=path)
+    git('config', 'uploadpack.allowAnySHA1InWant', 'true', cwd=path)
+    shutil.rmtree(work)
+    return 'file://' + path
+
+class Scenario:
+    """A synthetic live tree plus the remotes it upgrades from."""
+    def __init__(self, root, cogs=20, utils=10, plugins=3, emojis=14, data_mb=1.0, reboot=False, bundles=False):
+        self.root = root
+        self.tree = root + '/tree'
+        self.remotes = root + '/remotes'
+        self.cogs = cogs
+        self.utils = utils
+        self.plugins = plugins
+        self.emojis = emojis
+        self.data_mb = data_mb
+        self.reboot = reboot
+        self.bundles = bundles
+        self.config = {}
+
+    def system_files(self, revision, release):
+        utils = [f'util{index}' for index in range(self.utils)]
+        files = {
+            'unifier.py': module_source('unifier', revision),
+            'requirements.txt': 'nextcord\n',
+            'config.json': json.dumps({'owner': OWNER, 'branch': 'main', f'option{revision}': True}, indent=4),
+            'plugins/system.json': json.dumps({
+                'id': 'system', 'version': f'v2.{release}', 'release': release, 'modules': [], 'utils': [],
+                'shutdown': False
+            }),
+            'utils/__init__.py': '',
+            'utils/ui.py': UI_STUB,
+            'utils/log.py': LOG_STUB
+        }
+        for index, util in enumerate(utils):
+            # only every other file changes between releases
+            files[f'utils/{util}.py'] = module_source(util, revision if index % 2 else 0)
+        for index in range(self.cogs):
+            imports = [utils[index % len(utils)]] if utils else []
+            files[f'cogs/cog{index}.py'] = module_source(f'cog{index}', revision if index % 2 else 0, imports)
+        return files
+
+    def plugin_files(self, index, release):
+        plugin_id = f'plugin{index}'
+        manifest = {
+            'id': plugin_id, 'name': plugin_id, 'description': 'Synthetic plugin', 'version': f'v1.{release}',
+            'release': release,
+            'modules': [plugin_id + '.py'], 'utils': [plugin_id + '_util.py'], 'requirements': ['nextcord'],
+            'shutdown': False, 'services': []
+        }
+        files = {
+            plugin_id + '.py': module_source(plugin_id, release, [plugin_id + '_util']),
+            plugin_id + '_util.py': module_source(plugin_id + '_util', release)
+        }
+        if index == 0 and self.emojis:
+            manifest['services'] = ['emojis']
+            pack = {'emojis': {}}
+            for emoji in range(self.emojis):
+                name = EMOJI_NAMES[emoji] if emoji < len(EMOJI_NAMES) else f'emoji{emoji}'
+                # half the images change between releases
+                image = f'{name}-{release if emoji % 2 else 0}'.encode() * 64
+                files[f'emojis/{name}.png'] = image
+                pack['emojis'][name] = [f'{name}.png', release]
+            files['emoji.json'] = json.dumps(pack)
+        files['plugin.json'] = json.dumps(manifest)
+        return manifest, files
+
+    def bundle(self, name, files, update=None):
+        """Builds a bundle of files into the bundles directory and returns its path."""
+        source = self.root + '/bundle-source/' + name
+        for file, data in files.items():
+            write(source + '/' + file, data)
+        eupgrader_bundle.build(source, self.root + '/bundles/' + name + '.zip', update=update)
+        shutil.rmtree(source)
+        return self.root + '/bundles/' + name + '.zip'
+
+    def build(self):
+        os.makedirs(self.remotes)
+        release = 50
+        update = {'version': 'v2.60', 'release': 60, 'reboot': 100 if self.reboot else 0, 'legacy': []}
+        check_endpoint = publish(self.remotes + '/unifier-version.git', {'update.json': json.dumps(update)})
+        publish(self.remotes + '/unifier.git', self.system_files(2, 60), tag=update['version'])
+        if self.bundles:
+            os.makedirs(self.root + '/bundles')
+            self.bundle('unifier-' + update['version'], self.system_files(2, 60), update=update)
+
+        for name, data in self.system_files(1, release).items():
+            write(self.tree + '/' + name, data)
+        write(self.tree + '/data.json', json.dumps({'rooms': {}, 'padding': 'x' * int(self.data_mb * 1048576)}))
+        base = {'emojis': {name: [f':{name}:', 0] for name in EMOJI_NAMES}}
+        write(self.tree + '/emojis/base.json', json.dumps(base))
+        write(self.tree + '/emojis/current.json', json.dumps(dict(base, id='base')))
+
+        for index in range(self.plugins):
+            manifest, files = self.plugin_files(index, 1)
+            url = publish(self.remotes + f'/plugin{index}.git', self.plugin_files(index, 2)[1])
+            if self.bundles:
+                self.bundle(f'plugin{index}', self.plugin_files(index, 2)[1])
+            manifest['repository'] = url
+            write(self.tree + f'/plugins/plugin{index}.json', json.dumps(manifest))
+            for module in manifest['modules']:
+                write(self.tree + '/cogs/' + module, files[module])
+            for util in manifest['utils']:
+                write(self.tree + '/utils/' + util, files[util])
+            if 'emojis' in manifest['services']:
+                pack = json.loads(files['emoji.json'])
+                for emoji in pack['emojis'].values():
+                    emoji[0] = f'<:{emoji[0][:-4]}:0>'
+                write(self.tree + f'/emojis/plugin{index}.json', json.dumps(pack))
+
+        self.config = {
+            'owner': OWNER,
+            'home_guild': HOME_GUILD,
+            'branch': 'main',
+            'check_endpoint': check_endpoint,
+            'files_endpoint': 'file://' + self.remotes
+        }
+        if self.reboot:
+            # hand over to the stub entry point instead of asking for a manual reboot
+            shutil.copyfile(ROOT + '/eupgrader_handover.py', self.tree + '/utils/eupgrader_handover.py')
+            self.config['eupgrader_handover_entry'] = 'utils/eupgrader_handover.py'
+            self.config['eupgrader_handover_timeout'] = 30
+        if self.bundles:
+            # the system upgrade finds its bundle here, plugins are given theirs with bundle=
+            self.config['eupgrader_bundles'] = self.root + '/bundles'
+
+class FakeMessage:
+    def __init__(self, channel, embed=None, view=None):
+        self.id = channel.next_id()
+        self.embed = embed
+        self.view = view
+
+    async def edit(self, embed=None, view=None, **kwargs):
+        if embed:
+            self.embed = embed
+        self.view = view
+
+class FakeContext:
+    def __init__(self):
+        self.author = types.SimpleNamespace(id=OWNER)
+        self.messages = []
+        self.__ids = 1000
+
+    def next_id(self):
+        self.__ids += 1
+        return self.__ids
+
+    async def send(self, content=None, embed=None, view=None, **kwargs):
+        message = FakeMessage(self, embed=embed, view=view)
+        self.messages.append(message)
+        return message
+
+class FakeResponse:
+    def __init__(self, message):
+        self.message = message
+
+    async def edit_message(self, embed=None, view=None, **kwargs):
+        await self.message.edit(embed=embed, view=view)
+
+class FakeInteraction:
+    def __init__(self, message, custom_id='accept'):
+        self.user = types.SimpleNamespace(id=OWNER)
+        self.message = message
+        self.data = {'custom_id': custom_id}
+        self.response = FakeResponse(message)
+
+class FakeEmoji:
+    def __init__(self, guild, emoji_id, name):
+        self.guild = guild
+        self.id = emoji_id
+        self.name = name
+        self.animated = False
+
+    async def delete(self):
+        await asyncio.sleep(self.guild.latency)
+        self.guild.emojis.remove(self)
+
+class FakeGuild:
+    def __init__(self, latency=0.02):
+        self.id = HOME_GUILD
+        self.latency = latency
+        self.emojis = []
+        self.uploads = 0
+        self.__ids = 10000
+
+    async def create_custom_emoji(self, name, image):
+        await asyncio.sleep(self.latency)
+        self.__ids += 1
+        self.uploads += 1
+        emoji = FakeEmoji(self, self.__ids, name)
+        self.emojis.append(emoji)
+        return emoji
+
+class FakeBot:
+    """Just enough of the bot for the upgrader cog."""
+    def __init__(self, config, ctx, guild, loop):
+        self.config = config
+        self.ctx = ctx
+        self.guild = guild
+        self.loop = loop
+        self.package = 'unifier'
+        self.loglevel = logging.WARNING
+        self.command_prefix = 'u!'
+        self.colors = types.SimpleNamespace(success=0x11ad79, error=0xff0000)
+        self.ui_emojis = None
+        self.update = False
+        self.closed = False
+        self.extensions = {}
+
+    async def close(self):
+        self.closed = True
+
+    def load_extension(self, name):
+        self.extensions[name] = importlib.import_module(name)
+
+    def reload_extension(self, name):
+        self.extensions[name] = importlib.reload(sys.modules[name])
+
+    def get_guild(self, guild_id):
+        return self.guild if guild_id == self.guild.id else None
+
+    async def wait_for(self, event, check=None, timeout=None):
+        # every prompt is accepted straight away
+        interaction = FakeInteraction(self.ctx.messages[-1])
+        if check and not check(interaction):
+            raise asyncio.TimeoutError()
+        return interaction
+
+def load_upgrader():
+    for name in list(sys.modules):
+        if name in ('utils', 'cogs', 'eupgrader') or name.startswith('utils.') or name.startswith('cogs.'):
+            del sys.modules[name]
+    spec = importlib.util.spec_from_file_location('eupgrader', ROOT + '/eupgrader.py')
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['eupgrader'] = module
+    spec.loader.exec_module(module)
+    return module
+
+async def run(scenario, target, runs, latency, prefetch=False):
+    os.chdir(scenario.tree)
+    sys.path.insert(0, scenario.tree)
+    try:
+        module = load_upgrader()
+        ctx = FakeContext()
+        bot = FakeBot(dict(scenario.config), ctx, FakeGuild(latency), asyncio.get_running_loop())
+        bot.ui_emojis = module.Emojis()
+        for file in sorted(os.listdir('cogs')):
+            if file.endswith('.py'):
+                bot.load_extension('cogs.' + file[:-3])
+        cog = module.EmergencyUpgrader(bot)
+        results = []
+        if prefetch:
+            started = time.perf_counter()
+            await cog.prefetch_upgrade()
+            print(f'Prefetched {cog.prefetched} in {time.perf_counter() - started:.3f}s')
+        for index in range(runs):
+            args = 'force' if index else ''
+            if scenario.bundles and not target in ['system', 'all']:
+                args += f' bundle={scenario.root}/bundles/{target}.zip'
+            started = time.perf_counter()
+            await module.EmergencyUpgrader.emergency_upgrade.callback(cog, ctx, target, args=args)
+            elapsed = time.perf_counter() - started
+            embed = ctx.messages[-1].embed
+            results.append({
+                'run': index + 1,
+                'cache': 'warm' if index else 'cold',
+                'seconds': elapsed,
+                'result': embed.title if embed else None,
+                'handed_over': bot.closed,
+                'metrics': cog.metrics.to_dict()
+            })
+        cog.cog_unload()
+        return results
+    finally:
+        sys.path.remove(scenario.tree)
+        os.chdir(ROOT)
+
+def report(results, target):
+    for result in results:
+        print(f'run {result["run"]} ({result["cache"]} cache, {target}): {result["seconds"]:.3f}s - {result["result"]}')
+        if result['handed_over']:
+            print('    handed over to a new process')
+        if result['metrics'].get('max_stall') is not None:
+            print(f'    longest event loop stall: {result["metrics"]["max_stall"] * 1000:.1f}ms')
+        for stage in result['metrics']['stages']:
+            failed = ' FAILED' if stage['failed'] else ''
+            print(
+                f'    {stage["name"]:<10} {stage["seconds"] or 0:8.3f}s {stage["files"]:6d} files '
+                f'{stage["bytes"] / 1048576:9.2f} MiB{failed}'
+            )
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmark for Emergency Upgrader.')
+    parser.add_argument('--target', default='system', help='system, all or a plugin ID (plugin0, ...)')
+    parser.add_argument('--cogs', type=int, default=20)
+    parser.add_argument('--utils', type=int, default=10)
+    parser.add_argument('--plugins', type=int, default=3)
+    parser.add_argument('--emojis', type=int, default=14)
+    parser.add_argument('--data-mb', type=float, default=1.0)
+    parser.add_argument('--emoji-latency', type=float, default=0.02, help='seconds per fake Discord call')
+    parser.add_argument('--runs', type=int, default=2)
+    parser.add_argument('--reboot', action='store_true', help='make the system upgrade hand over to a new process')
+    parser.add_argument('--bundle', action='store_true', help='upgrade from single-file bundles instead of git')
+    parser.add_argument('--prefetch', action='store_true', help='run the background prefetch before upgrading')
+    parser.add_argument('--json', help='write results to this file')
+    parser.add_argument('--keep', action='store_true', help='keep the synthetic tree')
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='eupgrader-bench-')
+    try:
+        scenario = Scenario(
+            root, cogs=args.cogs, utils=args.utils, plugins=args.plugins, emojis=args.emojis, data_mb=args.data_mb,
+            reboot=args.reboot, bundles=args.bundle
+        )
+        started = time.perf_counter()
+        scenario.build()
+        print(f'Built synthetic tree in {time.perf_counter() - started:.2f}s at {root}')
+        results = asyncio.run(run(scenario, args.target, args.runs, args.emoji_latency, args.prefetch))
+        report(results, args.target)
+        if args.json:
+            with open(args.json, 'w+') as file:
+                json.dump({'parameters': vars(args), 'results': results}, file, indent=2)
+    finally:
+        if not args.keep:
+            shutil.rmtree(root, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
@@ -17,7 +17,7 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
 import nextcord
-from nextcord.ext import commands
+from nextcord.ext import commands, tasks
 from utils import ui, log
 import json
 import os
@@ -27,75 +27,2125 @@ import tomli
 import tomli_w
 import shutil
 import importlib
+import asyncio
+import errno
+import hashlib
+import time
+import subprocess
+import threading
+import copy
+import ast
+import io
+import py_compile
+import mmap
+import socket
+import tempfile
+import struct
+import contextlib
+import zipfile
+import urllib.request
+import importlib.metadata
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+try:
+    from packaging.requirements import Requirement, InvalidRequirement
+except ImportError:
+    Requirement = None
+
+try:
+    from PIL import Image, ImageSequence
+except ImportError:
+    Image = None
 
 class Emojis:
+    keys = (
+        'back', 'prev', 'next', 'first', 'last', 'search', 'command', 'install', 'success', 'warning', 'error',
+        'rooms', 'emoji', 'leaderboard'
+    )
+    __slots__ = keys + ('_base',)
+
+    # parsed base packs shared by all instances, keyed by path
+    _bases = {}
+
     def __init__(self, data=None, devmode=False):
-        if devmode:
-            with open('emojis/devbase.json', 'r') as file:
-                base = json.load(file)
+        self._base = self.base(devmode)['emojis']
+        emojis = dict(self._base)
+        if data:
+            emojis.update(data['emojis'])
+        for key in self.keys:
+            setattr(self, key, emojis[key][0])
+
+    @classmethod
+    def base(cls, devmode=False):
+        """Returns the parsed base pack, reading it from disk only if it changed."""
+        path = 'emojis/devbase.json' if devmode else 'emojis/base.json'
+        mtime = os.stat(path).st_mtime_ns
+        cached = cls._bases.get(path)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        with open(path, 'r') as file:
+            base = json.load(file)
+        cls._bases.update({path: (mtime, base)})
+        return base
+
+    def merge(self, data):
+        """Returns a new Emojis with data's emojis layered over this one's base pack, without touching disk."""
+        merged = object.__new__(Emojis)
+        merged._base = self._base
+        for key in self.keys:
+            setattr(merged, key, (data['emojis'][key] if key in data['emojis'] else self._base[key])[0])
+        return merged
+
+class PluginRegistry:
+    """In-memory index of plugin manifests.
+
+    Maps plugin IDs to manifests and module names to plugin IDs. The index is
+    rebuilt only when the plugins directory or one of its manifests changes."""
+    def __init__(self, path='plugins'):
+        self.path = path
+        self.__signature = None
+        self.__manifests = {}
+        self.__modules = {}
+        self.__checks = {}
+        self.__lock = threading.Lock()
+
+    def __scan(self):
+        entries = []
+        with os.scandir(self.path) as scanner:
+            for entry in scanner:
+                if entry.name.endswith('.json') and entry.is_file():
+                    stat = entry.stat()
+                    entries.append((entry.name, stat.st_mtime_ns, stat.st_size))
+        return os.stat(self.path).st_mtime_ns, tuple(sorted(entries))
+
+    def refresh(self, force=False):
+        with self.__lock:
+            signature = self.__scan()
+            if signature == self.__signature and not force:
+                return
+            manifests = {}
+            modules = {}
+            for name, _mtime, _size in signature[1]:
+                plugin_id = name[:-5]
+                try:
+                    with open(self.path + '/' + name) as file:
+                        info = json.load(file)
+                except:
+                    continue
+                manifests.update({plugin_id: info})
+                for module in info.get('modules', []):
+                    if module.endswith('.py'):
+                        modules.setdefault(module[:-3], plugin_id)
+            self.__manifests = manifests
+            self.__modules = modules
+            self.__signature = signature
+
+    def plugins(self):
+        self.refresh()
+        return list(self.__manifests.keys())
+
+    def get(self, plugin_id):
+        """Returns a copy of a plugin's manifest, or None if it is not installed."""
+        self.refresh()
+        info = self.__manifests.get(plugin_id)
+        return copy.deepcopy(info) if info else None
+
+    def lookup(self, extension):
+        """Returns the ID and manifest of the plugin providing an extension."""
+        self.refresh()
+        if extension.startswith('cogs.'):
+            extension = extension.replace('cogs.', '', 1)
+        if extension in self.__manifests:
+            return extension, self.__manifests[extension]
+        plugin_id = self.__modules.get(extension)
+        if not plugin_id:
+            return None, None
+        return plugin_id, self.__manifests[plugin_id]
+
+    def files(self):
+        """Returns the cogs and utils files owned by plugins other than system."""
+        self.refresh()
+        files = set()
+        for plugin_id, info in self.__manifests.items():
+            if plugin_id == 'system':
+                continue
+            files.update(['cogs/' + module for module in info.get('modules', [])])
+            files.update(['utils/' + util for util in info.get('utils', [])])
+        return files
+
+    def check_module(self, plugin_id):
+        """Returns the plugin's utils.<plugin>_check module, reloading it if it changed on disk."""
+        name = 'utils.' + plugin_id + '_check'
+        try:
+            mtime = os.stat('utils/' + plugin_id + '_check.py').st_mtime_ns
+        except OSError:
+            mtime = None
+        cached = self.__checks.get(plugin_id)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        if cached:
+            module = importlib.reload(cached[1])
         else:
-            with open('emojis/base.json', 'r') as file:
-                base = json.load(file)
+            module = importlib.import_module(name)
+        self.__checks.update({plugin_id: (mtime, module)})
+        return module
 
-        if data:
-            for key in base['emojis'].keys():
-                if not key in data['emojis'].keys():
-                    data['emojis'].update({key: data['emojis'][key]})
+class ReloadPlanner:
+    """Works out which modules need reloading after an install.
+
+    File hashes of loaded extensions and utils modules are recorded before the
+    install and compared afterwards. Changed utils modules are reloaded in
+    dependency order, followed by every extension that changed or imports an
+    affected utils module."""
+    def __init__(self, hashes):
+        self.hashes = hashes
+        self.before = {}
+
+    @staticmethod
+    def module_file(name):
+        module = sys.modules.get(name)
+        path = getattr(module, '__file__', None)
+        if not path:
+            path = name.replace('.', '/') + '.py'
+            if not os.path.isfile(path):
+                path = name.replace('.', '/') + '/__init__.py'
+        return os.path.abspath(path)
+
+    @staticmethod
+    def utils_imports(path, package=None):
+        """Returns the utils.* modules imported by a source file."""
+        try:
+            with open(path, 'r') as file:
+                tree = ast.parse(file.read())
+        except (OSError, SyntaxError, ValueError):
+            return set()
+        found = set()
+        for node in ast.walk(tree):
+            if type(node) is ast.Import:
+                for alias in node.names:
+                    if alias.name.startswith('utils.'):
+                        found.add('.'.join(alias.name.split('.')[:2]))
+            elif type(node) is ast.ImportFrom:
+                if node.level == 1 and package == 'utils':
+                    module = 'utils.' + node.module if node.module else 'utils'
+                elif node.level == 0 and node.module:
+                    module = node.module
+                else:
+                    continue
+                if module == 'utils':
+                    found.update(['utils.' + alias.name for alias in node.names])
+                elif module.startswith('utils.'):
+                    found.add('.'.join(module.split('.')[:2]))
+        return found
+
+    def __hash(self, name):
+        try:
+            return self.hashes.hash(self.module_file(name))
+        except OSError:
+            return None
+
+    def __utils(self):
+        return [name for name in sys.modules if name.startswith('utils.') and name.count('.') == 1]
+
+    def record(self, extensions):
+        self.before = {name: self.__hash(name) for name in list(extensions) + self.__utils()}
+
+    def plan(self, extensions):
+        """Returns the utils modules and extensions to reload, in reload order."""
+        changed = set([name for name, digest in self.before.items() if self.__hash(name) != digest])
+        return self.order(extensions, changed)
+
+    def order(self, extensions, changed):
+        """Returns the utils modules and extensions to reload if the modules in changed were replaced."""
+        extensions = list(extensions)
+        loaded_utils = set(self.__utils())
+        depends = {
+            name: self.utils_imports(self.module_file(name), package='utils') & loaded_utils
+            for name in loaded_utils
+        }
+
+        # utils affected directly or through other utils
+        affected = changed & loaded_utils
+        while True:
+            more = set([name for name in loaded_utils if depends[name] & affected]) - affected
+            if not more:
+                break
+            affected |= more
+
+        utils_order = []
+        remaining = set(affected)
+        while remaining:
+            ready = sorted([name for name in remaining if not depends[name] & remaining])
+            if not ready:
+                # circular imports, reload the rest in any order
+                ready = sorted(remaining)
+            utils_order.extend(ready)
+            remaining -= set(ready)
+
+        toreload = []
+        for extension in extensions:
+            if extension in changed or self.utils_imports(self.module_file(extension)) & affected:
+                toreload.append(extension)
+        return utils_order, toreload
+
+class EmojiInstallError(RuntimeError):
+    """Raised when an emoji pack was only partly installed.
+
+    pack describes the emojis that are actually in the guild now, so it can be
+    saved in place of the old pack, whose emojis may have been deleted."""
+    def __init__(self, message, pack):
+        super().__init__(message)
+        self.pack = pack
+
+class EmojiInstaller:
+    """Installs emoji packs into a guild concurrently.
+
+    Works with any guild-like object that has an emojis list and an async
+    create_custom_emoji method, so it can be driven by a fake guild offline."""
+    def __init__(self, guild, concurrency=4, retries=3, logger=None):
+        self.guild = guild
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.retries = retries
+        self.logger = logger
+
+    @staticmethod
+    def emoji_id(emoji):
+        if (emoji.startswith('<:') or emoji.startswith('<a:')) and emoji.endswith('>'):
+            return int(emoji.split(':')[2].replace('>', ''))
+        return None
+
+    @staticmethod
+    def emoji_string(emoji):
+        return f'<a:{emoji.name}:{emoji.id}>' if emoji.animated else f'<:{emoji.name}:{emoji.id}>'
+
+    @staticmethod
+    def changes(oldpack, newpack):
+        """Returns (added, updated, removed) emoji names between two packs.
+
+        Updated emojis have a newer version, but are only uploaded again if their image hash changed."""
+        added = [name for name in newpack['emojis'] if not name in oldpack['emojis']]
+        updated = [
+            name for name in newpack['emojis']
+            if name in oldpack['emojis'] and oldpack['emojis'][name][1] < newpack['emojis'][name][1]
+        ]
+        removed = [name for name in oldpack['emojis'] if not name in newpack['emojis']]
+        return added, updated, removed
+
+    async def __call(self, action):
+        attempt = 0
+        while True:
+            async with self.semaphore:
+                try:
+                    return await action()
+                except nextcord.HTTPException as e:
+                    if e.status != 429 or attempt >= self.retries:
+                        raise
+                    try:
+                        delay = float(e.response.headers.get('Retry-After', 2 ** attempt))
+                    except:
+                        delay = 2 ** attempt
+            attempt += 1
+            if self.logger:
+                self.logger.debug(f'Rate limited, retrying in {delay}s')
+            await asyncio.sleep(delay)
+
+    async def __create(self, name, path):
+        data = await asyncio.get_running_loop().run_in_executor(None, lambda: read_bytes(path))
+        return await self.__call(lambda: self.guild.create_custom_emoji(
+            name=name, image=nextcord.File(io.BytesIO(data), filename=os.path.basename(path))
+        ))
+
+    async def install(self, oldpack, newpack, source, images=None):
+        """Replaces oldpack with newpack (images in source) and returns newpack with emoji strings filled in.
+
+        images optionally maps emoji names to preprocessed files to upload instead of the ones in source."""
+        images = images or {}
+        loop = asyncio.get_running_loop()
+        index = {emoji.id: emoji for emoji in self.guild.emojis}
+        digests = await loop.run_in_executor(None, lambda: {
+            name: hash_file(source + '/' + entry[0]) for name, entry in newpack['emojis'].items()
+            if os.path.isfile(source + '/' + entry[0])
+        })
+        oldhashes = oldpack.get('hashes', {})
+
+        todelete = []
+        toreplace = []
+        tokeep = []
+        for emojiname in oldpack['emojis']:
+            oldversion = oldpack['emojis'][emojiname][1]
+            ignore_replace = False
+            try:
+                newversion = newpack['emojis'][emojiname][1]
+            except:
+                ignore_replace = True
+                newversion = oldversion + 1
+            if oldversion < newversion:
+                existing = index.get(self.emoji_id(oldpack['emojis'][emojiname][0]))
+                if (
+                        not ignore_replace and existing and emojiname in oldhashes and
+                        oldhashes[emojiname] == digests.get(emojiname)
+                ):
+                    # image is unchanged, no need to upload it again
+                    tokeep.append(emojiname)
+                    continue
+                if existing:
+                    todelete.append(existing)
+                if not ignore_replace:
+                    toreplace.append(emojiname)
+
+        if self.logger:
+            self.logger.debug(f'Removing: {", ".join([str(emoji.id) for emoji in todelete])}')
+        results = await asyncio.gather(*[self.__call(emoji.delete) for emoji in todelete], return_exceptions=True)
+        deleted = set([emoji.id for emoji, result in zip(todelete, results) if not isinstance(result, BaseException)])
+        errors = [result for result in results if isinstance(result, BaseException)]
+        if errors:
+            self.__fail(oldpack, newpack, digests, deleted, {}, errors)
+
+        toupload = [
+            emojiname for emojiname in newpack['emojis']
+            if emojiname in toreplace or not emojiname in oldpack['emojis'].keys()
+        ]
+        if self.logger:
+            self.logger.debug(f'Installing: {", ".join(toupload)} ({len(tokeep)} unchanged)')
+        results = await asyncio.gather(*[
+            self.__create(emojiname, images.get(emojiname, source + '/' + newpack['emojis'][emojiname][0]))
+            for emojiname in toupload
+        ], return_exceptions=True)
+        errors = [result for result in results if isinstance(result, BaseException)]
+        if errors:
+            self.__fail(oldpack, newpack, digests, deleted, {
+                emojiname: emoji for emojiname, emoji in zip(toupload, results) if not isinstance(emoji, BaseException)
+            }, errors)
+        for emojiname, emoji in zip(toupload, results):
+            newpack['emojis'][emojiname][0] = self.emoji_string(emoji)
+        for emojiname in newpack['emojis']:
+            if not emojiname in toupload:
+                newpack['emojis'][emojiname][0] = oldpack['emojis'][emojiname][0]
+        newpack['hashes'] = digests
+        return newpack
+
+    def __fail(self, oldpack, newpack, digests, deleted, created, errors):
+        """Raises the first error, as an EmojiInstallError describing the guild if it was already changed."""
+        if not deleted and not created:
+            raise errors[0]
+        pack = copy.deepcopy(newpack)
+        pack['emojis'] = {
+            emojiname: entry for emojiname, entry in copy.deepcopy(oldpack['emojis']).items()
+            if not self.emoji_id(entry[0]) in deleted
+        }
+        pack['hashes'] = {
+            emojiname: digest for emojiname, digest in oldpack.get('hashes', {}).items() if emojiname in pack['emojis']
+        }
+        for emojiname, emoji in created.items():
+            pack['emojis'][emojiname] = [self.emoji_string(emoji), newpack['emojis'][emojiname][1]]
+            pack['hashes'][emojiname] = digests.get(emojiname)
+        if self.logger:
+            self.logger.warning(
+                f'Emoji pack only partly installed: {len(deleted)} emojis removed, {len(created)} uploaded'
+            )
+        raise EmojiInstallError(f'{len(errors)} emojis could not be replaced: {errors[0]}', pack) from errors[0]
+
+def image_size(data):
+    """Returns (width, height) from a PNG or GIF header, or None for other formats."""
+    if data[:8] == b'\x89PNG\r\n\x1a\n' and len(data) >= 24:
+        return struct.unpack('>II', data[16:24])
+    if data[:6] in [b'GIF87a', b'GIF89a'] and len(data) >= 10:
+        return struct.unpack('<HH', data[6:10])
+    return None
+
+def shrink_emoji(path, output, max_bytes, max_side):
+    """Downscales and recompresses an emoji image until it fits the limits.
+
+    Animated images are written as output.gif and others as output.png. Returns
+    the file written, or path if the image already fits. Raises ValueError if it
+    can't be made to fit."""
+    data = read_bytes(path)
+    size = image_size(data)
+    if len(data) <= max_bytes and (not size or max(size) <= max_side):
+        return path
+    if not Image:
+        raise ValueError(
+            f'{os.path.basename(path)} is {len(data) / 1024:.0f} KiB' + (f' ({size[0]}x{size[1]})' if size else '') +
+            ' and Pillow is not installed to shrink it'
+        )
+    with Image.open(io.BytesIO(data)) as image:
+        animated = getattr(image, 'is_animated', False)
+        frames = [frame.copy() for frame in ImageSequence.Iterator(image)] if animated else [image.copy()]
+        durations = [frame.info.get('duration', 100) for frame in frames]
+        side = min(max_side, max(image.size))
+        while side >= 16:
+            scaled = []
+            for frame in frames:
+                frame = frame.convert('RGBA')
+                frame.thumbnail((side, side), Image.LANCZOS)
+                scaled.append(frame)
+            buffer = io.BytesIO()
+            if animated:
+                scaled[0].save(
+                    buffer, format='GIF', save_all=True, append_images=scaled[1:], duration=durations, loop=0,
+                    optimize=True, disposal=2
+                )
+            else:
+                scaled[0].save(buffer, format='PNG', optimize=True)
+            if buffer.tell() <= max_bytes:
+                output += '.gif' if animated else '.png'
+                with open(output + '.tmp', 'wb') as file:
+                    file.write(buffer.getvalue())
+                os.replace(output + '.tmp', output)
+                return output
+            side = int(side * 0.75)
+    raise ValueError(f'{os.path.basename(path)} could not be shrunk below {max_bytes / 1024:.0f} KiB')
+
+class EmojiPreprocessor:
+    """Shrinks emoji images that exceed Discord's limits before anything is uploaded.
+
+    Results are cached by source hash, so reinstalling or upgrading a pack reuses
+    images that were already shrunk. Work is spread over a process pool when
+    Pillow is available."""
+    def __init__(self, cache, max_bytes=262144, max_side=128, workers=None):
+        self.cache = cache
+        self.max_bytes = max_bytes
+        self.max_side = max_side
+        self.workers = workers or os.cpu_count() or 1
+        self.__pool = None
+
+    @property
+    def pool(self):
+        if not self.__pool:
+            self.__pool = ProcessPoolExecutor(max_workers=self.workers)
+        return self.__pool
+
+    def fits(self, data):
+        size = image_size(data)
+        return len(data) <= self.max_bytes and (not size or max(size) <= self.max_side)
+
+    def prepare(self, source, pack):
+        """Returns {emoji name: file to upload} for a pack whose images are in source.
+
+        Raises ValueError listing every image that can't be made to fit."""
+        os.makedirs(self.cache, exist_ok=True)
+        images = {}
+        pending = {}
+        for name, entry in pack['emojis'].items():
+            path = source + '/' + entry[0]
+            if not os.path.isfile(path):
+                continue
+            data = read_bytes(path)
+            if self.fits(data):
+                images.update({name: path})
+                continue
+            key = hashlib.sha256(data + f':{self.max_bytes}:{self.max_side}'.encode()).hexdigest()
+            output = self.cache + '/' + key
+            # the extension depends on whether the image turned out to be animated
+            cached = [output + ext for ext in ['.gif', '.png'] if os.path.isfile(output + ext)]
+            if cached:
+                images.update({name: cached[0]})
+            else:
+                pending.update({name: (path, output)})
+        if pending:
+            args = [(path, output, self.max_bytes, self.max_side) for path, output in pending.values()]
+            if Image and len(pending) > 1 and self.workers > 1:
+                futures = [self.pool.submit(shrink_emoji, *arg) for arg in args]
+            else:
+                futures = None
+            errors = []
+            for index, name in enumerate(pending):
+                try:
+                    images.update({name: futures[index].result() if futures else shrink_emoji(*args[index])})
+                except ValueError as e:
+                    errors.append(str(e))
+            if errors:
+                raise ValueError('Some emojis are too large: ' + ', '.join(errors))
+        return images
+
+    def shutdown(self):
+        if self.__pool:
+            self.__pool.shutdown(wait=False)
+            self.__pool = None
+
+def fastcopy(src, dst):
+    """Copies a file in-kernel where possible, falling back to shutil."""
+    if hasattr(os, 'copy_file_range'):
+        try:
+            with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+                size = os.fstat(fsrc.fileno()).st_size
+                copied = 0
+                while copied < size:
+                    sent = os.copy_file_range(fsrc.fileno(), fdst.fileno(), size - copied)
+                    if sent == 0:
+                        break
+                    copied += sent
+            if copied == size:
+                shutil.copymode(src, dst)
+                return
+        except OSError as e:
+            if not e.errno in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EPERM):
+                raise
+
+    # shutil.copyfile uses os.sendfile on Linux
+    shutil.copyfile(src, dst)
+    shutil.copymode(src, dst)
+
+class CopyResult:
+    """Outcome of a single file copy."""
+    __slots__ = ('src', 'dst', 'error', 'size')
+
+    def __init__(self, src, dst, error=None, size=0):
+        self.src = src
+        self.dst = dst
+        self.error = error
+        self.size = size
+
+    @property
+    def ok(self):
+        return self.error is None
+
+class CopyEngine:
+    """Copies files in-process on a bounded thread pool."""
+    def __init__(self, workers=None):
+        self.workers = workers or min(32, (os.cpu_count() or 1) * 4)
+        self.__pool = None
+
+    @property
+    def pool(self):
+        if not self.__pool:
+            self.__pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='eupgrader-copy')
+        return self.__pool
+
+    def copy_one(self, src, dst):
+        try:
+            fastcopy(src, dst)
+            size = os.path.getsize(dst)
+        except Exception as e:
+            return CopyResult(src, dst, e)
+        return CopyResult(src, dst, size=size)
+
+    async def copy(self, pairs, loop=None):
+        """Copies (src, dst) pairs without blocking the event loop."""
+        loop = loop or asyncio.get_running_loop()
+        return list(await asyncio.gather(*[
+            loop.run_in_executor(self.pool, self.copy_one, src, dst) for src, dst in pairs
+        ]))
+
+    def shutdown(self):
+        if self.__pool:
+            self.__pool.shutdown(wait=False)
+            self.__pool = None
+
+def compile_module(path, dfile=None):
+    """Compiles a module to bytecode next to its source. Returns an error message, or None."""
+    try:
+        py_compile.compile(path, dfile=dfile, doraise=True)
+    except py_compile.PyCompileError as e:
+        return e.msg.strip()
+    except OSError as e:
+        return f'{path}: {e}'
+    return None
+
+class Compiler:
+    """Byte-compiles modules across a process pool so syntax errors surface before anything is reloaded.
+
+    Small batches are compiled in-process, as starting workers would cost more than it saves."""
+    def __init__(self, workers=None, min_batch=16):
+        self.workers = workers or os.cpu_count() or 1
+        self.min_batch = min_batch
+        self.__pool = None
+
+    @property
+    def pool(self):
+        if not self.__pool:
+            self.__pool = ProcessPoolExecutor(max_workers=self.workers)
+        return self.__pool
+
+    def compile(self, modules):
+        """Compiles (path, display path) pairs, raising SyntaxError listing every module that failed."""
+        modules = list(modules)
+        if len(modules) >= self.min_batch and self.workers > 1:
+            errors = list(self.pool.map(
+                compile_module, *zip(*modules), chunksize=max(1, len(modules) // (self.workers * 4))
+            ))
         else:
-            data = base
-
-        self.back = data['emojis']['back'][0]
-        self.prev = data['emojis']['prev'][0]
-        self.next = data['emojis']['next'][0]
-        self.first = data['emojis']['first'][0]
-        self.last = data['emojis']['last'][0]
-        self.search = data['emojis']['search'][0]
-        self.command = data['emojis']['command'][0]
-        self.install = data['emojis']['install'][0]
-        self.success = data['emojis']['success'][0]
-        self.warning = data['emojis']['warning'][0]
-        self.error = data['emojis']['error'][0]
-        self.rooms = data['emojis']['rooms'][0]
-        self.emoji = data['emojis']['emoji'][0]
-        self.leaderboard = data['emojis']['leaderboard'][0]
-
-def status(code):
-    if code != 0:
-        raise RuntimeError("install failed")
+            errors = [compile_module(path, dfile) for path, dfile in modules]
+        errors = [error for error in errors if error]
+        if errors:
+            raise SyntaxError('\n'.join(errors))
+        return len(modules)
+
+    def shutdown(self):
+        if self.__pool:
+            self.__pool.shutdown(wait=False)
+            self.__pool = None
+
+def read_bytes(path):
+    with open(path, 'rb') as file:
+        return file.read()
+
+def list_files(directory):
+    """Returns the names of regular files directly inside directory."""
+    with os.scandir(directory) as scanner:
+        return sorted([entry.name for entry in scanner if entry.is_file()])
+
+class AsyncFiles:
+    """Runs blocking filesystem calls in an executor so they never stall the event loop."""
+    def __init__(self, executor=None):
+        self.executor = executor
+
+    async def run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, lambda: func(*args))
+
+    async def read(self, path):
+        return await self.run(read_bytes, path)
+
+    async def write(self, path, data):
+        def write():
+            with open(path, 'wb') as file:
+                file.write(data)
+        await self.run(write)
+
+    async def read_json(self, path):
+        return json.loads(await self.read(path))
+
+    async def write_json(self, path, data, indent=None):
+        await self.write(path, json.dumps(data, indent=indent).encode())
+
+    async def list_files(self, directory):
+        return await self.run(list_files, directory)
+
+    async def exists(self, path):
+        return await self.run(os.path.isfile, path)
+
+def hash_file(path, chunk=1048576):
+    """Returns the SHA-256 hex digest of a file."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        while True:
+            data = file.read(chunk)
+            if not data:
+                break
+            digest.update(data)
+    return digest.hexdigest()
+
+class HashCache:
+    """Caches file hashes keyed by path, size and modification time.
+
+    Files modified in the last few seconds are not cached, as a second write
+    within the filesystem's timestamp granularity would go unnoticed."""
+    def __init__(self, path=None):
+        self.path = path
+        self.__entries = {}
+        self.__lock = threading.Lock()
+        if path:
+            try:
+                with open(path, 'r') as file:
+                    self.__entries = json.load(file)
+            except:
+                pass
+
+    def __cached(self, key, path, func):
+        stat = os.stat(path)
+        entry = self.__entries.get(key)
+        if entry and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+            return entry[2]
+        digest = func(path)
+        if time.time_ns() - stat.st_mtime_ns > 2000000000:
+            with self.__lock:
+                self.__entries.update({key: [stat.st_size, stat.st_mtime_ns, digest]})
+        return digest
+
+    def hash(self, path):
+        path = os.path.abspath(path)
+        return self.__cached(path, path, hash_file)
+
+    def blob(self, path):
+        """Returns the git blob ID of a file."""
+        path = os.path.abspath(path)
+        return self.__cached('blob:' + path, path, git_blob_hash)
+
+    def save(self):
+        if not self.path:
+            return
+        with self.__lock:
+            # drop entries for files that no longer exist
+            self.__entries = {
+                key: entry for key, entry in self.__entries.items()
+                if os.path.exists(key[5:] if key.startswith('blob:') else key)
+            }
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path + '.tmp', 'w+') as file:
+                json.dump(self.__entries, file)
+            os.replace(self.path + '.tmp', self.path)
+
+def diff_files(source, target, files, hashes, pool=None):
+    """Compares files (relative paths) under source against target.
+
+    Returns the lists of files that are new and that have changed."""
+    def compare(file):
+        if not os.path.isfile(target + '/' + file):
+            return 'added'
+        if hashes.hash(source + '/' + file) != hashes.hash(target + '/' + file):
+            return 'changed'
+        return None
+
+    results = pool.map(compare, files) if pool else map(compare, files)
+    added = []
+    changed = []
+    for file, result in zip(files, results):
+        if result == 'added':
+            added.append(file)
+        elif result == 'changed':
+            changed.append(file)
+    return added, changed
+
+def parse_requirement(line):
+    """Parses a requirements.txt line into (name, specifier, requirement).
+
+    Returns None for blank lines, comments, pip options and requirements whose
+    environment markers do not apply. name is None if the line can't be parsed."""
+    line = re.sub(r'(^|\s)#.*$', '', line).strip()
+    if not line or line.startswith('-'):
+        return None
+    if Requirement:
+        try:
+            requirement = Requirement(line)
+        except InvalidRequirement:
+            return None, None, line
+        if requirement.marker and not requirement.marker.evaluate():
+            return None
+        return requirement.name, requirement.specifier, line
+    match = re.match(r'^([A-Za-z0-9][A-Za-z0-9._-]*)\s*(\[[^\]]*\])?\s*([^;]*)', line)
+    if not match:
+        return None, None, line
+    return match.group(1), match.group(3).strip(), line
+
+def requirement_satisfied(name, specifier):
+    if not name:
+        return False
+    try:
+        version = importlib.metadata.version(name)
+    except importlib.metadata.PackageNotFoundError:
+        return False
+    if not specifier:
+        return True
+    if type(specifier) is str:
+        # without packaging, only exact pins can be checked
+        return specifier == '==' + version
+    return specifier.contains(version, prereleases=True)
+
+def unsatisfied_requirements(lines):
+    """Returns the requirements from lines that installed distributions do not satisfy."""
+    missing = []
+    for line in lines:
+        parsed = parse_requirement(line)
+        if not parsed:
+            continue
+        name, specifier, requirement = parsed
+        if not requirement_satisfied(name, specifier) and not requirement in missing:
+            missing.append(requirement)
+    return missing
+
+def pip(*args):
+    result = subprocess.run([sys.executable, '-m', 'pip'] + list(args), capture_output=True)
+    if result.returncode != 0:
+        raise RuntimeError(f'pip {args[0]} failed: ' + result.stderr.decode(errors='replace').strip())
+    return result.stdout
+
+class Wheelhouse:
+    """Local wheel cache so dependency installs can run offline."""
+    def __init__(self, path):
+        self.path = path
+
+    def prefetch(self, requirements, no_deps=False):
+        os.makedirs(self.path, exist_ok=True)
+        pip('download', '--quiet', '--dest', self.path, '--find-links', self.path,
+            *(['--no-deps'] if no_deps else []), *requirements)
+
+    def install(self, requirements, no_deps=False):
+        args = ['install', '--quiet', '--find-links', self.path] + (['--no-dependencies'] if no_deps else [])
+        try:
+            pip(*args, '--no-index', *requirements)
+        except RuntimeError:
+            # wheelhouse is incomplete, let pip fetch what's missing
+            pip(*args, *requirements)
+
+def git(*args, cwd=None, input=None):
+    """Runs a git command and returns its output, raising RuntimeError on failure."""
+    result = subprocess.run(['git'] + list(args), cwd=cwd, capture_output=True, input=input)
+    if result.returncode != 0:
+        raise RuntimeError(f'git {args[0]} failed: ' + result.stderr.decode(errors='replace').strip())
+    return result.stdout
+
+class RemoteMetadata:
+    """Reads single files from remote repositories without cloning them.
+
+    Each remote gets a persistent bare repository that fetches only the tip commit
+    with blobs filtered out, so reading a file downloads just that file. Results
+    are cached in memory for ttl seconds."""
+    def __init__(self, root, ttl=300):
+        self.root = root
+        self.ttl = ttl
+        self.__cache = {}
+        self.__heads = {}
+
+    def repo(self, url):
+        path = self.root + '/' + hashlib.sha1(url.encode()).hexdigest() + '.git'
+        if not os.path.isdir(path):
+            shutil.rmtree(path + '.tmp', ignore_errors=True)
+            git('init', '--quiet', '--bare', path + '.tmp')
+            git('remote', 'add', 'origin', url, cwd=path + '.tmp')
+            git('config', 'remote.origin.promisor', 'true', cwd=path + '.tmp')
+            git('config', 'remote.origin.partialclonefilter', 'blob:none', cwd=path + '.tmp')
+            git('config', 'extensions.partialClone', 'origin', cwd=path + '.tmp')
+            os.replace(path + '.tmp', path)
+        return path
+
+    def read(self, url, ref, file, fresh=False):
+        """Returns the contents of a file at ref on a remote."""
+        return self.read_commit(url, ref, file, fresh=fresh)[0]
+
+    def read_commit(self, url, ref, file, fresh=False):
+        """Returns the contents of a file at ref on a remote, and the commit ref pointed to when it was read."""
+        key = (url, ref, file)
+        if not fresh and key in self.__cache and time.time() - self.__cache[key][0] < self.ttl:
+            return self.__cache[key][1], self.__cache[key][2]
+        repo, commit = self.fetch(url, ref, fresh=fresh)
+        data = git('cat-file', 'blob', commit + ':' + file, cwd=repo)
+        self.__cache.update({key: (time.time(), data, commit)})
+        return data, commit
+
+    def fetch(self, url, ref, fresh=False):
+        """Fetches the tip commit of ref without blobs and returns (repo, commit)."""
+        key = (url, ref)
+        if not fresh and key in self.__heads and time.time() - self.__heads[key][0] < self.ttl:
+            return self.__heads[key][1]
+        repo = self.repo(url)
+        try:
+            git('fetch', '--quiet', '--depth', '1', '--filter=blob:none', '--no-tags', 'origin', ref, cwd=repo)
+        except RuntimeError:
+            # remote or local git may not support partial fetches
+            git('fetch', '--quiet', '--depth', '1', '--no-tags', 'origin', ref, cwd=repo)
+        result = (repo, git('rev-parse', 'FETCH_HEAD', cwd=repo).decode().strip())
+        self.__heads.update({key: (time.time(), result)})
+        return result
+
+    def tree(self, url, ref, fresh=False):
+        """Returns {path: blob ID} for every file at ref on a remote, without downloading any blobs."""
+        repo, commit = self.fetch(url, ref, fresh=fresh)
+        return ls_tree(repo, commit)
+
+    def read_json(self, url, ref, file, fresh=False):
+        return json.loads(self.read(url, ref, file, fresh=fresh))
+
+    def invalidate(self, url=None):
+        for cache in [self.__cache, self.__heads]:
+            for key in list(cache.keys()):
+                if not url or key[0] == url:
+                    cache.pop(key)
+
+def dirsize(path):
+    total = 0
+    for root, _dirs, files in os.walk(path):
+        for file in files:
+            try:
+                total += os.lstat(os.path.join(root, file)).st_size
+            except OSError:
+                pass
+    return total
+
+class MirrorCache:
+    """Persistent bare mirrors of remote repositories.
+
+    Mirrors are kept up to date with incremental fetches, and versions are
+    materialised as detached worktrees rather than fresh clones. Once the cache
+    grows past max_size bytes, mirrors are garbage collected and then evicted,
+    least recently used first. Mirrors another thread is fetching from or
+    checking out of are left alone until it's done."""
+    def __init__(self, root, max_size=None):
+        self.root = root
+        self.max_size = max_size
+        self.__lock = threading.Lock()
+        self.__busy = {}
+
+    def path(self, url):
+        return self.root + '/' + hashlib.sha1(url.encode()).hexdigest() + '.git'
+
+    @contextlib.contextmanager
+    def using(self, path):
+        """Marks a mirror as in use, so enforce_limit won't collect or evict it."""
+        with self.__lock:
+            self.__busy.update({path: self.__busy.get(path, 0) + 1})
+        try:
+            yield path
+        finally:
+            with self.__lock:
+                self.__busy[path] -= 1
+                if not self.__busy[path]:
+                    self.__busy.pop(path)
+
+    def update(self, url):
+        """Creates or incrementally fetches the mirror for a remote and returns its path."""
+        with self.using(self.path(url)) as path:
+            self.__update(url, path)
+        self.enforce_limit(keep=path)
+        return path
+
+    def __update(self, url, path):
+        if not os.path.isdir(path):
+            shutil.rmtree(path + '.tmp', ignore_errors=True)
+            git('init', '--quiet', '--bare', path + '.tmp')
+            git('remote', 'add', 'origin', url, cwd=path + '.tmp')
+            git('config', '--replace-all', 'remote.origin.fetch', '+refs/heads/*:refs/heads/*', cwd=path + '.tmp')
+            git('config', '--add', 'remote.origin.fetch', '+refs/tags/*:refs/tags/*', cwd=path + '.tmp')
+            git('config', '--add', 'remote.origin.fetch', '+HEAD:refs/eupgrader/head', cwd=path + '.tmp')
+            git('fetch', '--quiet', 'origin', cwd=path + '.tmp')
+            os.replace(path + '.tmp', path)
+        else:
+            git('fetch', '--quiet', '--prune', 'origin', cwd=path)
+            git('gc', '--quiet', '--auto', cwd=path)
+        os.utime(path)
+
+    def checkout(self, url, ref, target, fetch=True, limit=True):
+        """Materialises ref of a remote at target as a detached worktree.
+
+        Use ref=None for the remote's default branch, and limit=False to leave
+        enforcing the size limit to the caller. Returns roughly how many bytes
+        the mirror grew by."""
+        with self.using(self.path(url)) as path:
+            size = dirsize(path) if os.path.isdir(path) else 0
+            if fetch:
+                self.__update(url, path)
+            shutil.rmtree(target, ignore_errors=True)
+            git('worktree', 'prune', cwd=path)
+            git('worktree', 'add', '--quiet', '--detach', '--force', target, ref or 'refs/eupgrader/head', cwd=path)
+            grown = max(dirsize(path) - size, 0)
+        if fetch and limit:
+            self.enforce_limit(keep=path)
+        return grown
+
+    def adopt(self, url, ref, source, target):
+        """Moves a worktree checked out earlier at source to target if it is still clean and at ref.
+
+        Returns False and leaves target alone if source can't be used."""
+        with self.using(self.path(url)) as path:
+            if not os.path.isdir(path) or not os.path.isfile(source + '/.git'):
+                return False
+            try:
+                head = git('rev-parse', 'HEAD', cwd=source).strip()
+                if head != git('rev-parse', '--verify', (ref or 'refs/eupgrader/head') + '^{commit}', cwd=path).strip():
+                    return False
+                if git('status', '--porcelain', cwd=source).strip():
+                    return False
+            except RuntimeError:
+                return False
+            shutil.rmtree(target, ignore_errors=True)
+            git('worktree', 'prune', cwd=path)
+            git('worktree', 'move', source, target, cwd=path)
+            return True
+
+    def remove(self, url, target):
+        """Removes a worktree made by checkout, and the mirror's record of it."""
+        with self.using(self.path(url)) as path:
+            if os.path.isdir(path):
+                try:
+                    git('worktree', 'remove', '--force', target, cwd=path)
+                    return
+                except RuntimeError:
+                    pass
+            # the worktree may already be broken, or belong to a mirror that has been evicted
+            shutil.rmtree(target, ignore_errors=True)
+            if os.path.isdir(path):
+                git('worktree', 'prune', cwd=path)
+
+    def mirrors(self):
+        try:
+            return [self.root + '/' + mirror for mirror in os.listdir(self.root) if mirror.endswith('.git')]
+        except FileNotFoundError:
+            return []
+
+    def enforce_limit(self, keep=None):
+        if not self.max_size:
+            return
+        # held throughout, so no thread can start using a mirror while it is collected or evicted
+        with self.__lock:
+            mirrors = self.mirrors()
+            sizes = {mirror: dirsize(mirror) for mirror in mirrors}
+            if sum(sizes.values()) <= self.max_size:
+                return
+            idle = [mirror for mirror in mirrors if not mirror in self.__busy]
+            for mirror in idle:
+                git('reflog', 'expire', '--expire=now', '--all', cwd=mirror)
+                git('gc', '--quiet', '--prune=now', cwd=mirror)
+                sizes.update({mirror: dirsize(mirror)})
+            total = sum(sizes.values())
+            for mirror in sorted(idle, key=os.path.getmtime):
+                if total <= self.max_size:
+                    break
+                if mirror == keep:
+                    continue
+                shutil.rmtree(mirror, ignore_errors=True)
+                total -= sizes[mirror]
+
+def git_blob_hash(path, chunk=1048576):
+    """Returns the git blob ID (SHA-1 of the blob header and contents) of a file."""
+    digest = hashlib.sha1()
+    if os.path.islink(path):
+        target = os.readlink(path).encode()
+        digest.update(b'blob %d\0' % len(target) + target)
+        return digest.hexdigest()
+    with open(path, 'rb') as file:
+        size = os.fstat(file.fileno()).st_size
+        digest.update(b'blob %d\0' % size)
+        if size > chunk:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                digest.update(mapped)
+        else:
+            digest.update(file.read())
+    return digest.hexdigest()
+
+def ls_tree(repo, ref):
+    """Returns {path: blob ID} for every file in the tree of ref."""
+    files = {}
+    for entry in git('ls-tree', '-r', '-z', '--full-tree', ref, cwd=repo).split(b'\0'):
+        if not entry:
+            continue
+        info, name = entry.split(b'\t', 1)
+        mode, kind, blob = info.split(b' ')
+        if kind == b'blob':
+            files.update({os.fsdecode(name): blob.decode()})
+    return files
+
+def verify_checkout(path, pool=None):
+    """Checks every file of a git worktree against the blob IDs in its HEAD tree.
+
+    Returns (files, bytes) checked. Raises RuntimeError if a file is missing or
+    its contents don't match what git recorded."""
+    return verify_files(path, ls_tree(path, 'HEAD'), pool=pool)
+
+def verify_files(path, expected, pool=None, hashes=None):
+    """Checks files in a git worktree against expected ({path: blob ID}), like verify_checkout."""
+    blob = hashes.blob if hashes else git_blob_hash
+
+    def check(name):
+        try:
+            return blob(path + '/' + name) == expected[name], os.lstat(path + '/' + name).st_size
+        except FileNotFoundError:
+            return None, 0
+
+    names = list(expected)
+    results = list(pool.map(check, names)) if pool else [check(name) for name in names]
+    missing = [name for name, (ok, size) in zip(names, results) if ok is None]
+    mismatched = [name for name, (ok, size) in zip(names, results) if ok is False]
+    if mismatched:
+        # files touched by clean/eol filters hash differently on disk, let git judge those
+        hashed = git(
+            'hash-object', '--stdin-paths', cwd=path, input='\n'.join(mismatched).encode()
+        ).decode().split()
+        mismatched = [name for name, blob in zip(mismatched, hashed) if blob != expected[name]]
+    if missing or mismatched:
+        raise RuntimeError(
+            f'{len(missing)} files missing and {len(mismatched)} corrupted in the downloaded tree: ' +
+            ', '.join((missing + mismatched)[:10])
+        )
+    return len(names), sum([size for ok, size in results])
+
+def link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+class UpgradeBundle:
+    """A release packed into a single zip file by utils/eupgrader_bundle.py.
+
+    bundle.json records the release and the SHA-256 of every file. The zip's
+    central directory is the file index, so single files are read or extracted
+    without unpacking the rest, and each one is checked against bundle.json
+    while it streams."""
+    format = 1
+
+    def __init__(self, path):
+        self.path = path
+        self.zip = zipfile.ZipFile(path)
+        try:
+            raw = self.zip.read('bundle.json')
+            self.manifest = json.loads(raw)
+            if self.manifest.get('format') != self.format:
+                raise ValueError(f'Unsupported bundle format: {self.manifest.get("format")}')
+            missing = set(self.files) - set(self.zip.namelist())
+            if missing:
+                raise ValueError('Bundle index is missing files: ' + ', '.join(sorted(missing)[:10]))
+        except KeyError:
+            self.zip.close()
+            raise ValueError(f'{path} is not an upgrade bundle')
+        except:
+            self.zip.close()
+            raise
+        # bundle.json pins every file, so its hash identifies the bundle's contents
+        self.digest = hashlib.sha256(raw).hexdigest()
+
+    @property
+    def files(self):
+        return self.manifest['files']
+
+    @property
+    def version(self):
+        return self.manifest.get('version')
+
+    def list_files(self, directory):
+        """Returns the names of files directly inside directory, like list_files."""
+        prefix = directory + '/'
+        return sorted([
+            file[len(prefix):] for file in self.files if file.startswith(prefix) and not '/' in file[len(prefix):]
+        ])
+
+    def read(self, file):
+        data = self.zip.read(file)
+        if hashlib.sha256(data).hexdigest() != self.files[file]:
+            raise RuntimeError(f'{file} is corrupted in the bundle')
+        return data
+
+    def read_json(self, file):
+        return json.loads(self.read(file))
+
+    def verify(self, pool=None, chunk=1048576):
+        """Hashes every file in the bundle against bundle.json, raising RuntimeError on any difference.
+
+        Returns (files, bytes) checked."""
+        def check(file):
+            digest = hashlib.sha256()
+            size = 0
+            with self.zip.open(file) as source:
+                while True:
+                    data = source.read(chunk)
+                    if not data:
+                        break
+                    digest.update(data)
+                    size += len(data)
+            if digest.hexdigest() != self.files[file]:
+                raise RuntimeError(f'{file} is corrupted in the bundle')
+            return size
+
+        sizes = list(pool.map(check, self.files) if pool else map(check, self.files))
+        return len(sizes), sum(sizes)
+
+    def extract(self, file, target, chunk=1048576):
+        """Streams a file out of the bundle to target, replacing it only if the hash matches. Returns its size."""
+        digest = hashlib.sha256()
+        size = 0
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with self.zip.open(file) as source, open(target + '.eupgrader-tmp', 'wb') as output:
+            while True:
+                data = source.read(chunk)
+                if not data:
+                    break
+                digest.update(data)
+                output.write(data)
+                size += len(data)
+        if digest.hexdigest() != self.files[file]:
+            os.remove(target + '.eupgrader-tmp')
+            raise RuntimeError(f'{file} is corrupted in the bundle')
+        os.replace(target + '.eupgrader-tmp', target)
+        return size
+
+    def diff(self, pairs, hashes, pool=None):
+        """Compares bundled files against installed ones, given as (file, installed path) pairs.
+
+        Returns the lists of files that are new and that have changed, like diff_files."""
+        def compare(pair):
+            file, path = pair
+            if not os.path.isfile(path):
+                return 'added'
+            if hashes.hash(path) != self.files[file]:
+                return 'changed'
+            return None
+
+        results = pool.map(compare, pairs) if pool else map(compare, pairs)
+        added = []
+        changed = []
+        for (file, path), result in zip(pairs, results):
+            if result == 'added':
+                added.append(file)
+            elif result == 'changed':
+                changed.append(file)
+        return added, changed
+
+    def close(self):
+        self.zip.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def fetch_bundle(location, target):
+    """Returns a local path for the bundle at location, downloading it to target if it is a URL."""
+    if location.startswith('file://'):
+        return location[7:]
+    if not '://' in location:
+        return location
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    with urllib.request.urlopen(location) as response, open(target + '.tmp', 'wb') as file:
+        shutil.copyfileobj(response, file, 1048576)
+    os.replace(target + '.tmp', target)
+    return target
+
+class StagedInstall:
+    """Builds the new tree beside the live one and switches over with renames.
+
+    Directories are staged as hardlinked copies of the live ones with changed
+    files swapped out, and single files are staged next to their live copy.
+    Cutover and rollback are then a handful of renames. A marker file exists
+    while the renames are in progress, so recover can tell a cutover that was
+    interrupted part-way from one that finished."""
+    stage_suffix = '.eupgrader-stage'
+    old_suffix = '.eupgrader-old'
+    marker = '.eupgrader-cutover.json'
+
+    def __init__(self, root, directories):
+        self.root = root
+        self.directories = directories
+        self.staged = []
+        self.created = []
+        self.switched = False
+
+    def live_path(self, file):
+        return self.root + '/' + file
+
+    def staged_path(self, file):
+        if '/' in file and file.split('/', 1)[0] in self.directories:
+            directory, rest = file.split('/', 1)
+            return self.root + '/' + directory + self.stage_suffix + '/' + rest
+        return self.root + '/' + file + self.stage_suffix
+
+    def __leftovers(self):
+        leftovers = []
+        for folder in [self.root, self.root + '/plugins']:
+            try:
+                entries = os.listdir(folder)
+            except FileNotFoundError:
+                continue
+            for entry in entries:
+                if entry.endswith(self.stage_suffix) or entry.endswith(self.old_suffix):
+                    leftovers.append(folder + '/' + entry)
+        return leftovers
+
+    def recover(self):
+        """Undoes a cutover that was interrupted part-way and removes leftover staging files.
+
+        After a cutover that finished, the previous tree is removed instead."""
+        try:
+            with open(self.root + '/' + self.marker, 'r') as file:
+                marker = json.load(file)
+        except FileNotFoundError:
+            marker = None
+        if marker:
+            self.__switch_back(marker['files'], marker['created'])
+            os.remove(self.root + '/' + self.marker)
+        for path in self.__leftovers():
+            if path.endswith(self.old_suffix):
+                live = path[:-len(self.old_suffix)]
+                if not os.path.exists(live):
+                    os.rename(path, live)
+                    continue
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+
+    def prepare(self):
+        self.recover()
+        for directory in self.directories:
+            shutil.copytree(
+                self.live_path(directory), self.staged_path(directory + '/x')[:-2], symlinks=True,
+                copy_function=link_or_copy
+            )
+
+    def __target(self, file):
+        target = self.staged_path(file)
+        if os.path.lexists(target):
+            # may be hardlinked to the live file, so never write through it
+            os.remove(target)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if not file in self.staged:
+            self.staged.append(file)
+        return target
+
+    def stage_file(self, file, src):
+        fastcopy(src, self.__target(file))
+
+    def stage_extract(self, file, bundle):
+        return bundle.extract(file, self.__target(file))
+
+    def stage_data(self, file, data):
+        with open(self.__target(file), 'wb') as target:
+            target.write(data)
+
+    def validate(self, compiler=None):
+        """Checks staged files parse, compiling staged modules to bytecode. Returns the number of modules compiled."""
+        modules = []
+        for file in self.staged:
+            path = self.staged_path(file)
+            if file.endswith('.py'):
+                if file.split('/', 1)[0] in self.directories:
+                    modules.append((path, self.live_path(file)))
+                else:
+                    with open(path, 'rb') as source:
+                        compile(source.read(), file, 'exec')
+            elif file.endswith('.json'):
+                with open(path, 'r') as source:
+                    json.load(source)
+        return (compiler or Compiler(workers=1)).compile(modules)
+
+    def __files(self):
+        return [file for file in self.staged if not file.split('/', 1)[0] in self.directories]
+
+    def __switch_back(self, files, created):
+        for directory in self.directories:
+            live = self.live_path(directory)
+            if os.path.exists(live + self.old_suffix):
+                if os.path.exists(live):
+                    staged = self.staged_path(directory + '/x')[:-2]
+                    shutil.rmtree(staged, ignore_errors=True)
+                    os.rename(live, staged)
+                os.rename(live + self.old_suffix, live)
+        for file in files:
+            live = self.live_path(file)
+            if os.path.exists(live + self.old_suffix):
+                os.replace(live + self.old_suffix, live)
+            elif file in created and os.path.exists(live):
+                os.remove(live)
+
+    def cutover(self):
+        self.switched = True
+        files = self.__files()
+        # written before the first rename, so recover knows to switch back if the renames don't all happen
+        with open(self.root + '/' + self.marker + '.tmp', 'w') as marker:
+            json.dump({
+                'files': files, 'created': [file for file in files if not os.path.exists(self.live_path(file))]
+            }, marker)
+            marker.flush()
+            os.fsync(marker.fileno())
+        os.replace(self.root + '/' + self.marker + '.tmp', self.root + '/' + self.marker)
+        for directory in self.directories:
+            os.rename(self.live_path(directory), self.live_path(directory) + self.old_suffix)
+            os.rename(self.staged_path(directory + '/x')[:-2], self.live_path(directory))
+        for file in files:
+            live = self.live_path(file)
+            if os.path.exists(live):
+                link_or_copy(live, live + self.old_suffix)
+            else:
+                self.created.append(file)
+            os.replace(self.staged_path(file), live)
+        os.remove(self.root + '/' + self.marker)
+
+    def rollback(self):
+        """Switches back to the previous tree, if the cutover happened, and discards the staged one."""
+        if self.switched:
+            self.__switch_back(self.__files(), self.created)
+            self.switched = False
+            try:
+                os.remove(self.root + '/' + self.marker)
+            except FileNotFoundError:
+                pass
+        self.recover()
+
+    def commit(self):
+        """Removes the previous tree once the new one is in use."""
+        self.recover()
+
+class SnapshotStore:
+    """Content-addressed backup store keeping multiple generations.
+
+    File contents are stored once per hash under blobs/, and each snapshot is a
+    small manifest mapping relative paths to blob hashes. Blobs are copies rather
+    than hardlinks, as installs overwrite live files in place."""
+    def __init__(self, root, generations=3, copier=None, hashes=None):
+        self.root = root
+        self.generations = max(generations, 1)
+        self.copier = copier or CopyEngine()
+        self.hashes = hashes or HashCache()
+
+    @property
+    def blobs(self):
+        return self.root + '/blobs'
+
+    @property
+    def manifests(self):
+        return self.root + '/manifests'
+
+    def blob_path(self, digest):
+        return self.blobs + '/' + digest[:2] + '/' + digest
+
+    @property
+    def journals(self):
+        return self.root + '/journals'
+
+    def store(self, path):
+        """Stores a file's contents as a blob. Returns its hash and the number of bytes written."""
+        digest = self.hashes.hash(path)
+        blob = self.blob_path(digest)
+        if os.path.exists(blob):
+            return digest, 0
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        # files with identical contents may be stored at the same time, so each copy gets its own temp file
+        handle, temp = tempfile.mkstemp(dir=os.path.dirname(blob), prefix=digest + '.', suffix='.tmp')
+        os.close(handle)
+        try:
+            fastcopy(path, temp)
+            os.replace(temp, blob)
+        except:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(temp)
+            raise
+        return digest, os.path.getsize(blob)
+
+    def snapshot(self, base, files):
+        """Stores files (relative to base) and writes a manifest. Returns the manifest ID and bytes written."""
+        os.makedirs(self.manifests, exist_ok=True)
+        results = list(self.copier.pool.map(lambda file: self.store(base + '/' + file), files))
+        manifest = {'created': time.time(), 'files': {}}
+        written = 0
+        for file, (digest, size) in zip(files, results):
+            manifest['files'].update({file: digest})
+            written += size
+
+        manifest_id = time.strftime('%Y%m%d-%H%M%S')
+        suffix = 0
+        while os.path.exists(self.manifests + '/' + manifest_id + '.json'):
+            suffix += 1
+            manifest_id = time.strftime('%Y%m%d-%H%M%S') + f'-{suffix}'
+        manifest.update({'id': manifest_id})
+        with open(self.manifests + '/' + manifest_id + '.json.tmp', 'w+') as file:
+            json.dump(manifest, file)
+        os.replace(self.manifests + '/' + manifest_id + '.json.tmp', self.manifests + '/' + manifest_id + '.json')
+        self.evict()
+        return manifest_id, written
+
+    def history(self):
+        """Returns manifest IDs, oldest first."""
+        try:
+            return sorted(
+                [file[:-5] for file in os.listdir(self.manifests) if file.endswith('.json')],
+                key=lambda manifest_id: (os.path.getmtime(self.manifests + '/' + manifest_id + '.json'), manifest_id)
+            )
+        except FileNotFoundError:
+            return []
+
+    def load(self, manifest_id):
+        with open(self.manifests + '/' + manifest_id + '.json', 'r') as file:
+            return json.load(file)
+
+    def restore_pairs(self, manifest_id, base, files=None):
+        """Returns (blob, destination) pairs that restore a manifest into base."""
+        manifest = self.load(manifest_id)
+        pairs = []
+        for file, digest in manifest['files'].items():
+            if files is not None and not file in files:
+                continue
+            os.makedirs(os.path.dirname(base + '/' + file), exist_ok=True)
+            pairs.append((self.blob_path(digest), base + '/' + file))
+        return pairs
+
+    def evict(self):
+        """Removes manifests past the generation limit and any blobs no longer referenced."""
+        manifests = self.history()
+        for manifest_id in manifests[:-self.generations]:
+            os.remove(self.manifests + '/' + manifest_id + '.json')
+        referenced = set()
+        for manifest_id in self.history():
+            try:
+                referenced.update(self.load(manifest_id)['files'].values())
+            except:
+                continue
+        if os.path.isdir(self.journals):
+            # blobs of unfinished upgrades are still needed for rollback
+            for journal in os.listdir(self.journals):
+                try:
+                    entries = UpgradeJournal.read(self.journals + '/' + journal)
+                except:
+                    continue
+                referenced.update([entry['old'] for entry in entries if entry['old']])
+        if not os.path.isdir(self.blobs):
+            return
+        for prefix in os.listdir(self.blobs):
+            for blob in os.listdir(self.blobs + '/' + prefix):
+                # temp files belong to a store that is still copying
+                if not blob in referenced and not blob.endswith('.tmp'):
+                    os.remove(self.blobs + '/' + prefix + '/' + blob)
+
+class UpgradeJournal:
+    """Write-ahead journal of the files an upgrade writes.
+
+    Before a file is written, its previous contents are stored as a snapshot
+    blob and an entry with its path, previous hash and new hash is flushed to
+    disk. Rollback replays the entries in reverse, so only files that were
+    actually touched are restored."""
+    def __init__(self, snapshots, base, journal_id=None):
+        self.snapshots = snapshots
+        self.base = base
+        self.id = journal_id or time.strftime('%Y%m%d-%H%M%S') + '-' + os.urandom(3).hex()
+        self.path = snapshots.journals + '/' + self.id + '.jsonl'
+        self.entries = []
+        self.kept = []
+        self.__lock = threading.Lock()
+        if os.path.exists(self.path):
+            self.entries = self.read(self.path)
+
+    @staticmethod
+    def read(path):
+        entries = []
+        with open(path, 'r') as file:
+            for line in file:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    # torn final entry from a crash, the write it describes never happened
+                    break
+        return entries
+
+    def record(self, file, new=None):
+        """Records that file (relative to base) is about to be written with contents hashing to new."""
+        live = self.base + '/' + file
+        old = self.snapshots.store(live)[0] if os.path.isfile(live) else None
+        entry = {'path': file, 'old': old, 'new': new}
+        with self.__lock:
+            os.makedirs(self.snapshots.journals, exist_ok=True)
+            with open(self.path, 'a') as journal:
+                journal.write(json.dumps(entry) + '\n')
+                journal.flush()
+                os.fsync(journal.fileno())
+            self.entries.append(entry)
+
+    def record_many(self, files, pool=None):
+        """Records several files, given as (file, new) pairs."""
+        if pool:
+            list(pool.map(lambda pair: self.record(*pair), files))
+        else:
+            for file, new in files:
+                self.record(file, new)
+
+    def keep(self, file):
+        """Notes that file was written without journaling, as the change it records can't be undone."""
+        if not file in self.kept:
+            self.kept.append(file)
+
+    def rollback(self):
+        """Restores every journaled file to its previous contents, newest write first."""
+        for entry in reversed(self.entries):
+            live = self.base + '/' + entry['path']
+            if entry['old']:
+                os.makedirs(os.path.dirname(live), exist_ok=True)
+                fastcopy(self.snapshots.blob_path(entry['old']), live + '.eupgrader-restore')
+                os.replace(live + '.eupgrader-restore', live)
+            elif os.path.exists(live):
+                os.remove(live)
+        self.close()
+
+    def close(self):
+        """Discards the journal once the upgrade has finished or been rolled back."""
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+        self.entries = []
+
+class UpgradeCheckpoint:
+    """Records how far a system upgrade got, so an interrupted one can be resumed or rolled back.
+
+    Holds the selected version, the backup snapshot and journal IDs, the blob IDs
+    of the verified download and the stages completed so far. The file is
+    replaced atomically after every stage and removed once the upgrade has
+    finished or been rolled back."""
+    def __init__(self, path, data=None):
+        self.path = path
+        self.data = data or {}
+        self.data.setdefault('stages', [])
+
+    @classmethod
+    def load(cls, path):
+        """Returns the checkpoint left by an interrupted upgrade, or None."""
+        try:
+            with open(path, 'r') as file:
+                return cls(path, json.load(file))
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            # the file is replaced atomically, so this is not from an upgrade we wrote
+            return None
+
+    @property
+    def stages(self):
+        return self.data['stages']
+
+    def done(self, stage):
+        return stage in self.stages
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + '.tmp', 'w+') as file:
+            json.dump(self.data, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(self.path + '.tmp', self.path)
+
+    def update(self, **data):
+        self.data.update(data)
+        self.save()
+
+    def complete(self, stage, **data):
+        """Marks a stage as completed, along with anything a resumed upgrade needs from it."""
+        self.data.update(data)
+        if not stage in self.stages:
+            self.stages.append(stage)
+        self.save()
+
+    def clear(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+def upgrade_candidates(update, current, force=False):
+    """Lists versions from update.json that current (system.json) can upgrade to.
+
+    Each entry is [version, description, release, legacy index or -1, reboot]."""
+    available = []
+    if update['release'] > current['release'] or force:
+        available.append([update['version'], 'Release version', update['release'], -1, update['reboot']])
+    index = 0
+    for legacy in update['legacy']:
+        if (
+                legacy['lower'] <= current['release'] <= legacy['upper'] and (
+                    legacy['release'] > (
+                        current['legacy'] if 'legacy' in current.keys() else -1
+                    ) or force
+                )
+        ):
+            available.append([legacy['version'], 'Legacy version', legacy['release'], index, legacy['reboot']])
+        index += 1
+    return available
+
+class Handover:
+    """Starts a replacement bot process and waits until it has finished loading.
+
+    The new process connects to a local socket once it is ready (see
+    eupgrader_handover.ready) and holds the connection until this process
+    closes it or exits, so it only connects to Discord once we're offline."""
+    def __init__(self, entry, args=None, timeout=120, log=None):
+        self.entry = entry
+        self.args = args or []
+        self.timeout = timeout
+        self.log = log
+        self.path = tempfile.gettempdir() + f'/eupgrader-{os.getpid()}.sock'
+        self.process = None
+        self.server = None
+        self.conn = None
+
+    def start(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(self.path)
+        self.server.listen(1)
+        output = open(self.log, 'ab') if self.log else subprocess.DEVNULL
+        try:
+            self.process = subprocess.Popen(
+                [sys.executable, self.entry] + list(self.args), cwd=os.getcwd(),
+                env=dict(os.environ, EUPGRADER_HANDOVER=self.path), stdin=subprocess.DEVNULL, stdout=output,
+                stderr=subprocess.STDOUT, start_new_session=True
+            )
+        finally:
+            if self.log:
+                output.close()
+
+    def wait(self):
+        """Blocks until the new process reports ready. Raises RuntimeError if it exits or times out first."""
+        deadline = time.monotonic() + self.timeout
+        self.server.settimeout(0.5)
+        while True:
+            if self.process.poll() is not None:
+                raise RuntimeError(f'Replacement process exited with code {self.process.returncode}')
+            if time.monotonic() > deadline:
+                raise RuntimeError(f'Replacement process was not ready within {self.timeout}s')
+            try:
+                conn, _address = self.server.accept()
+            except socket.timeout:
+                continue
+            conn.settimeout(max(deadline - time.monotonic(), 0.1))
+            data = b''
+            try:
+                while not data.endswith(b'\n'):
+                    chunk = conn.recv(64)
+                    if not chunk:
+                        break
+                    data += chunk
+            except OSError:
+                pass
+            if data.strip() == b'ready':
+                self.conn = conn
+                return
+            conn.close()
+
+    def release(self):
+        """Closes the socket, letting the new process connect."""
+        for sock in [self.conn, self.server]:
+            if sock:
+                sock.close()
+        self.conn = None
+        self.server = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def abort(self):
+        if self.process and self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+        self.release()
+
+def needs_reboot(candidate, current):
+    """Returns whether upgrading current (system.json) to an upgrade_candidates entry needs a reboot."""
+    if candidate[3] > -1:
+        return candidate[4] >= (current['legacy'] if 'legacy' in current.keys() and
+                                type(current['legacy']) is int else -1)
+    return candidate[4] >= current['release']
+
+class LagMonitor:
+    """Measures how late the event loop wakes up while it is running.
+
+    A coroutine sleeping for interval seconds should wake up on time; any extra
+    delay is time the loop spent blocked."""
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.max_stall = 0
+        self.stalls = 0
+        self.__task = None
+
+    async def __watch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            stall = loop.time() - started - self.interval
+            if stall > self.interval:
+                self.stalls += 1
+            self.max_stall = max(self.max_stall, stall)
+
+    def start(self):
+        self.__task = asyncio.get_running_loop().create_task(self.__watch())
+
+    def stop(self):
+        if self.__task:
+            self.__task.cancel()
+            self.__task = None
+        return self.max_stall
+
+class StageGraph:
+    """Runs upgrade stages as soon as the stages they depend on have finished.
+
+    When a stage fails, or run itself is cancelled, stages that haven't started
+    are skipped and the ones already running are left to finish, so nothing is
+    still writing files when the caller rolls back. The first error (or the
+    cancellation) is then raised."""
+    def __init__(self):
+        self.stages = {}
+        self.results = {}
+        self.failed = None
+        self.cancelled = False
+
+    def add(self, name, func, after=()):
+        """Adds a stage. func is a coroutine function taking no arguments; after lists stages added earlier."""
+        for dependency in after:
+            if not dependency in self.stages:
+                raise ValueError(f'Stage {name} depends on unknown stage {dependency}')
+        self.stages.update({name: (func, list(after))})
+
+    def cancel(self):
+        """Stops further stages from starting."""
+        self.cancelled = True
+
+    async def run(self):
+        tasks = {}
+        errors = []
+
+        async def run_stage(name):
+            func, after = self.stages[name]
+            if not all(await asyncio.gather(*[tasks[dependency] for dependency in after])) or self.cancelled:
+                return False
+            try:
+                self.results.update({name: await func()})
+            except BaseException as e:
+                if not errors:
+                    self.failed = name
+                errors.append(e)
+                self.cancel()
+                return False
+            return True
+
+        for name in self.stages:
+            tasks.update({name: asyncio.ensure_future(run_stage(name))})
+        pending = set(tasks.values())
+        cancelled = None
+        while pending:
+            try:
+                # unlike gather, wait doesn't cancel the stages when cancelled, so executor work can't be cut off
+                done, pending = await asyncio.wait(pending)
+            except asyncio.CancelledError as e:
+                self.cancel()
+                cancelled = e
+        if cancelled:
+            raise cancelled
+        if errors:
+            raise errors[0]
+        return self.results
+
+class Span:
+    """Timing and I/O counters for one upgrade stage."""
+    __slots__ = ('name', 'started', 'duration', 'bytes', 'files', 'failed')
+
+    def __init__(self, name):
+        self.name = name
+        self.started = time.perf_counter()
+        self.duration = None
+        self.bytes = 0
+        self.files = 0
+        self.failed = False
+
+    def add(self, size=0, files=0):
+        self.bytes += size
+        self.files += files
+
+class UpgradeMetrics:
+    """Per-stage timings for a single upgrade, exported as JSON and Prometheus text."""
+    def __init__(self, target, slow=None, logger=None):
+        self.target = target
+        self.slow = slow
+        self.logger = logger
+        self.created = time.time()
+        self.spans = []
+        self.lag = None
+
+    def start(self, name):
+        span = Span(name)
+        self.spans.append(span)
+        return span
+
+    def stop(self, span, failed=False):
+        if span.duration is not None:
+            return
+        span.duration = time.perf_counter() - span.started
+        span.failed = failed
+        if self.slow and span.duration > self.slow and self.logger:
+            self.logger.warning(f'Stage {span.name} took {span.duration:.1f}s (threshold: {self.slow}s)')
+
+    @contextlib.contextmanager
+    def span(self, name):
+        span = self.start(name)
+        try:
+            yield span
+        except BaseException:
+            self.stop(span, failed=True)
+            raise
+        self.stop(span)
+
+    def finish(self):
+        """Stops spans left open by a failure."""
+        for span in self.spans:
+            self.stop(span, failed=True)
+
+    @property
+    def max_stall(self):
+        return self.lag.max_stall if self.lag else None
+
+    @property
+    def total(self):
+        """Wall time from the first stage starting to the last one finishing."""
+        if not self.spans:
+            return 0
+        return max([span.started + (span.duration or 0) for span in self.spans]) - min(
+            [span.started for span in self.spans]
+        )
+
+    def summary(self):
+        lines = []
+        for span in self.spans:
+            duration = span.duration if span.duration is not None else time.perf_counter() - span.started
+            line = f'`{span.name}`: {duration:.2f}s'
+            if span.files:
+                line += f', {span.files} files'
+            if span.bytes >= 1048576:
+                line += f', {span.bytes / 1048576:.2f} MiB'
+            elif span.bytes:
+                line += f', {span.bytes / 1024:.1f} KiB'
+            if span.failed:
+                line += ' (failed)'
+            lines.append(line)
+        if self.max_stall is not None:
+            lines.append(f'Longest event loop stall: {self.max_stall * 1000:.0f}ms')
+        return '\n'.join(lines)[:1024]
+
+    def to_dict(self):
+        return {
+            'target': self.target,
+            'created': self.created,
+            'total': self.total,
+            'max_stall': self.max_stall,
+            'stages': [
+                {
+                    'name': span.name, 'seconds': span.duration, 'bytes': span.bytes, 'files': span.files,
+                    'failed': span.failed
+                } for span in self.spans
+            ]
+        }
+
+    def prometheus(self):
+        lines = []
+        for metric, key, description in [
+            ('eupgrader_stage_seconds', 'duration', 'Wall time spent in each upgrade stage.'),
+            ('eupgrader_stage_bytes', 'bytes', 'Bytes transferred or written by each upgrade stage.'),
+            ('eupgrader_stage_files', 'files', 'Files handled by each upgrade stage.')
+        ]:
+            lines.append(f'# HELP {metric} {description}')
+            lines.append(f'# TYPE {metric} gauge')
+            for span in self.spans:
+                lines.append(
+                    f'{metric}{{target="{self.target}",stage="{span.name}"}} {getattr(span, key) or 0}'
+                )
+        if self.max_stall is not None:
+            lines.append('# HELP eupgrader_loop_max_stall_seconds Longest event loop stall during the upgrade.')
+            lines.append('# TYPE eupgrader_loop_max_stall_seconds gauge')
+            lines.append(f'eupgrader_loop_max_stall_seconds{{target="{self.target}"}} {self.max_stall}')
+        lines.append('# HELP eupgrader_last_upgrade_timestamp_seconds When the last upgrade started.')
+        lines.append('# TYPE eupgrader_last_upgrade_timestamp_seconds gauge')
+        lines.append(f'eupgrader_last_upgrade_timestamp_seconds{{target="{self.target}"}} {self.created}')
+        return '\n'.join(lines) + '\n'
+
+    def export(self, directory, history=50):
+        """Writes metrics.prom for this upgrade and appends it to the metrics.json history."""
+        os.makedirs(directory, exist_ok=True)
+        try:
+            with open(directory + '/metrics.json', 'r') as file:
+                entries = json.load(file)
+        except:
+            entries = []
+        entries = (entries + [self.to_dict()])[-history:]
+        with open(directory + '/metrics.json.tmp', 'w+') as file:
+            json.dump(entries, file, indent=2)
+        os.replace(directory + '/metrics.json.tmp', directory + '/metrics.json')
+        with open(directory + '/metrics.prom.tmp', 'w+') as file:
+            file.write(self.prometheus())
+        os.replace(directory + '/metrics.prom.tmp', directory + '/metrics.prom')
 
 class EmergencyUpgrader(commands.Cog):
     def __init__(self,bot):
         global language
         self.bot = bot
         self.logger = log.buildlogger(self.bot.package, 'eupgrader', self.bot.loglevel)
+        self.copier = CopyEngine(self.bot.config.get('eupgrader_copy_workers'))
+        self.compiler = Compiler(self.bot.config.get('eupgrader_compile_workers'))
+        self.emoji_preprocessor = EmojiPreprocessor(
+            os.getcwd() + '/.eupgrader/emojis', max_bytes=self.bot.config.get('eupgrader_emoji_max_kb', 256) * 1024,
+            max_side=self.bot.config.get('eupgrader_emoji_max_size', 128),
+            workers=self.bot.config.get('eupgrader_emoji_workers')
+        )
+        self.plugins = PluginRegistry()
+        self.reload_timings = {}
+        self.metrics = UpgradeMetrics(None)
+        self.cache_root = os.getcwd() + '/.eupgrader'
+        self.metadata = RemoteMetadata(
+            self.cache_root + '/metadata', self.bot.config.get('eupgrader_check_ttl', 300)
+        )
+        self.mirrors = MirrorCache(
+            self.cache_root + '/mirrors', self.bot.config.get('eupgrader_mirror_max_mb', 1024) * 1048576
+        )
+        self.hashes = HashCache(self.cache_root + '/hashes.json')
+        self.wheelhouse = Wheelhouse(self.cache_root + '/wheelhouse')
+        self.upgrade_lock = asyncio.Lock()
+        self.handover = None
+        self.io = AsyncFiles()
+        self.prefetched = None
+        self.snapshots = SnapshotStore(
+            os.getcwd() + '/old', self.bot.config.get('eupgrader_backup_generations', 3), copier=self.copier,
+            hashes=self.hashes
+        )
+        if self.bot.config.get('eupgrader_prefetch_interval'):
+            self.prefetcher.change_interval(seconds=self.bot.config['eupgrader_prefetch_interval'])
+            self.prefetcher.start()
+
+    def cog_unload(self):
+        self.prefetcher.cancel()
+        self.copier.shutdown()
+        self.compiler.shutdown()
+        self.emoji_preprocessor.shutdown()
+
+    @tasks.loop(hours=1)
+    async def prefetcher(self):
+        try:
+            await self.prefetch_upgrade()
+        except:
+            self.logger.exception('Background prefetch failed')
+
+    @prefetcher.before_loop
+    async def before_prefetcher(self):
+        await self.bot.wait_until_ready()
+
+    async def prefetch_upgrade(self):
+        """Downloads and checks out the newest Unifier upgrade and its dependencies ahead of time.
+
+        The checkout is left in .eupgrader/prestage, where emergency_upgrade picks it up
+        instead of downloading again."""
+        if self.upgrade_lock.locked():
+            return
+        async with self.upgrade_lock:
+            used = await self.io.run(lambda: dirsize(self.cache_root))
+            free = (await self.io.run(shutil.disk_usage, os.getcwd())).free
+            if used > self.bot.config.get('eupgrader_prefetch_max_mb', 2048) * 1048576:
+                self.logger.warning(f'Skipping prefetch, cache is using {used / 1048576:.0f}MB')
+                return
+            if free < self.bot.config.get('eupgrader_prefetch_min_free_mb', 1024) * 1048576:
+                self.logger.warning(f'Skipping prefetch, only {free / 1048576:.0f}MB of disk space left')
+                return
+            current = await self.io.read_json('plugins/system.json')
+            if current['release'] >= 75:
+                # emergency_upgrade refuses to touch patched versions, so there is nothing to prefetch
+                return
+            update_raw = await self.io.run(lambda: self.metadata.read(
+                self.bot.config['check_endpoint'], self.bot.config['branch'], 'update.json', fresh=True
+            ))
+            available = upgrade_candidates(json.loads(update_raw), current)
+            if not available:
+                return
+            version = available[0][0]
+            if self.prefetched == version and await self.io.run(os.path.isdir, self.cache_root + '/prestage'):
+                return
+            self.logger.debug(f'Prefetching Unifier {version}')
+            url = self.bot.config['files_endpoint'] + '/unifier.git'
+            await self.io.run(lambda: self.mirrors.checkout(url, version, self.cache_root + '/prestage'))
+            requirements = (await self.io.read(self.cache_root + '/prestage/requirements.txt')).decode().split('\n')
+            await self.prefetch_dependencies(requirements)
+            self.prefetched = version
+            self.logger.info(f'Unifier {version} is downloaded and ready to install')
 
-    async def copy(self, src, dst):
-        await self.bot.loop.run_in_executor(None, lambda: shutil.copy2(src, dst))
+    async def copy_files(self, pairs, action='Copying', strict=True, span=None):
+        """Copies files through the copy engine and returns per-file results.
+
+        If strict is set, a RuntimeError is raised when any copy fails."""
+        results = await self.copier.copy(pairs, loop=self.bot.loop)
+        failed = []
+        for result in results:
+            if result.ok:
+                self.logger.debug(action + ': ' + result.src)
+                if span:
+                    span.add(result.size, 1)
+            else:
+                self.logger.error(f'{action} failed: {result.src} ({result.error})')
+                failed.append(result)
+        if strict and failed:
+            raise RuntimeError(f'{len(failed)} of {len(results)} files failed to copy')
+        return results
 
     async def preunload(self, extension):
         """Performs necessary steps before unloading."""
-        info = None
-        plugin_name = None
-        if extension.startswith('cogs.'):
-            extension = extension.replace('cogs.', '', 1)
-        for plugin in os.listdir('plugins'):
-            if extension + '.json' == plugin:
-                plugin_name = plugin[:-5]
-                try:
-                    with open('plugins/' + plugin) as file:
-                        info = json.load(file)
-                except:
-                    continue
-                break
-            else:
-                try:
-                    with open('plugins/' + plugin) as file:
-                        info = json.load(file)
-                except:
-                    continue
-                if extension + '.py' in info['modules']:
-                    plugin_name = plugin[:-5]
-                    break
+        plugin_name, info = await self.io.run(self.plugins.lookup, extension)
         if not plugin_name:
             return
         if plugin_name == 'system':
@@ -104,16 +2154,639 @@ class EmergencyUpgrader(commands.Cog):
             raise ValueError('Invalid plugin')
         if not info['shutdown']:
             return
-        script = importlib.import_module('utils.' + plugin_name + '_check')
+        script = await self.io.run(self.plugins.check_module, plugin_name)
         await script.check(self.bot)
 
+    def background(self, coro):
+        """Schedules a coroutine whose failure should only be logged unless it is awaited."""
+        def done(task):
+            if not task.cancelled() and task.exception():
+                self.logger.debug(f'Background task failed: {task.exception()}')
+
+        task = self.bot.loop.create_task(coro)
+        task.add_done_callback(done)
+        return task
+
+    async def prefetch_dependencies(self, requirements, no_deps=False):
+        """Downloads wheels for unsatisfied requirements into the wheelhouse."""
+        missing = await self.io.run(lambda: unsatisfied_requirements(requirements))
+        if missing:
+            self.logger.debug('Prefetching: ' + ' '.join(missing))
+            await self.io.run(lambda: self.wheelhouse.prefetch(missing, no_deps=no_deps))
+        return missing
+
+    async def install_dependencies(self, requirements, no_deps=False, prefetch=None):
+        """Installs unsatisfied requirements in a single pip run, using the wheelhouse where possible."""
+        if prefetch:
+            try:
+                await prefetch
+            except:
+                self.logger.warning('Dependency prefetch failed, installing from index')
+        missing = await self.io.run(lambda: unsatisfied_requirements(requirements))
+        if not missing:
+            self.logger.debug('All dependencies are already satisfied')
+            return missing
+        self.logger.debug('Installing: ' + ' '.join(missing))
+        await self.io.run(lambda: self.wheelhouse.install(missing, no_deps=no_deps))
+        return missing
+
+    async def check_plugin(self, plugin_info, force=False, bundle=None):
+        """Returns the remote (or bundled) plugin.json of a plugin if it has an upgrade available, or None.
+
+        A remote plugin.json gets the commit it was read from as 'commit', so the download can be
+        pinned to the release that was confirmed. Raises ValueError if the remote plugin ID is invalid."""
+        if bundle:
+            new = await self.io.run(bundle.read_json, 'plugin.json')
+        else:
+            raw, commit = await self.io.run(
+                lambda: self.metadata.read_commit(plugin_info['repository'], 'HEAD', 'plugin.json', fresh=force)
+            )
+            new = json.loads(raw)
+            new.update({'commit': commit})
+        if not bool(re.match("^[a-z0-9_-]*$", new['id'])):
+            raise ValueError('Invalid plugin ID')
+        if new['release'] <= plugin_info['release'] and not force:
+            return None
+        return new
+
+    async def compile_installed(self, files):
+        """Byte-compiles installed cogs and utils so reloads load warm bytecode. Raises SyntaxError on bad files."""
+        modules = [
+            (os.getcwd() + '/' + file, None) for file in files
+            if file.endswith('.py') and file.split('/', 1)[0] in ['cogs', 'utils']
+        ]
+        with self.metrics.span('compile') as span:
+            span.add(files=await self.io.run(self.compiler.compile, modules))
+
+    async def start_handover(self, msg, embed):
+        """Starts the replacement process after a reboot-required upgrade and waits for it to be ready.
+
+        The old process is shut down by finish_handover once the upgrade command is done."""
+        handover = Handover(
+            self.bot.config['eupgrader_handover_entry'], self.bot.config.get('eupgrader_handover_args'),
+            timeout=self.bot.config.get('eupgrader_handover_timeout', 120), log=self.cache_root + '/handover.log'
+        )
+        embed.description = 'The upgrade was successful. Starting the new process...'
+        await msg.edit(embed=embed)
+        try:
+            with self.metrics.span('handover'):
+                await self.io.run(handover.start)
+                await self.io.run(handover.wait)
+        except:
+            self.logger.exception('Handover failed, a manual reboot is required')
+            await self.io.run(handover.abort)
+            embed.description = ('The upgrade was successful, but the new process could not be started. '
+                                 'Please reboot the bot.')
+            await msg.edit(embed=embed)
+            return
+        self.logger.info(f'Replacement process {handover.process.pid} is ready, shutting down')
+        embed.title = f'{self.bot.ui_emojis.success} Upgrade successful'
+        embed.description = 'The upgrade was successful! The new process is taking over now.'
+        await msg.edit(embed=embed)
+        self.handover = handover
+
+    async def finish_handover(self):
+        handover = self.handover
+        self.handover = None
+        try:
+            await self.bot.close()
+        finally:
+            await self.io.run(handover.release)
+
+    def kept_note(self, journals):
+        """Describes files a rollback left alone because the changes they record couldn't be undone."""
+        kept = [file for journal in journals for file in journal.kept]
+        if not kept:
+            return ''
+        return ('\nEmojis had already been changed in the home guild, so the emoji packs were updated to match it: ' +
+                ', '.join([f'`{file}`' for file in kept]))
+
+    async def download_plugin(self, url, target, limit=True, commit=None):
+        """Checks out a plugin at commit (or the remote's default branch) to target and verifies it."""
+        with self.metrics.span('download') as span:
+            span.add(await self.io.run(lambda: self.mirrors.checkout(url, commit, target, limit=limit)))
+        await self.verify_download(target)
+
+    async def verify_download(self, target):
+        """Hashes a downloaded tree against its git tree, raising RuntimeError on any difference."""
+        with self.metrics.span('verify') as span:
+            files, size = await self.io.run(lambda: verify_checkout(target, pool=self.copier.pool))
+            span.add(size, files)
+        self.logger.debug(f'Verified {files} downloaded files')
+
+    async def verify_bundle(self, bundle):
+        """Hashes every file in a bundle against its manifest, raising RuntimeError on any difference."""
+        with self.metrics.span('verify') as span:
+            files, size = await self.io.run(lambda: bundle.verify(pool=self.copier.pool))
+            span.add(size, files)
+        self.logger.debug(f'Verified {files} bundled files')
+
+    def bundle_url(self, name):
+        """Returns where to get a bundle from if eupgrader_bundles is set, or None to use git."""
+        location = self.bot.config.get('eupgrader_bundles')
+        if not location:
+            return None
+        if location is True:
+            location = self.bot.config['files_endpoint']
+        return location.rstrip('/') + '/' + name
+
+    async def download_bundle(self, checkpoint, version):
+        """Fetches and checks the bundle for a Unifier release, recording its manifest hash in the checkpoint."""
+        self.logger.info('Downloading bundle...')
+        with self.metrics.span('download') as span:
+            path = await self.io.run(
+                fetch_bundle, checkpoint.data['bundle'], self.cache_root + f'/bundles/unifier-{version}.zip'
+            )
+            span.add(await self.io.run(os.path.getsize, path), 1)
+        with await self.io.run(UpgradeBundle, path) as bundle:
+            if bundle.version != version:
+                raise ValueError(f'Bundle contains {bundle.version}, expected {version}')
+            if not 'plugins/system.json' in bundle.files:
+                raise FileNotFoundError('plugins/system.json')
+            # every file is checked now, as direct installs extract over live files and can't stop halfway
+            await self.verify_bundle(bundle)
+        await self.io.run(lambda: checkpoint.complete('download', bundle_path=path, commit=bundle.digest, artifacts=None))
+        self.logger.debug('Bundle confirmed, proceeding with upgrade')
+
+    async def download_system(self, checkpoint, version, force=False):
+        """Downloads and verifies a Unifier release into update/, recording its blob IDs in the checkpoint."""
+        if checkpoint.data.get('bundle'):
+            return await self.download_bundle(checkpoint, version)
+        self.logger.info('Downloading from remote repository...')
+        url = self.bot.config['files_endpoint'] + '/unifier.git'
+        target = os.getcwd() + '/update'
+        with self.metrics.span('download') as span:
+            if not force and await self.io.run(lambda: self.mirrors.adopt(
+                url, version, self.cache_root + '/prestage', target
+            )):
+                self.logger.debug('Using prefetched download')
+            else:
+                span.add(await self.io.run(lambda: self.mirrors.checkout(url, version, target)))
+            self.prefetched = None
+        self.logger.debug('Confirming download...')
+        if not await self.io.exists(target + '/plugins/system.json'):
+            raise FileNotFoundError('update/plugins/system.json')
+        await self.verify_download(target)
+        commit = (await self.io.run(lambda: git('rev-parse', 'HEAD', cwd=target))).decode()
+        artifacts = await self.io.run(ls_tree, target, 'HEAD')
+        await self.io.run(lambda: checkpoint.complete('download', commit=commit.strip(), artifacts=artifacts))
+        self.logger.debug('Download confirmed, proceeding with upgrade')
+
+    async def verify_resumed_download(self, checkpoint):
+        """Checks update/ still holds the download an interrupted upgrade verified. Returns False if it doesn't."""
+        target = os.getcwd() + '/update'
+        try:
+            with self.metrics.span('verify') as span:
+                if checkpoint.data.get('bundle'):
+                    with await self.io.run(UpgradeBundle, checkpoint.data['bundle_path']) as bundle:
+                        if bundle.digest != checkpoint.data['commit']:
+                            raise RuntimeError('Bundle has changed since it was checked')
+                        files, size = await self.io.run(lambda: bundle.verify(pool=self.copier.pool))
+                        span.add(size, files)
+                    return True
+                commit = await self.io.run(lambda: git('rev-parse', 'HEAD', cwd=target))
+                if commit.decode().strip() != checkpoint.data['commit']:
+                    raise RuntimeError('update/ is at a different commit')
+                files, size = await self.io.run(lambda: verify_files(
+                    target, checkpoint.data['artifacts'], pool=self.copier.pool, hashes=self.hashes
+                ))
+                span.add(size, files)
+        except:
+            self.logger.exception('Previous download is no longer valid, downloading again')
+            return False
+        return True
+
+    async def install_plugin(
+            self, plugin_id, source, url, journal, prefetch=None, dependencies=True, bundle=None, confirmed=None
+    ):
+        """Installs a downloaded plugin from source, journaling every file it writes.
+
+        With a bundle, only changed modules are extracted, straight to their installed paths, and
+        source only receives the emoji images. confirmed is the plugin.json the user agreed to install."""
+        if bundle:
+            new = await self.io.run(bundle.read_json, 'plugin.json')
+        else:
+            new = await self.io.read_json(source + '/plugin.json')
+        if new['id'] != plugin_id:
+            raise ValueError('Plugin ID changed between check and download')
+        if confirmed and new['release'] != confirmed['release']:
+            raise ValueError(f'Plugin release changed from {confirmed["release"]} to {new["release"]} since it was checked')
+        modules = new['modules']
+        utilities = new['utils']
+        services = new['services'] if 'services' in new.keys() else []
+        graph = StageGraph()
+
+        async def install_dependencies():
+            self.logger.debug('Installing dependencies')
+            with self.metrics.span('deps') as span:
+                span.add(files=len(
+                    await self.install_dependencies(new['requirements'], no_deps=True, prefetch=prefetch)
+                ))
+
+        async def install_files():
+            self.logger.info('Upgrading Plugin')
+            tocopy = ['cogs/' + module for module in modules] + ['utils/' + util for util in utilities]
+            if bundle:
+                names = {file: file.split('/', 1)[1] for file in tocopy}
+                added, changed = await self.io.run(lambda: bundle.diff(
+                    [(names[file], os.getcwd() + '/' + file) for file in tocopy], self.hashes, pool=self.copier.pool
+                ))
+                tocopy = [file for file in tocopy if names[file] in added or names[file] in changed]
+                self.logger.debug(f'{len(tocopy)} of {len(names)} plugin files changed')
+                with self.metrics.span('install') as span:
+                    await self.io.run(lambda: journal.record_many(
+                        [(file, bundle.files[names[file]]) for file in tocopy], pool=self.copier.pool
+                    ))
+                    span.add(sum(await self.io.run(lambda: list(self.copier.pool.map(
+                        lambda file: bundle.extract(names[file], os.getcwd() + '/' + file), tocopy
+                    )))), len(tocopy))
+                await self.compile_installed(tocopy)
+                return
+            sources = [source + '/' + file.split('/', 1)[1] for file in tocopy]
+            with self.metrics.span('install') as span:
+                await self.io.run(lambda: journal.record_many(
+                    [(file, self.hashes.hash(path)) for file, path in zip(tocopy, sources)], pool=self.copier.pool
+                ))
+                await self.copy_files(
+                    [(path, os.getcwd() + '/' + file) for file, path in zip(tocopy, sources)], action='Installing',
+                    span=span
+                )
+            await self.compile_installed(tocopy)
+
+        async def prepare_emojis():
+            if bundle:
+                emojipack = await self.io.run(bundle.read_json, 'emoji.json')
+                images = [
+                    'emojis/' + entry[0] for entry in emojipack['emojis'].values()
+                    if 'emojis/' + entry[0] in bundle.files
+                ]
+                await self.io.run(lambda: shutil.rmtree(source, ignore_errors=True))
+                await self.io.run(lambda: list(self.copier.pool.map(
+                    lambda image: bundle.extract(image, source + '/' + image), images
+                )))
+            else:
+                emojipack = await self.io.read_json(source + '/emoji.json')
+            with self.metrics.span('emoji_prep') as span:
+                images = await self.io.run(self.emoji_preprocessor.prepare, source + '/emojis', emojipack)
+                shrunk = [name for name, path in images.items() if path.startswith(self.emoji_preprocessor.cache)]
+                span.add(files=len(shrunk))
+            if shrunk:
+                self.logger.info('Using shrunk images for: ' + ', '.join(shrunk))
+            return emojipack, images
+
+        async def install_emojis():
+            self.logger.info('Installing new Emoji Pack')
+            span = self.metrics.start('emoji')
+            home_guild = self.bot.get_guild(self.bot.config['home_guild'])
+            oldemojipack = await self.io.read_json(f'emojis/{plugin_id}.json')
+            emojipack, images = graph.results['emoji_prep']
+            installer = EmojiInstaller(
+                home_guild, concurrency=self.bot.config.get('eupgrader_emoji_concurrency', 4), logger=self.logger
+            )
+            try:
+                emojipack = await installer.install(oldemojipack, emojipack, source + '/emojis', images=images)
+            except EmojiInstallError as e:
+                # save what is in the guild now, as the old pack may point at deleted emojis
+                await save_emojis(e.pack)
+                raise
+            emojipack['installed'] = True
+            await save_emojis(emojipack)
+            span.add(files=len(emojipack['emojis']))
+            self.metrics.stop(span)
+
+        async def save_emojis(emojipack):
+            # the old emojis are gone from the guild now, so the pack files are kept even if the upgrade is rolled back
+            await self.io.write_json(f'emojis/{plugin_id}.json', emojipack, indent=2)
+            journal.keep(f'emojis/{plugin_id}.json')
+            currentdata = await self.io.read_json('emojis/current.json')
+            if currentdata['id']==plugin_id:
+                emojipack.update({'id': plugin_id})
+                await self.io.write_json('emojis/current.json', emojipack, indent=2)
+                journal.keep('emojis/current.json')
+                # the host may have set up its own theme object, which has no base pack to merge over
+                theme = self.bot.ui_emojis if isinstance(self.bot.ui_emojis, Emojis) else await self.io.run(Emojis)
+                self.bot.ui_emojis = theme.merge(emojipack)
+
+        async def register():
+            self.logger.info('Registering plugin')
+            plugin_info = copy.deepcopy(new)
+            plugin_info.update({'repository': url})
+            await self.io.run(journal.record, 'plugins/' + plugin_id + '.json')
+            await self.io.write_json('plugins/' + plugin_id + '.json', plugin_info)
+
+        # dependencies, files and emoji preprocessing don't depend on each other. Guild emojis can't be
+        # rolled back, so they are replaced last, once everything else has installed and compiled.
+        if dependencies and 'requirements' in new.keys():
+            graph.add('deps', install_dependencies)
+        graph.add('install', install_files)
+        if 'emojis' in services:
+            graph.add('emoji_prep', prepare_emojis)
+        graph.add('register', register, after=[stage for stage in graph.stages if stage != 'emoji_prep'])
+        if 'emojis' in services:
+            graph.add('emoji', install_emojis, after=['emoji_prep', 'register'])
+        try:
+            await graph.run()
+        except:
+            self.logger.exception(f'Plugin {plugin_id} failed at stage {graph.failed}')
+            raise
+
+    async def reload_extensions(self, planner):
+        """Reloads the modules affected by an install and returns reload times per extension."""
+        with self.metrics.span('reload') as span:
+            return await self.__reload_extensions(planner, span)
+
+    async def __reload_extensions(self, planner, span):
+        utils_order, toreload = await self.io.run(lambda: planner.plan(list(self.bot.extensions)))
+        span.add(files=len(utils_order) + len(toreload))
+        for module in utils_order:
+            self.logger.debug('Reloading module: ' + module)
+            importlib.reload(sys.modules[module])
+        await asyncio.gather(*[self.preunload(extension) for extension in toreload])
+        timings = {}
+        for extension in toreload:
+            self.logger.debug('Restarting extension: ' + extension)
+            started = time.perf_counter()
+            self.bot.reload_extension(extension)
+            timings.update({extension: time.perf_counter() - started})
+            self.logger.debug(f'Restarted {extension} in {timings[extension] * 1000:.1f}ms')
+        if timings:
+            slowest = max(timings, key=timings.get)
+            self.logger.info(
+                f'Restarted {len(timings)} of {len(self.bot.extensions)} extensions in '
+                f'{sum(timings.values()) * 1000:.1f}ms (slowest: {slowest}, {timings[slowest] * 1000:.1f}ms)'
+            )
+        self.reload_timings = timings
+        return timings
+
+    async def plan_files(self, tree, files, digest=None):
+        """Compares files (live path: path in tree) against a remote tree using cached blob IDs.
+
+        For bundles, tree is the bundle's file index and digest is self.hashes.hash.
+        Returns (added, changed, unchanged)."""
+        digest = digest or self.hashes.blob
+
+        def compare(item):
+            live, remote = item
+            path = os.getcwd() + '/' + live
+            if not os.path.isfile(path):
+                return 'added'
+            return 'changed' if digest(path) != tree[remote] else 'unchanged'
+
+        items = [(live, remote) for live, remote in files.items() if remote in tree]
+        results = await self.io.run(lambda: list(self.copier.pool.map(compare, items)))
+        grouped = {'added': [], 'changed': [], 'unchanged': []}
+        for (live, remote), result in zip(items, results):
+            grouped[result].append(live)
+        return grouped['added'], grouped['changed'], grouped['unchanged']
+
+    def plan_reloads(self, files):
+        """Returns the extensions that would be reloaded if files were replaced."""
+        changed = set([file[:-3].replace('/', '.') for file in files if file.endswith('.py')])
+        utils_order, toreload = ReloadPlanner(self.hashes).order(list(self.bot.extensions), changed)
+        return toreload
+
+    async def plan_system(self, force=False, bundle=None):
+        """Works out what a system upgrade would do, without installing or changing anything.
+
+        Reads from the same source as the upgrade: the bundle given, the one from eupgrader_bundles or git.
+        Bundles that are URLs are downloaded to do so."""
+        current = await self.io.read_json('plugins/system.json')
+        if bundle:
+            bundle = await self.io.run(fetch_bundle, bundle, self.cache_root + '/bundles/unifier.zip')
+            with await self.io.run(UpgradeBundle, bundle) as opened:
+                update = opened.manifest['update']
+                bundled = opened.version
+        else:
+            update = json.loads(await self.io.run(
+                self.metadata.read, self.bot.config['check_endpoint'], self.bot.config['branch'], 'update.json', force
+            ))
+        available = upgrade_candidates(update, current, force=force)
+        if bundle:
+            available = [candidate for candidate in available if candidate[0] == bundled]
+        if not available:
+            return None
+        version = available[0][0]
+        if not bundle:
+            bundle = self.bundle_url(f'unifier-{version}.zip')
+        if bundle:
+            path = await self.io.run(fetch_bundle, bundle, self.cache_root + f'/bundles/unifier-{version}.zip')
+            with await self.io.run(UpgradeBundle, path) as opened:
+                if opened.version != version:
+                    raise ValueError(f'Bundle contains {opened.version}, expected {version}')
+                tree = opened.files
+                digest = self.hashes.hash
+                requirements = (await self.io.run(opened.read, 'requirements.txt')).decode()
+                newcfg = await self.io.run(opened.read_json, 'config.json')
+        else:
+            url = self.bot.config['files_endpoint'] + '/unifier.git'
+            tree = await self.io.run(self.metadata.tree, url, version, force)
+            digest = None
+            requirements = (await self.io.run(self.metadata.read, url, version, 'requirements.txt')).decode()
+            newcfg = json.loads(await self.io.run(self.metadata.read, url, version, 'config.json'))
+        files = {
+            file: file for file in tree
+            if file in ['unifier.py', 'requirements.txt'] or (
+                file.count('/') == 1 and file.split('/')[0] in ['cogs', 'utils']
+            )
+        }
+        added, changed, unchanged = await self.plan_files(tree, files, digest=digest)
+        oldcfg = await self.io.read_json('config.json')
+        should_reboot = needs_reboot(available[0], current)
+        return {
+            'name': 'Unifier',
+            'current': f'{current["version"]} (`{current["release"]}`)',
+            'version': f'{version} (`{available[0][2]}`)',
+            'reboot': should_reboot,
+            'added': added,
+            'changed': changed,
+            'unchanged': unchanged,
+            'dependencies': await self.io.run(unsatisfied_requirements, requirements.split('\n')),
+            'config': [key for key in newcfg if not key in oldcfg.keys()],
+            'reload': [] if should_reboot else await self.io.run(self.plan_reloads, added + changed)
+        }
+
+    async def plan_plugin(self, plugin_info, force=False, bundle=None):
+        """Works out what a plugin upgrade would do, without installing or changing anything.
+
+        With a bundle, the plan is made from it rather than the plugin's repository."""
+        if bundle:
+            bundle = await self.io.run(fetch_bundle, bundle, self.cache_root + f'/bundles/{plugin_info["id"]}.zip')
+            with await self.io.run(UpgradeBundle, bundle) as opened:
+                return await self.__plan_plugin(plugin_info, force, opened)
+        return await self.__plan_plugin(plugin_info, force, None)
+
+    async def __plan_plugin(self, plugin_info, force, bundle):
+        new = await self.check_plugin(plugin_info, force=force, bundle=bundle)
+        if not new:
+            return None
+        if bundle:
+            tree = bundle.files
+        else:
+            tree = await self.io.run(self.metadata.tree, plugin_info['repository'], 'HEAD')
+        files = {'cogs/' + module: module for module in new['modules']}
+        files.update({'utils/' + util: util for util in new['utils']})
+        added, changed, unchanged = await self.plan_files(tree, files, digest=self.hashes.hash if bundle else None)
+        emojis = None
+        if 'emojis' in new.get('services', []) and 'emoji.json' in tree:
+            if bundle:
+                newpack = await self.io.run(bundle.read_json, 'emoji.json')
+            else:
+                newpack = json.loads(
+                    await self.io.run(self.metadata.read, plugin_info['repository'], 'HEAD', 'emoji.json')
+                )
+            oldpath = f'emojis/{new["id"]}.json'
+            oldpack = await self.io.read_json(oldpath) if await self.io.run(os.path.isfile, oldpath) else {'emojis': {}}
+            emojis = EmojiInstaller.changes(oldpack, newpack)
+        return {
+            'name': new.get('name', new['id']),
+            'current': f'{plugin_info.get("version", "unknown")} (`{plugin_info["release"]}`)',
+            'version': f'{new.get("version", "unknown")} (`{new["release"]}`)',
+            'reboot': False,
+            'added': added,
+            'changed': changed,
+            'unchanged': unchanged,
+            'dependencies': await self.io.run(unsatisfied_requirements, new.get('requirements', [])),
+            'config': [],
+            'emojis': emojis,
+            'reload': await self.io.run(self.plan_reloads, added + changed)
+        }
+
+    async def plan(self, ctx, plugin, force=False, bundle=None):
+        """Shows what an upgrade would change without changing anything."""
+        current = await self.io.read_json('plugins/system.json')
+        if current['release'] >= 75:
+            return await ctx.send('You\'re on a patched version. Emergency Upgrader is not needed.')
+        started = time.perf_counter()
+        embed = nextcord.Embed(title=f'{self.bot.ui_emojis.install} Planning upgrade...')
+        msg = await ctx.send(embed=embed)
+        try:
+            if plugin == 'system':
+                plans = {'system': await self.plan_system(force=force, bundle=bundle)}
+            else:
+                if plugin == 'all':
+                    plugins = await self.io.run(lambda: [
+                        plugin_id for plugin_id in self.plugins.plugins()
+                        if plugin_id != 'system' and 'repository' in self.plugins.get(plugin_id).keys()
+                    ])
+                else:
+                    plugins = [plugin]
+                infos = [await self.io.run(self.plugins.get, plugin_id) for plugin_id in plugins]
+                if not all(infos):
+                    embed.title = f'{self.bot.ui_emojis.error} Plugin not found'
+                    embed.description = 'The plugin could not be found.'
+                    embed.colour = self.bot.colors.error
+                    return await msg.edit(embed=embed)
+                # like upgrade_all, planning every plugin doesn't use bundles
+                results = await asyncio.gather(*[
+                    self.plan_plugin(info, force=force, bundle=bundle if plugin != 'all' else None) for info in infos
+                ], return_exceptions=True)
+                plans = dict(zip(plugins, results))
+        except:
+            self.logger.exception('Could not plan upgrade')
+            embed.title = f'{self.bot.ui_emojis.error} Could not plan upgrade'
+            embed.description = 'Remote metadata or the bundle could not be read. Please check console logs for more info.'
+            embed.colour = self.bot.colors.error
+            return await msg.edit(embed=embed)
+
+        def listing(items):
+            text = ', '.join([f'`{item}`' for item in items[:15]])
+            return text + (f' and {len(items) - 15} more' if len(items) > 15 else '') if items else 'None'
+
+        def emoji_summary(changes):
+            if changes is None:
+                return 'None'
+            if not any(changes):
+                return 'Unchanged'
+            added, updated, removed = changes
+            # updated emojis keep their guild emoji if the image turns out to be identical
+            return f'{len(added)} added, {len(updated)} may be updated, {len(removed)} removed'
+
+        embed.title = f'{self.bot.ui_emojis.install} Upgrade plan'
+        embed.description = 'Nothing has been installed or changed.'
+        embed.colour = 0xffcc00
+        for plugin_id, plan in list(plans.items())[:25]:
+            if isinstance(plan, BaseException):
+                value = f'Could not check for updates: {plan}'
+            elif not plan:
+                value = 'Up to date'
+            else:
+                value = '\n'.join([
+                    f'**Version**: {plan["current"]} -> {plan["version"]}',
+                    f'**Reboot required**: {"Yes" if plan["reboot"] else "No"}',
+                    f'**Files**: {len(plan["added"])} added, {len(plan["changed"])} changed, '
+                    f'{len(plan["unchanged"])} unchanged',
+                    f'**Changes**: {listing(plan["added"] + plan["changed"])}',
+                    f'**Dependencies**: {listing(plan["dependencies"])}',
+                    f'**New config keys**: {listing(plan["config"])}' if plugin_id == 'system' else
+                    f'**Emoji pack**: {emoji_summary(plan["emojis"])}',
+                    f'**Reloads**: {listing(plan["reload"]) if not plan["reboot"] else "Reboot required"}'
+                ])
+            embed.add_field(name=plan['name'] if type(plan) is dict else plugin_id, value=value[:1024], inline=False)
+        embed.set_footer(text=f'Planned in {(time.perf_counter() - started) * 1000:.0f}ms')
+        await msg.edit(embed=embed)
+
+    def add_metrics(self, embed):
+        if self.metrics.spans:
+            embed.add_field(name='Timings', value=self.metrics.summary(), inline=False)
+
+    def manual_restore(self, journal_id, snapshot):
+        steps = 'The rollback failed. Stop the bot and run these from the Unifier directory to restore it manually:'
+        if journal_id:
+            steps += f'\n  python utils/eupgrader_restore.py rollback {journal_id}'
+        if snapshot:
+            steps += f'\n  python utils/eupgrader_restore.py restore {snapshot}' + (
+                '  (only if the rollback above fails)' if journal_id else ''
+            )
+        if not journal_id and not snapshot:
+            steps += '\n  python utils/eupgrader_restore.py list'
+        return steps
+
     @commands.command(hidden=True,description='Upgrades Unifier or a plugin.')
     async def emergency_upgrade(self, ctx, plugin='system', *, args=''):
         if not ctx.author.id == self.bot.config['owner']:
             return
 
-        with open('plugins/system.json', 'r') as file:
-            current = json.load(file)
+        if 'plan' in args.split(' '):
+            bundles = [arg[7:] for arg in args.split(' ') if arg.startswith('bundle=')]
+            return await self.plan(
+                ctx, plugin.lower(), force='force' in args.split(' '), bundle=bundles[-1] if bundles else None
+            )
+
+        async with self.upgrade_lock:
+            # created under the lock, so a command waiting for it can't replace a running upgrade's metrics
+            self.metrics = UpgradeMetrics(
+                plugin.lower(), slow=self.bot.config.get('eupgrader_slow_stage', 30), logger=self.logger
+            )
+            monitor = LagMonitor()
+            monitor.start()
+            self.metrics.lag = monitor
+            try:
+                await self.upgrade(ctx, plugin, args)
+            finally:
+                monitor.stop()
+                if monitor.max_stall > self.bot.config.get('eupgrader_max_stall', 0.25):
+                    self.logger.warning(
+                        f'Event loop was blocked for up to {monitor.max_stall * 1000:.0f}ms during the upgrade '
+                        f'({monitor.stalls} stalls)'
+                    )
+                self.metrics.finish()
+                if self.metrics.spans:
+                    self.logger.info(f'Upgrade stages took {self.metrics.total:.2f}s in total')
+                    try:
+                        await self.io.run(lambda: self.metrics.export(self.cache_root))
+                    except:
+                        self.logger.exception('Could not export upgrade metrics')
+                if self.handover:
+                    await self.finish_handover()
+
+    async def upgrade(self, ctx, plugin, args):
+        if plugin.lower() == 'system':
+            checkpoint = await self.io.run(UpgradeCheckpoint.load, self.cache_root + '/checkpoint.json')
+            if checkpoint:
+                # checked before the version, as an interrupted install may have already replaced system.json
+                return await self.resume_upgrade(ctx, checkpoint)
+
+        current = await self.io.read_json('plugins/system.json')
 
         if current['release'] >= 75:
             return await ctx.send('You\'re on a patched version. Emergency Upgrader is not needed.')
@@ -131,48 +2804,55 @@ class EmergencyUpgrader(commands.Cog):
         force = False
         ignore_backup = False
         no_backup = False
+        direct = False
         if 'force' in args:
             force = True
         if 'ignore-backup' in args:
             ignore_backup = True
         if 'no-backup' in args:
             no_backup = True
+        if 'direct' in args:
+            direct = True
+        bundle = None
+        for arg in args:
+            if arg.startswith('bundle='):
+                bundle = arg[7:]
 
         plugin = plugin.lower()
 
+        if plugin == 'all':
+            return await self.upgrade_all(ctx, force=force)
+
         if plugin=='system':
             embed = nextcord.Embed(
                 title=f'{self.bot.ui_emojis.install} Checking for upgrades...',
                 description='Getting latest version from remote'
             )
             msg = await ctx.send(embed=embed)
-            available = []
             try:
-                os.system('rm -rf ' + os.getcwd() + '/update_check')
-                await self.bot.loop.run_in_executor(None, lambda: os.system(
-                    'git clone --branch ' + self.bot.config['branch'] + ' ' + self.bot.config[
-                        'check_endpoint'] + ' ' + os.getcwd() + '/update_check'))
-                with open('plugins/system.json', 'r') as file:
-                    current = json.load(file)
-                with open('update_check/update.json', 'r') as file:
-                    new = json.load(file)
-                if new['release'] > current['release'] or force:
-                    available.append([new['version'], 'Release version', new['release'], -1, new['reboot']])
-                index = 0
-                for legacy in new['legacy']:
-                    if (
-                            legacy['lower'] <= current['release'] <= legacy['upper'] and (
-                                legacy['release'] > (
-                                    current['legacy'] if 'legacy' in current.keys() else -1
-                                ) or force
-                            )
-                    ):
-                        available.append([legacy['version'], 'Legacy version', legacy['release'], index, legacy['reboot']])
-                    index += 1
+                with self.metrics.span('check') as span:
+                    if bundle:
+                        # a bundle carries its own update.json, so air-gapped hosts can upgrade from it
+                        bundle = await self.io.run(fetch_bundle, bundle, self.cache_root + '/bundles/unifier.zip')
+                        with await self.io.run(UpgradeBundle, bundle) as opened:
+                            update_raw = json.dumps(opened.manifest['update']).encode()
+                    else:
+                        update_raw = await self.io.run(lambda: self.metadata.read(
+                            self.bot.config['check_endpoint'], self.bot.config['branch'], 'update.json', fresh=force
+                        ))
+                    span.add(len(update_raw), 1)
+                current = await self.io.read_json('plugins/system.json')
+                available = upgrade_candidates(json.loads(update_raw), current, force=force)
+                if bundle:
+                    available = [candidate for candidate in available if candidate[0] == opened.version]
                 update_available = len(available) >= 1
             except:
+                self.logger.exception('Could not check for updates')
                 embed.title = f'{self.bot.ui_emojis.error} Failed to check for updates'
-                embed.description = 'Could not find a valid update.json file on remote'
+                if bundle:
+                    embed.description = 'The bundle is invalid or does not contain an update.json file'
+                else:
+                    embed.description = 'Could not find a valid update.json file on remote'
                 embed.colour = self.bot.colors.error
                 return await msg.edit(embed=embed)
             if not update_available:
@@ -186,16 +2866,11 @@ class EmergencyUpgrader(commands.Cog):
                 release = available[selected][2]
                 version = available[selected][0]
                 legacy = available[selected][3] > -1
-                reboot = available[selected][4]
                 embed.title = f'{self.bot.ui_emojis.install} Update available'
                 embed.description = f'An update is available for Unifier!\n\nCurrent version: {current["version"]} (`{current["release"]}`)\nNew version: {version} (`{release}`)'
                 embed.remove_footer()
                 embed.colour = 0xffcc00
-                if legacy:
-                    should_reboot = reboot >= (current['legacy'] if 'legacy' in current.keys() and
-                                               type(current['legacy']) is int else -1)
-                else:
-                    should_reboot = reboot >= current['release']
+                should_reboot = needs_reboot(available[selected], current)
                 if should_reboot:
                     embed.set_footer(text='The bot will need to reboot to apply the new update.')
                 selection = nextcord.ui.StringSelect(
@@ -249,6 +2924,28 @@ class EmergencyUpgrader(commands.Cog):
                 elif interaction.data['custom_id'] == 'selection':
                     selected = int(interaction.data['values'][0])
             self.logger.info('Upgrade confirmed, preparing...')
+
+            if not bundle:
+                bundle = self.bundle_url(f'unifier-{version}.zip')
+
+            local = bundle and await self.io.run(os.path.isfile, bundle)
+
+            async def prefetch_system():
+                if local:
+                    def read():
+                        with UpgradeBundle(bundle) as opened:
+                            return opened.read('requirements.txt')
+
+                    requirements = await self.io.run(read)
+                else:
+                    requirements = await self.io.run(lambda: self.metadata.read(
+                        self.bot.config['files_endpoint'] + '/unifier.git', version, 'requirements.txt'
+                    ))
+                return await self.prefetch_dependencies(requirements.decode().split('\n'))
+
+            # remote bundles are for hosts without git, so their requirements are only read once downloaded
+            prefetch = None if bundle and not local else self.background(prefetch_system())
+            snapshot = None
             if not no_backup:
                 embed.title = f'{self.bot.ui_emojis.install} Backing up...'
                 embed.description = 'Your data is being backed up.'
@@ -256,27 +2953,19 @@ class EmergencyUpgrader(commands.Cog):
             try:
                 if no_backup:
                     raise ValueError()
-                folder = os.getcwd() + '/old'
-                try:
-                    os.mkdir(folder)
-                except:
-                    pass
-                folder = os.getcwd() + '/old/cogs'
-                try:
-                    os.mkdir(folder)
-                except:
-                    pass
-                for file in os.listdir(os.getcwd() + '/cogs'):
-                    self.logger.debug('Backing up: ' + os.getcwd() + '/cogs/' + file)
-                    os.system('cp ' + os.getcwd() + '/cogs/' + file + ' ' + os.getcwd() + '/old/cogs/' + file)
-                self.logger.debug('Backing up: ' + os.getcwd() + '/unifier.py')
-                os.system('cp ' + os.getcwd() + '/unifier.py ' + os.getcwd() + '/old/unifier.py')
-                self.logger.debug('Backing up: ' + os.getcwd() + '/data.json')
-                os.system('cp ' + os.getcwd() + '/data.json ' + os.getcwd() + '/old/data.json')
-                self.logger.debug('Backing up: ' + os.getcwd() + '/config.json')
-                os.system('cp ' + os.getcwd() + '/config.json ' + os.getcwd() + '/old/config.json')
-                self.logger.debug('Backing up: ' + os.getcwd() + '/update.json')
-                os.system('cp ' + os.getcwd() + '/update.json ' + os.getcwd() + '/old/update.json')
+                tobackup = []
+                for directory in ['cogs', 'utils']:
+                    for file in await self.io.list_files(os.getcwd() + '/' + directory):
+                        tobackup.append(directory + '/' + file)
+                for file in ['unifier.py', 'data.json', 'config.json', 'update.json', 'requirements.txt',
+                             'plugins/system.json']:
+                    if await self.io.exists(os.getcwd() + '/' + file):
+                        tobackup.append(file)
+                self.logger.debug('Backing up: ' + ', '.join(tobackup))
+                with self.metrics.span('backup') as span:
+                    snapshot, written = await self.io.run(lambda: self.snapshots.snapshot(os.getcwd(), tobackup))
+                    span.add(written, len(tobackup))
+                self.logger.debug(f'Created snapshot {snapshot} ({written} new bytes)')
             except:
                 if no_backup:
                     self.logger.warning('Backup skipped, requesting final confirmation.')
@@ -293,7 +2982,7 @@ class EmergencyUpgrader(commands.Cog):
                     raise
             else:
                 self.logger.info('Backup complete, requesting final confirmation.')
-                embed.description = '- :inbox_tray: Your files have been backed up to `[Unifier root directory]/old.`\n- :wrench: Any modifications you made to Unifier will be wiped, unless they are a part of the new upgrade.\n- :warning: Once started, you cannot abort the upgrade.'
+                embed.description = f'- :inbox_tray: Your files have been backed up to `[Unifier root directory]/old` (snapshot `{snapshot}`).\n- :wrench: Any modifications you made to Unifier will be wiped, unless they are a part of the new upgrade.\n- :warning: Once started, you cannot abort the upgrade.'
             embed.title = f'{self.bot.ui_emojis.install} Start the upgrade?'
             components = ui.MessageComponents()
             components.add_row(btns)
@@ -319,147 +3008,18 @@ class EmergencyUpgrader(commands.Cog):
             embed.title = f'{self.bot.ui_emojis.install} Upgrading Unifier'
             embed.description = ':hourglass_flowing_sand: Downloading updates\n:x: Installing updates\n:x: Reloading modules'
             await interaction.response.edit_message(embed=embed, view=None)
-            self.logger.info('Starting upgrade')
-            try:
-                self.logger.debug('Purging old update files')
-                os.system('rm -rf ' + os.getcwd() + '/update')
-                self.logger.info('Downloading from remote repository...')
-                await self.bot.loop.run_in_executor(None, lambda: os.system(
-                    'git clone --branch ' + version + ' --single-branch --depth 1 ' + self.bot.config[
-                        'files_endpoint'] + '/unifier.git ' + os.getcwd() + '/update'
-                ))
-                self.logger.debug('Confirming download...')
-                x = open(os.getcwd() + '/update/plugins/system.json', 'r')
-                x.close()
-                self.logger.debug('Download confirmed, proceeding with upgrade')
-            except:
-                self.logger.exception('Download failed, no rollback required')
-                embed.title = f'{self.bot.ui_emojis.error} Upgrade failed'
-                embed.description = 'Could not download updates. No rollback is required.'
-                embed.colour = self.bot.colors.error
-                await msg.edit(embed=embed)
-                return
-            try:
-                self.logger.debug('Installing dependencies')
-                x = open('update/requirements.txt')
-                newdeps = x.read().split('\n')
-                x.close()
-                try:
-                    x = open('requirements.txt')
-                    olddeps = x.read().split('\n')
-                    x.close()
-                except:
-                    self.logger.warning('Could not find requirements.txt, installing all dependencies')
-                    olddeps = []
-                for dep in olddeps:
-                    try:
-                        newdeps.remove(dep)
-                    except:
-                        pass
-                if len(newdeps) > 0:
-                    self.logger.debug('Installing: ' + ' '.join(newdeps))
-                    await self.bot.loop.run_in_executor(None, lambda: status(os.system(
-                        'python3 -m pip install ' + '"' + '" "'.join(newdeps) + '"')
-                    ))
-            except:
-                self.logger.exception('Dependency installation failed, no rollback required')
-                embed.title = f'{self.bot.ui_emojis.error} Upgrade failed'
-                embed.description = 'Could not install dependencies. No rollback is required.'
-                embed.colour = self.bot.colors.error
-                await msg.edit(embed=embed)
-                return
-            try:
-                self.logger.info('Installing upgrades')
-                embed.description = ':white_check_mark: Downloading updates\n:hourglass_flowing_sand: Installing updates\n:x: Reloading modules'
-                await msg.edit(embed=embed)
-                self.logger.debug('Installing: ' + os.getcwd() + '/update/unifier.py')
-                status(os.system('cp ' + os.getcwd() + '/update/unifier.py ' + os.getcwd() + '/unifier.py'))
-                self.logger.debug('Installing: ' + os.getcwd() + '/update/requirements.txt')
-                status(os.system('cp ' + os.getcwd() + '/update/requirements.txt ' + os.getcwd() + '/requirements.txt'))
-                self.logger.debug('Installing: ' + os.getcwd() + '/update_check/update.json')
-                if legacy:
-                    current['version'] = version
-                    current['legacy'] = release
-                    with open('plugins/system.json', 'w+') as file:
-                        json.dump(current,file)
-                else:
-                    status(os.system('cp ' + os.getcwd() + '/update_check/update.json ' + os.getcwd() + '/plugins/system.json'))
-                    with open('plugins/system.json', 'r') as file:
-                        newcurrent = json.load(file)
-                    newcurrent.pop('legacy')
-                    with open('plugins/system.json', 'w+') as file:
-                        json.dump(newcurrent, file)
-                for file in os.listdir(os.getcwd() + '/update/cogs'):
-                    self.logger.debug('Installing: ' + os.getcwd() + '/update/cogs/' + file)
-                    status(
-                        os.system('cp ' + os.getcwd() + '/update/cogs/' + file + ' ' + os.getcwd() + '/cogs/' + file))
-                for file in os.listdir(os.getcwd() + '/update/utils'):
-                    self.logger.debug('Installing: ' + os.getcwd() + '/update/utils/' + file)
-                    status(
-                        os.system('cp ' + os.getcwd() + '/update/utils/' + file + ' ' + os.getcwd() + '/utils/' + file))
-                self.logger.debug('Updating config.json')
-                with open('config.json', 'r') as file:
-                    oldcfg = json.load(file)
-                with open('update/config.json', 'r') as file:
-                    newcfg = json.load(file)
-                for key in newcfg:
-                    if not key in list(oldcfg.keys()):
-                        oldcfg.update({key: newcfg[key]})
-                with open('config.json', 'w') as file:
-                    json.dump(oldcfg, file, indent=4)
-                if should_reboot:
-                    self.bot.update = True
-                    self.logger.info('Upgrade complete, reboot required')
-                    embed.title = f'{self.bot.ui_emojis.success} Restart to apply upgrade'
-                    embed.description = f'The upgrade was successful. Please reboot the bot.'
-                    embed.colour = self.bot.colors.success
-                    await msg.edit(embed=embed)
-                else:
-                    self.logger.info('Restarting extensions')
-                    embed.description = ':white_check_mark: Downloading updates\n:white_check_mark: Installing updates\n:hourglass_flowing_sand: Reloading modules'
-                    await msg.edit(embed=embed)
-                    for cog in list(self.bot.extensions):
-                        self.logger.debug('Restarting extension: ' + cog)
-                        await self.preunload(cog)
-                        self.bot.reload_extension(cog)
-                    self.logger.info('Upgrade complete')
-                    embed.title = f'{self.bot.ui_emojis.success} Upgrade successful'
-                    embed.description = 'The upgrade was successful! :partying_face:'
-                    embed.colour = self.bot.colors.success
-                    await msg.edit(embed=embed)
-            except:
-                self.logger.exception('Upgrade failed, attempting rollback')
-                embed.title = f'{self.bot.ui_emojis.error} Upgrade failed'
-                embed.colour = self.bot.colors.error
-                try:
-                    self.logger.debug('Reverting: ' + os.getcwd() + '/unifier.py')
-                    status(os.system('cp ' + os.getcwd() + '/old/unifier.py ' + os.getcwd() + '/unifier.py'))
-                    self.logger.debug('Reverting: ' + os.getcwd() + '/data.json')
-                    status(os.system('cp ' + os.getcwd() + '/old/data.json ' + os.getcwd() + '/data.json'))
-                    self.logger.debug('Reverting: ' + os.getcwd() + '/plugins/system.json')
-                    status(os.system('cp ' + os.getcwd() + '/old/plugins/system.json ' + os.getcwd() + '/plugins/system.json'))
-                    self.logger.debug('Reverting: ' + os.getcwd() + '/config.json')
-                    status(os.system('cp ' + os.getcwd() + '/old/config.json ' + os.getcwd() + '/config.json'))
-                    for file in os.listdir(os.getcwd() + '/old/cogs'):
-                        self.logger.debug('Reverting: ' + os.getcwd() + '/cogs/' + file)
-                        status(
-                            os.system('cp ' + os.getcwd() + '/old/cogs/' + file + ' ' + os.getcwd() + '/cogs/' + file))
-                    self.logger.info('Rollback success')
-                    embed.description = 'The upgrade failed, and all files have been rolled back.'
-                except:
-                    self.logger.exception('Rollback failed')
-                    self.logger.critical(
-                        'The rollback failed. Visit https://unichat-wiki.pixels.onl/setup-selfhosted/upgrading-unifier/manual-rollback for recovery steps.')
-                    embed.description = 'The upgrade failed, and the bot may now be in a crippled state.\nPlease check console logs for more info.'
-                await msg.edit(embed=embed)
-                return
+            checkpoint = UpgradeCheckpoint(self.cache_root + '/checkpoint.json', {
+                'version': version, 'release': release, 'legacy': legacy, 'update': update_raw.decode(),
+                'reboot': should_reboot, 'direct': direct, 'snapshot': snapshot, 'journal': None,
+                'bundle': bundle, 'started': time.time()
+            })
+            await self.io.run(checkpoint.save)
+            await self.install_system(msg, embed, checkpoint, current, prefetch=prefetch, force=force)
         else:
             embed = nextcord.Embed(title=f'{self.bot.ui_emojis.install} Downloading extension...', description='Getting extension files from remote')
 
-            try:
-                with open('plugins/'+plugin+'.json') as file:
-                    plugin_info = json.load(file)
-            except:
+            plugin_info = await self.io.run(self.plugins.get, plugin)
+            if not plugin_info:
                 embed.title = f'{self.bot.ui_emojis.error} Plugin not found'
                 embed.description = 'The plugin could not be found.'
                 if plugin=='force':
@@ -470,37 +3030,48 @@ class EmergencyUpgrader(commands.Cog):
             embed.set_footer(text='Only install plugins from trusted sources!')
             msg = await ctx.send(embed=embed)
             url = plugin_info['repository']
-            try:
-                os.system('rm -rf ' + os.getcwd() + '/plugin_install')
-                await self.bot.loop.run_in_executor(None, lambda: status(os.system(
-                    'git clone ' + url + ' ' + os.getcwd() + '/plugin_install')))
-                with open('plugin_install/plugin.json', 'r') as file:
-                    new = json.load(file)
-                if not bool(re.match("^[a-z0-9_-]*$", new['id'])):
-                    embed.title = f'{self.bot.ui_emojis.error} Invalid plugin.json file'
-                    embed.description = 'Plugin IDs must be alphanumeric and may only contain lowercase letters, numbers, dashes, and underscores.'
+            if bundle:
+                try:
+                    bundle = await self.io.run(fetch_bundle, bundle, self.cache_root + f'/bundles/{plugin}.zip')
+                    # opened once here to check it is a valid bundle before anything else happens
+                    await self.io.run(lambda: UpgradeBundle(bundle).close())
+                except:
+                    self.logger.exception('Could not open bundle')
+                    embed.title = f'{self.bot.ui_emojis.error} Invalid bundle'
+                    embed.description = 'The bundle could not be read. Bundles are built with `utils/eupgrader_bundle.py`.'
                     embed.colour = self.bot.colors.error
                     await msg.edit(embed=embed)
                     return
-                if new['release'] <= plugin_info['release'] and not force:
-                    embed.title = f'{self.bot.ui_emojis.success} Plugin up to date'
-                    embed.description = f'This plugin is already up to date!'
-                    embed.colour = self.bot.colors.success
-                    await msg.edit(embed=embed)
-                    return
-                plugin_id = new['id']
-                name = new['name']
-                desc = new['description']
-                version = new['version']
-                modules = new['modules']
-                utilities = new['utils']
-                services = new['services'] if 'services' in new.keys() else []
+            try:
+                with self.metrics.span('check'):
+                    if bundle:
+                        with await self.io.run(UpgradeBundle, bundle) as opened:
+                            new = await self.check_plugin(plugin_info, force=force, bundle=opened)
+                    else:
+                        new = await self.check_plugin(plugin_info, force=force)
+            except ValueError:
+                embed.title = f'{self.bot.ui_emojis.error} Invalid plugin.json file'
+                embed.description = 'Plugin IDs must be alphanumeric and may only contain lowercase letters, numbers, dashes, and underscores.'
+                embed.colour = self.bot.colors.error
+                await msg.edit(embed=embed)
+                return
             except:
                 embed.title = f'{self.bot.ui_emojis.error} Failed to update plugin'
                 embed.description = 'The repository URL or the plugin.json file is invalid.'
                 embed.colour = self.bot.colors.error
                 await msg.edit(embed=embed)
                 raise
+            if not new:
+                embed.title = f'{self.bot.ui_emojis.success} Plugin up to date'
+                embed.description = f'This plugin is already up to date!'
+                embed.colour = self.bot.colors.success
+                await msg.edit(embed=embed)
+                return
+            plugin_id = new['id']
+            name = new['name']
+            desc = new['description']
+            version = new['version']
+            prefetch = self.background(self.prefetch_dependencies(new.get('requirements', []), no_deps=True))
             embed.title = f'{self.bot.ui_emojis.install} Update `{plugin_id}`?'
             embed.description = f'Name: `{name}`\nVersion: `{version}`\n\n{desc}'
             embed.colour = 0xffcc00
@@ -531,112 +3102,590 @@ class EmergencyUpgrader(commands.Cog):
                 return await interaction.response.edit_message(view=components)
 
             await interaction.response.edit_message(embed=embed, view=None)
+            journal = await self.io.run(UpgradeJournal, self.snapshots, os.getcwd())
+            opened = None
             try:
-                try:
-                    if 'requirements' in list(new.keys()):
-                        self.logger.debug('Installing dependencies')
-                        newdeps = new['requirements']
-                        try:
-                            olddeps = plugin_info['requirements']
-                        except:
-                            olddeps = []
-                        for dep in olddeps:
-                            if dep in newdeps:
-                                newdeps.remove(dep)
-                        if len(newdeps) > 0:
-                            self.logger.debug('Installing: ' + ' '.join(newdeps))
-                            await self.bot.loop.run_in_executor(None, lambda: status(
-                                os.system('python3 -m pip install --no-dependencies ' + '"' + '" "'.join(newdeps) + '"')
-                            ))
-                except:
-                    self.logger.exception('Dependency installation failed')
-                    raise RuntimeError()
-                self.logger.info('Upgrading Plugin')
-                for module in modules:
-                    self.logger.debug('Installing: ' + os.getcwd() + '/plugin_install/' + module)
-                    status(os.system(
-                        'cp ' + os.getcwd() + '/plugin_install/' + module + ' ' + os.getcwd() + '/cogs/' + module))
-                for util in utilities:
-                    self.logger.debug('Installing: ' + os.getcwd() + '/plugin_install/' + util)
-                    status(os.system(
-                        'cp ' + os.getcwd() + '/plugin_install/' + util + ' ' + os.getcwd() + '/utils/' + util))
-                if 'emojis' in services:
-                    self.logger.info('Uninstalling previous Emoji Pack')
-                    home_guild = self.bot.get_guild(self.bot.config['home_guild'])
-                    with open(f'emojis/{plugin_id}.json', 'r') as file:
-                        oldemojipack = json.load(file)
-                    with open('plugin_install/emoji.json', 'r') as file:
-                        emojipack = json.load(file)
-                    toreplace = []
-                    for emojiname in oldemojipack['emojis']:
-                        oldversion = oldemojipack['emojis'][emojiname][1]
-                        ignore_replace = False
-                        try:
-                            newversion = emojipack['emojis'][emojiname][1]
-                        except:
-                            ignore_replace = True
-                            newversion = oldversion + 1
-                        if oldversion < newversion:
-                            emoji = oldemojipack['emojis'][emojiname][0]
-                            if (emoji.startswith('<:') or emoji.startswith('<a:')) and emoji.endswith('>'):
-                                emoji_id = int(emoji.split(':')[2].replace('>',''))
-                                self.logger.debug(f'Removing: {emoji_id}')
-                                for emoji_obj in home_guild.emojis:
-                                    if emoji_obj.id==emoji_id:
-                                        await emoji_obj.delete()
-                            if not ignore_replace:
-                                toreplace.append(emojiname)
-
-                    self.logger.info('Installing new Emoji Pack')
-                    home_guild = self.bot.get_guild(self.bot.config['home_guild'])
-                    for emojiname in emojipack['emojis']:
-                        if emojiname in toreplace or not emojiname in oldemojipack['emojis'].keys():
-                            self.logger.debug(
-                                'Installing: ' + os.getcwd() + '/plugin_install/emojis/' + emojipack['emojis'][emojiname][0])
-                            file = 'plugin_install/emojis/' + emojipack['emojis'][emojiname][0]
-                            emoji = await home_guild.create_custom_emoji(name=emojiname, image=nextcord.File(fp=file))
-                            emojipack['emojis'][
-                                emojiname][0] = f'<a:{emoji.name}:{emoji.id}>' if emoji.animated else f'<:{emoji.name}:{emoji.id}>'
-                        else:
-                            emojipack['emojis'][emojiname][0] = oldemojipack['emojis'][emojiname][0]
-                    emojipack['installed'] = True
-                    with open(f'emojis/{plugin_id}.json', 'w+') as file:
-                        json.dump(emojipack, file, indent=2)
-                    with open(f'emojis/current.json', 'r') as file:
-                        currentdata = json.load(file)
-                    if currentdata['id']==plugin_id:
-                        emojipack.update({'id': plugin_id})
-                        with open(f'emojis/current.json', 'w+') as file:
-                            json.dump(emojipack, file, indent=2)
-                        self.bot.ui_emojis = Emojis(data=emojipack)
-                self.logger.info('Registering plugin')
-                status(
-                    os.system(
-                        'cp ' + os.getcwd() + '/plugin_install/plugin.json' + ' ' + os.getcwd() + '/plugins/' + plugin_id + '.json'))
-                with open('plugins/' + plugin_id + '.json') as file:
-                    plugin_info = json.load(file)
-                    plugin_info.update({'repository': url})
-                with open('plugins/' + plugin_id + '.json', 'w') as file:
-                    json.dump(plugin_info, file)
+                if bundle:
+                    opened = await self.io.run(UpgradeBundle, bundle)
+                    await self.verify_bundle(opened)
+                else:
+                    self.logger.info('Downloading from remote repository...')
+                    await self.download_plugin(url, os.getcwd() + '/plugin_install', commit=new.get('commit'))
+                planner = ReloadPlanner(self.hashes)
+                await self.io.run(lambda: planner.record(list(self.bot.extensions)))
+                await self.install_plugin(
+                    plugin_id, os.getcwd() + '/plugin_install', url, journal, prefetch=prefetch, bundle=opened,
+                    confirmed=new
+                )
                 self.logger.info('Reloading extensions')
-                for module in modules:
-                    modname = 'cogs.' + module[:-3]
-                    if modname in list(self.bot.extensions):
-                        self.logger.debug('Reloading extension: ' + modname)
-                        await self.preunload(modname)
-                        self.bot.reload_extension(modname)
+                await self.reload_extensions(planner)
+                await self.io.run(journal.close)
                 self.logger.debug('Upgrade complete')
                 embed.title = f'{self.bot.ui_emojis.success} Upgrade successful'
                 embed.description = 'The upgrade was successful! :partying_face:'
                 embed.colour = self.bot.colors.success
+                self.add_metrics(embed)
                 await msg.edit(embed=embed)
             except:
-                self.logger.exception('Upgrade failed')
+                self.logger.exception('Upgrade failed, attempting rollback')
                 embed.title = f'{self.bot.ui_emojis.error} Upgrade failed'
-                embed.description = 'The upgrade failed.'
                 embed.colour = self.bot.colors.error
+                self.metrics.finish()
+                try:
+                    self.logger.debug(f'Reverting {len(journal.entries)} journaled writes')
+                    with self.metrics.span('rollback') as span:
+                        span.add(files=len(journal.entries))
+                        await self.io.run(journal.rollback)
+                    self.logger.info('Rollback success')
+                    embed.description = 'The upgrade failed, and all files have been rolled back.'
+                except:
+                    self.logger.exception('Rollback failed')
+                    embed.description = 'The upgrade failed, and some files could not be rolled back.\nPlease check console logs for more info.'
+                embed.description += self.kept_note([journal])
+                self.add_metrics(embed)
                 await msg.edit(embed=embed)
                 return
+            finally:
+                if opened:
+                    await self.io.run(opened.close)
+
+    async def resume_upgrade(self, ctx, checkpoint):
+        """Offers to resume or roll back a system upgrade that was interrupted."""
+        stages = ', '.join([f'`{stage}`' for stage in checkpoint.stages]) or 'none'
+        embed = nextcord.Embed(
+            title=f'{self.bot.ui_emojis.install} Interrupted upgrade found',
+            description=(
+                f'An upgrade to {checkpoint.data["version"]} (`{checkpoint.data["release"]}`) was interrupted '
+                f'<t:{int(checkpoint.data["started"])}:R>.\nCompleted stages: {stages}\n\nResume the upgrade from '
+                'where it stopped, or roll back the files it changed.'
+            ),
+            color=0xffcc00
+        )
+        btns = ui.ActionRow(
+            nextcord.ui.Button(style=nextcord.ButtonStyle.green, label='Resume', custom_id=f'accept', disabled=False),
+            nextcord.ui.Button(style=nextcord.ButtonStyle.red, label='Roll back', custom_id=f'rollback', disabled=False),
+            nextcord.ui.Button(style=nextcord.ButtonStyle.gray, label='Nevermind', custom_id=f'reject', disabled=False)
+        )
+        components = ui.MessageComponents()
+        components.add_row(btns)
+        msg = await ctx.send(embed=embed, view=components)
+
+        def check(interaction):
+            return interaction.user.id == ctx.author.id and interaction.message.id == msg.id
+
+        try:
+            interaction = await self.bot.wait_for("interaction", check=check, timeout=60.0)
+        except:
+            return await msg.edit(view=None)
+        if interaction.data['custom_id'] == 'reject':
+            return await interaction.response.edit_message(view=None)
+        elif interaction.data['custom_id'] == 'rollback':
+            embed.title = f'{self.bot.ui_emojis.install} Rolling back...'
+            embed.description = 'Restoring the files changed by the interrupted upgrade.'
+            await interaction.response.edit_message(embed=embed, view=None)
+            return await self.rollback_upgrade(msg, embed, checkpoint)
+        self.logger.info('Resuming interrupted upgrade after stages: ' + (', '.join(checkpoint.stages) or 'none'))
+        embed.title = f'{self.bot.ui_emojis.install} Upgrading Unifier'
+        embed.description = ':hourglass_flowing_sand: Downloading updates\n:x: Installing updates\n:x: Reloading modules'
+        await interaction.response.edit_message(embed=embed, view=None)
+        current = await self.io.read_json('plugins/system.json')
+        await self.install_system(msg, embed, checkpoint, current)
+
+    async def rollback_upgrade(self, msg, embed, checkpoint):
+        """Rolls back the files written by an interrupted upgrade, using its journal and backup snapshot."""
+        self.logger.info('Rolling back interrupted upgrade')
+        planner = ReloadPlanner(self.hashes)
+        await self.io.run(lambda: planner.record(list(self.bot.extensions)))
+        try:
+            with self.metrics.span('rollback') as span:
+                # undo a cutover that was cut short, then put back every journaled file
+                await self.io.run(StagedInstall(os.getcwd(), ['cogs', 'utils']).recover)
+                if checkpoint.data['journal']:
+                    journal = await self.io.run(UpgradeJournal, self.snapshots, os.getcwd(), checkpoint.data['journal'])
+                    self.logger.debug(f'Reverting {len(journal.entries)} journaled writes')
+                    span.add(files=len(journal.entries))
+                    try:
+                        await self.io.run(journal.rollback)
+                    except:
+                        if not checkpoint.data['snapshot']:
+                            raise
+                        self.logger.exception('Journal replay failed, restoring snapshot ' + checkpoint.data['snapshot'])
+                        pairs = await self.io.run(
+                            self.snapshots.restore_pairs, checkpoint.data['snapshot'], os.getcwd()
+                        )
+                        await self.copy_files(pairs, action='Reverting', span=span)
+        except:
+            self.logger.exception('Rollback failed')
+            self.logger.critical(self.manual_restore(checkpoint.data['journal'], checkpoint.data['snapshot']))
+            embed.title = f'{self.bot.ui_emojis.error} Rollback failed'
+            embed.description = 'The interrupted upgrade could not be rolled back.\nPlease check console logs for more info.'
+            embed.colour = self.bot.colors.error
+            return await msg.edit(embed=embed)
+        await self.io.run(checkpoint.clear)
+        self.logger.info('Rollback success')
+        embed.title = f'{self.bot.ui_emojis.success} Rollback successful'
+        embed.description = 'All files changed by the interrupted upgrade have been restored.'
+        embed.colour = self.bot.colors.success
+        try:
+            await self.reload_extensions(planner)
+        except:
+            self.logger.exception('Could not reload extensions after rollback')
+            embed.description += '\nSome extensions could not be reloaded, please reboot the bot.'
+        self.add_metrics(embed)
+        await msg.edit(embed=embed)
+
+    async def install_system(self, msg, embed, checkpoint, current, prefetch=None, force=False):
+        """Downloads and installs a confirmed system upgrade, skipping stages the checkpoint has completed."""
+        version = checkpoint.data['version']
+        release = checkpoint.data['release']
+        legacy = checkpoint.data['legacy']
+        update_raw = checkpoint.data['update']
+        should_reboot = checkpoint.data['reboot']
+        direct = checkpoint.data['direct']
+        snapshot = checkpoint.data['snapshot']
+        self.logger.info('Starting upgrade')
+        try:
+            if checkpoint.done('download') and await self.verify_resumed_download(checkpoint):
+                self.logger.info('Reusing verified download from interrupted upgrade')
+            else:
+                await self.download_system(checkpoint, version, force=force)
+            bundle = None
+            if checkpoint.data.get('bundle'):
+                bundle = await self.io.run(UpgradeBundle, checkpoint.data['bundle_path'])
+        except:
+            self.logger.exception('Download failed, no rollback required')
+            embed.title = f'{self.bot.ui_emojis.error} Upgrade failed'
+            embed.description = 'Could not download updates. No rollback is required.'
+            embed.colour = self.bot.colors.error
+            await self.io.run(checkpoint.clear)
+            await msg.edit(embed=embed)
+            return
+        # a direct install is complete once compiled, a staged one once switched over
+        finished = checkpoint.done('compile' if direct else 'cutover')
+        staged = None if direct else StagedInstall(os.getcwd(), ['cogs', 'utils'])
+        if staged:
+            # undoes a cutover that was interrupted part-way before anything is compared against the live tree,
+            # or removes the previous tree if the switch finished, after which only the journal can undo it
+            await self.io.run(staged.recover)
+            if finished:
+                staged = None
+        journal = await self.io.run(UpgradeJournal, self.snapshots, os.getcwd(), checkpoint.data['journal'])
+        if not checkpoint.data['journal']:
+            await self.io.run(lambda: checkpoint.update(journal=journal.id))
+        graph = StageGraph()
+        try:
+            self.logger.info('Installing upgrades')
+            embed.description = ':white_check_mark: Downloading updates\n:hourglass_flowing_sand: Installing updates\n:x: Reloading modules'
+            await msg.edit(embed=embed)
+            planner = ReloadPlanner(self.hashes)
+
+            async def install_dependencies():
+                self.logger.debug('Installing dependencies')
+                if bundle:
+                    newdeps = (await self.io.run(bundle.read, 'requirements.txt')).decode().split('\n')
+                else:
+                    newdeps = (await self.io.read('update/requirements.txt')).decode().split('\n')
+                with self.metrics.span('deps') as span:
+                    span.add(files=len(await self.install_dependencies(newdeps, prefetch=prefetch)))
+                await self.io.run(checkpoint.complete, 'deps')
+
+            async def compare():
+                with self.metrics.span('compare') as span:
+                    await self.io.run(lambda: planner.record(list(self.bot.extensions)))
+                    files = ['unifier.py', 'requirements.txt']
+                    for directory in ['cogs', 'utils']:
+                        if bundle:
+                            listed = bundle.list_files(directory)
+                        else:
+                            listed = await self.io.list_files(os.getcwd() + '/update/' + directory)
+                        files.extend([directory + '/' + file for file in listed])
+                    if bundle:
+                        # bundled hashes are compared directly, nothing is extracted until install
+                        added, changed = await self.io.run(lambda: bundle.diff(
+                            [(file, os.getcwd() + '/' + file) for file in files], self.hashes, pool=self.copier.pool
+                        ))
+                    else:
+                        added, changed = await self.io.run(lambda: diff_files(
+                            os.getcwd() + '/update', os.getcwd(), files, self.hashes, pool=self.copier.pool
+                        ))
+                    span.add(files=len(files))
+                owned = await self.io.run(self.plugins.files)
+                deleted = []
+                for directory in ['cogs', 'utils']:
+                    for file in await self.io.list_files(os.getcwd() + '/' + directory):
+                        if not directory + '/' + file in files and not directory + '/' + file in owned:
+                            deleted.append(directory + '/' + file)
+                self.logger.info(
+                    f'{len(added)} files added, {len(changed)} changed, '
+                    f'{len(files) - len(added) - len(changed)} unchanged'
+                )
+                if deleted:
+                    self.logger.info('Files no longer in Unifier (left in place): ' + ', '.join(deleted))
+                return added + changed
+
+            async def merge_config():
+                with self.metrics.span('config') as span:
+                    newcurrent = copy.deepcopy(current)
+                    if legacy:
+                        newcurrent['version'] = version
+                        newcurrent['legacy'] = release
+                    else:
+                        newcurrent = json.loads(update_raw)
+                        newcurrent.pop('legacy', None)
+                    oldcfg = await self.io.read_json('config.json')
+                    if bundle:
+                        newcfg = await self.io.run(bundle.read_json, 'config.json')
+                    else:
+                        newcfg = await self.io.read_json('update/config.json')
+                    for key in newcfg:
+                        if not key in list(oldcfg.keys()):
+                            oldcfg.update({key: newcfg[key]})
+                    newsystem = json.dumps(newcurrent).encode()
+                    newconfig = json.dumps(oldcfg, indent=4).encode()
+                    span.add(len(newsystem) + len(newconfig), 2)
+                return newsystem, newconfig
+
+            async def install():
+                tocopy = graph.results['compare']
+                newsystem, newconfig = graph.results['config']
+                with self.metrics.span('install') as span:
+                    self.logger.debug('Journaling files to be written')
+                    if bundle:
+                        digests = [bundle.files[file] for file in tocopy]
+                    else:
+                        digests = await self.io.run(lambda: list(self.copier.pool.map(
+                            lambda file: self.hashes.hash(os.getcwd() + '/update/' + file), tocopy
+                        )))
+                    await self.io.run(lambda: journal.record_many(
+                        list(zip(tocopy, digests)) + [
+                            ('plugins/system.json', hashlib.sha256(newsystem).hexdigest()),
+                            ('config.json', hashlib.sha256(newconfig).hexdigest())
+                        ], pool=self.copier.pool
+                    ))
+                    if staged and bundle:
+                        self.logger.debug('Staging new tree from bundle')
+                        await self.io.run(staged.prepare)
+                        span.add(sum(await self.io.run(lambda: list(self.copier.pool.map(
+                            lambda file: staged.stage_extract(file, bundle), tocopy
+                        )))), len(tocopy))
+                        await self.io.run(staged.stage_data, 'plugins/system.json', newsystem)
+                        await self.io.run(staged.stage_data, 'config.json', newconfig)
+                    elif staged:
+                        self.logger.debug('Staging new tree')
+                        await self.io.run(staged.prepare)
+                        await self.io.run(lambda: list(self.copier.pool.map(
+                            lambda file: staged.stage_file(file, os.getcwd() + '/update/' + file), tocopy
+                        )))
+                        span.add(
+                            await self.io.run(lambda: sum([
+                                os.path.getsize(os.getcwd() + '/update/' + file) for file in tocopy
+                            ])),
+                            len(tocopy)
+                        )
+                        await self.io.run(staged.stage_data, 'plugins/system.json', newsystem)
+                        await self.io.run(staged.stage_data, 'config.json', newconfig)
+                    elif bundle:
+                        span.add(sum(await self.io.run(lambda: list(self.copier.pool.map(
+                            lambda file: bundle.extract(file, os.getcwd() + '/' + file), tocopy
+                        )))), len(tocopy))
+                        await self.io.write('plugins/system.json', newsystem)
+                        await self.io.write('config.json', newconfig)
+                    else:
+                        await self.copy_files(
+                            [(os.getcwd() + '/update/' + file, os.getcwd() + '/' + file) for file in tocopy],
+                            action='Installing', span=span
+                        )
+                        await self.io.write('plugins/system.json', newsystem)
+                        await self.io.write('config.json', newconfig)
+                await self.io.run(lambda: checkpoint.complete('install', files=tocopy))
+
+            async def compile_modules():
+                if staged:
+                    self.logger.debug('Validating and compiling staged files')
+                    with self.metrics.span('compile') as span:
+                        span.add(files=await self.io.run(staged.validate, self.compiler))
+                else:
+                    await self.compile_installed(checkpoint.data['files'])
+                await self.io.run(checkpoint.complete, 'compile')
+
+            async def cutover():
+                with self.metrics.span('cutover'):
+                    started = time.perf_counter()
+                    await self.io.run(staged.cutover)
+                await self.io.run(checkpoint.complete, 'cutover')
+                self.logger.info(f'Switched to new tree in {(time.perf_counter() - started) * 1000:.1f}ms')
+
+            # dependencies install while the new tree is compared, staged and compiled. Writing
+            # straight to the live tree waits for them, so a failed pip run leaves it untouched.
+            deps = [] if checkpoint.done('deps') else ['deps']
+            if deps:
+                graph.add('deps', install_dependencies)
+            if finished or (direct and checkpoint.done('install')):
+                # resuming past the install, modules loaded at startup already match the new files
+                await self.io.run(lambda: planner.record(list(self.bot.extensions)))
+                if not finished:
+                    graph.add('compile', compile_modules)
+            else:
+                graph.add('compare', compare)
+                graph.add('config', merge_config)
+                graph.add('install', install, after=['compare', 'config'] + ([] if staged else deps))
+                graph.add('compile', compile_modules, after=['install'])
+                if staged:
+                    graph.add('cutover', cutover, after=['compile'] + deps)
+            await graph.run()
+            if bundle:
+                await self.io.run(bundle.close)
+            await self.io.run(self.hashes.save)
+            if should_reboot:
+                self.bot.update = True
+                self.logger.info('Upgrade complete, reboot required')
+                embed.title = f'{self.bot.ui_emojis.success} Restart to apply upgrade'
+                embed.description = f'The upgrade was successful. Please reboot the bot.'
+                embed.colour = self.bot.colors.success
+                self.add_metrics(embed)
+                await msg.edit(embed=embed)
+            else:
+                self.logger.info('Restarting extensions')
+                embed.description = ':white_check_mark: Downloading updates\n:white_check_mark: Installing updates\n:hourglass_flowing_sand: Reloading modules'
+                await msg.edit(embed=embed)
+                await self.reload_extensions(planner)
+                self.logger.info('Upgrade complete')
+                embed.title = f'{self.bot.ui_emojis.success} Upgrade successful'
+                embed.description = 'The upgrade was successful! :partying_face:'
+                embed.colour = self.bot.colors.success
+                self.add_metrics(embed)
+                await msg.edit(embed=embed)
+            if staged:
+                await self.io.run(staged.commit)
+            await self.io.run(checkpoint.clear)
+            await self.io.run(journal.close)
+            if should_reboot and self.bot.config.get('eupgrader_handover_entry'):
+                await self.start_handover(msg, embed)
+        except:
+            self.logger.exception('Upgrade failed, attempting rollback')
+            if bundle:
+                await self.io.run(bundle.close)
+            embed.title = f'{self.bot.ui_emojis.error} Upgrade failed'
+            embed.colour = self.bot.colors.error
+            self.metrics.finish()
+            span = self.metrics.start('rollback')
+            try:
+                rolled_back = False
+                if staged:
+                    try:
+                        await self.io.run(staged.rollback)
+                    except:
+                        self.logger.exception('Could not switch back to previous tree, replaying journal')
+                    else:
+                        rolled_back = True
+                        await self.io.run(journal.close)
+                if not rolled_back:
+                    try:
+                        self.logger.debug(f'Reverting {len(journal.entries)} journaled writes')
+                        await self.io.run(journal.rollback)
+                    except:
+                        if not snapshot:
+                            raise
+                        self.logger.exception('Journal replay failed, restoring snapshot ' + snapshot)
+                        pairs = await self.io.run(self.snapshots.restore_pairs, snapshot, os.getcwd())
+                        await self.copy_files(pairs, action='Reverting', span=span)
+                self.logger.info('Rollback success')
+                embed.description = 'The upgrade failed, and all files have been rolled back.'
+                if graph.failed:
+                    embed.description += f'\nFailed stage: `{graph.failed}`'
+                await self.io.run(checkpoint.clear)
+                self.metrics.stop(span)
+            except:
+                self.metrics.stop(span, failed=True)
+                self.logger.exception('Rollback failed')
+                self.logger.critical(self.manual_restore(journal.id, snapshot))
+                embed.description = (
+                    'The upgrade failed, and the bot may now be in a crippled state.\nPlease check console logs for '
+                    f'more info, or run `{self.bot.command_prefix}emergency_upgrade` to retry the rollback.'
+                )
+            self.add_metrics(embed)
+            await msg.edit(embed=embed)
+
+    async def upgrade_all(self, ctx, force=False):
+        """Checks every installed plugin and upgrades all outdated ones after a single confirmation."""
+        embed = nextcord.Embed(
+            title=f'{self.bot.ui_emojis.install} Checking for upgrades...',
+            description='Checking all plugins for updates'
+        )
+        embed.set_footer(text='Only install plugins from trusted sources!')
+        msg = await ctx.send(embed=embed)
+
+        semaphore = asyncio.Semaphore(self.bot.config.get('eupgrader_git_concurrency', 4))
+        def installed():
+            plugins = {}
+            for plugin_id in self.plugins.plugins():
+                info = self.plugins.get(plugin_id)
+                if plugin_id != 'system' and info and 'repository' in info.keys():
+                    plugins.update({plugin_id: info})
+            return plugins
+
+        plugins = await self.io.run(installed)
+
+        async def check_one(plugin_id):
+            async with semaphore:
+                return await self.check_plugin(plugins[plugin_id], force=force)
+
+        with self.metrics.span('check') as span:
+            results = await asyncio.gather(*[check_one(plugin_id) for plugin_id in plugins], return_exceptions=True)
+            span.add(files=len(plugins))
+        available = {}
+        failed = []
+        for plugin_id, result in zip(plugins, results):
+            if isinstance(result, BaseException):
+                self.logger.warning(f'Could not check {plugin_id} for updates: {result}')
+                failed.append(plugin_id)
+            elif result:
+                if result['id'] != plugin_id:
+                    self.logger.warning(f'Skipping {plugin_id}: remote plugin.json has a different ID')
+                    failed.append(plugin_id)
+                    continue
+                available.update({plugin_id: result})
+
+        failed_text = (
+            '\n\nCould not check: ' + ', '.join([f'`{plugin_id}`' for plugin_id in failed])
+        ) if failed else ''
+        if not available:
+            embed.title = f'{self.bot.ui_emojis.success} No updates available'
+            embed.description = f'All {len(plugins)} plugins are up to date.' + failed_text
+            embed.colour = self.bot.colors.success
+            return await msg.edit(embed=embed)
+
+        requirements = []
+        for new in available.values():
+            requirements.extend([dep for dep in new.get('requirements', []) if not dep in requirements])
+        prefetch = self.background(self.prefetch_dependencies(requirements, no_deps=True))
+
+        embed.title = f'{self.bot.ui_emojis.install} Update {len(available)} plugins?'
+        embed.description = '\n'.join([
+            f'`{plugin_id}`: {plugins[plugin_id]["version"]} -> {new["version"]}' for plugin_id, new in available.items()
+        ]) + failed_text
+        embed.colour = 0xffcc00
+        btns = ui.ActionRow(
+            nextcord.ui.Button(style=nextcord.ButtonStyle.green, label='Update all', custom_id=f'accept', disabled=False),
+            nextcord.ui.Button(style=nextcord.ButtonStyle.gray, label='Nevermind', custom_id=f'reject', disabled=False)
+        )
+        components = ui.MessageComponents()
+        components.add_row(btns)
+        await msg.edit(embed=embed, view=components)
+
+        def check(interaction):
+            return interaction.user.id == ctx.author.id and interaction.message.id == msg.id
+
+        try:
+            interaction = await self.bot.wait_for("interaction", check=check, timeout=60.0)
+        except:
+            btns.items[0].disabled = True
+            btns.items[1].disabled = True
+            components = ui.MessageComponents()
+            components.add_row(btns)
+            return await msg.edit(view=components)
+        if interaction.data['custom_id'] == 'reject':
+            btns.items[0].disabled = True
+            btns.items[1].disabled = True
+            components = ui.MessageComponents()
+            components.add_row(btns)
+            return await interaction.response.edit_message(view=components)
+
+        embed.title = f'{self.bot.ui_emojis.install} Upgrading plugins'
+        await interaction.response.edit_message(embed=embed, view=None)
+
+        try:
+            self.logger.debug('Installing dependencies')
+            with self.metrics.span('deps') as span:
+                span.add(files=len(await self.install_dependencies(requirements, no_deps=True, prefetch=prefetch)))
+        except:
+            self.logger.exception('Dependency installation failed, no rollback required')
+            embed.title = f'{self.bot.ui_emojis.error} Upgrade failed'
+            embed.description = 'Could not install dependencies. No rollback is required.'
+            embed.colour = self.bot.colors.error
+            return await msg.edit(embed=embed)
+
+        # downloads run ahead of installs, which happen one plugin at a time. The mirror cache's size
+        # limit is only enforced once they're all done, so no download's mirror is evicted before it's installed
+        async def download_one(plugin_id):
+            async with semaphore:
+                await self.download_plugin(
+                    plugins[plugin_id]['repository'], self.cache_root + '/plugin_install/' + plugin_id, limit=False,
+                    commit=available[plugin_id]['commit']
+                )
+
+        downloads = {
+            plugin_id: self.background(download_one(plugin_id)) for plugin_id in available
+        }
+        planner = ReloadPlanner(self.hashes)
+        await self.io.run(lambda: planner.record(list(self.bot.extensions)))
+        journals = {}
+        upgraded = []
+        failed_journals = []
+        for plugin_id in available:
+            journal = await self.io.run(UpgradeJournal, self.snapshots, os.getcwd())
+            try:
+                await downloads[plugin_id]
+                self.logger.info('Upgrading ' + plugin_id)
+                await self.install_plugin(
+                    plugin_id, self.cache_root + '/plugin_install/' + plugin_id, plugins[plugin_id]['repository'],
+                    journal, dependencies=False, confirmed=available[plugin_id]
+                )
+            except:
+                self.logger.exception(f'Upgrade of {plugin_id} failed, attempting rollback')
+                failed.append(plugin_id)
+                failed_journals.append(journal)
+                try:
+                    await self.io.run(journal.rollback)
+                except:
+                    self.logger.exception(f'Rollback of {plugin_id} failed')
+                continue
+            finally:
+                try:
+                    await self.io.run(
+                        self.mirrors.remove, plugins[plugin_id]['repository'],
+                        self.cache_root + '/plugin_install/' + plugin_id
+                    )
+                except:
+                    self.logger.exception(f'Could not remove the download of {plugin_id}')
+            journals.update({plugin_id: journal})
+            upgraded.append(plugin_id)
+        try:
+            await self.io.run(self.mirrors.enforce_limit)
+        except:
+            self.logger.exception('Could not enforce the mirror cache size limit')
+
+        try:
+            self.logger.info('Reloading extensions')
+            await self.reload_extensions(planner)
+        except:
+            self.logger.exception('Reload failed, attempting rollback')
+            embed.title = f'{self.bot.ui_emojis.error} Upgrade failed'
+            embed.colour = self.bot.colors.error
+            try:
+                with self.metrics.span('rollback'):
+                    for journal in reversed(list(journals.values())):
+                        await self.io.run(journal.rollback)
+                self.logger.info('Rollback success')
+                embed.description = 'The upgrade failed, and all files have been rolled back.'
+            except:
+                self.logger.exception('Rollback failed')
+                embed.description = 'The upgrade failed, and some files could not be rolled back.\nPlease check console logs for more info.'
+            embed.description += self.kept_note(failed_journals + list(journals.values()))
+            self.add_metrics(embed)
+            return await msg.edit(embed=embed)
+        for journal in journals.values():
+            await self.io.run(journal.close)
+
+        self.logger.info(f'Upgraded {len(upgraded)} plugins')
+        embed.title = f'{self.bot.ui_emojis.success} Upgrade successful' if not failed else f'{self.bot.ui_emojis.warning} Upgrade partially successful'
+        embed.description = 'Upgraded: ' + (', '.join([f'`{plugin_id}`' for plugin_id in upgraded]) or 'none')
+        if failed:
+            embed.description += '\nFailed: ' + ', '.join([f'`{plugin_id}`' for plugin_id in failed])
+            embed.description += self.kept_note(failed_journals)
+        embed.colour = self.bot.colors.success if not failed else 0xffcc00
+        self.add_metrics(embed)
+        await msg.edit(embed=embed)
 
 def setup(bot):
     bot.add_cog(EmergencyUpgrader(bot))
@@ -0,0 +1,88 @@
+"""Builds single-file upgrade bundles for Emergency Upgrader.
+
+A bundle is a zip file holding the files of one release, plus bundle.json,
+which records the bundle format, the release it contains and the SHA-256 of
+every file. Emergency Upgrader reads files one at a time through the zip's
+index and checks each one against bundle.json as it is extracted, so upgrading
+from a bundle needs neither git nor a checkout of the repository.
+
+Build a bundle from a release's working tree with:
+    python utils/eupgrader_bundle.py SOURCE OUTPUT [--update UPDATE_JSON]
+
+If SOURCE is a git repository, only tracked files are bundled. Unifier bundles
+include update.json (from SOURCE or --update), so hosts that can't reach the
+update repository can still check and install them.
+"""
+
+import os
+import sys
+import json
+import hashlib
+import zipfile
+import subprocess
+
+FORMAT = 1
+MANIFEST = 'bundle.json'
+
+def tracked_files(source):
+    """Returns the files git tracks in source, or every file outside .git if it isn't a repository."""
+    try:
+        result = subprocess.run(['git', 'ls-files', '-z'], cwd=source, capture_output=True, check=True)
+        return [file for file in result.stdout.decode().split('\0') if file]
+    except (OSError, subprocess.CalledProcessError):
+        files = []
+        for root, dirs, names in os.walk(source):
+            if '.git' in dirs:
+                dirs.remove('.git')
+            for name in names:
+                files.append(os.path.relpath(os.path.join(root, name), source).replace(os.sep, '/'))
+        return files
+
+def build(source, output, files=None, update=None, chunk=1048576):
+    """Writes a bundle of files (relative to source) to output and returns its manifest."""
+    files = sorted(files if files is not None else tracked_files(source))
+    manifest = {'format': FORMAT, 'files': {}}
+    with zipfile.ZipFile(output + '.tmp', 'w', zipfile.ZIP_DEFLATED) as bundle:
+        for file in files:
+            digest = hashlib.sha256()
+            with open(source + '/' + file, 'rb') as src, bundle.open(file, 'w') as dst:
+                while True:
+                    data = src.read(chunk)
+                    if not data:
+                        break
+                    digest.update(data)
+                    dst.write(data)
+            manifest['files'].update({file: digest.hexdigest()})
+
+        if 'plugin.json' in files:
+            with open(source + '/plugin.json', 'r') as file:
+                info = json.load(file)
+        else:
+            if update is None and 'update.json' in files:
+                with open(source + '/update.json', 'r') as file:
+                    update = json.load(file)
+            info = update or {}
+            info = dict(info, id='system')
+        manifest.update({'id': info.get('id'), 'version': info.get('version'), 'release': info.get('release')})
+        if update is not None:
+            manifest.update({'update': update})
+        bundle.writestr(MANIFEST, json.dumps(manifest, indent=2))
+    os.replace(output + '.tmp', output)
+    return manifest
+
+def main():
+    args = sys.argv[1:]
+    update = None
+    if '--update' in args:
+        index = args.index('--update')
+        with open(args[index + 1], 'r') as file:
+            update = json.load(file)
+        del args[index:index + 2]
+    if len(args) != 2:
+        print(__doc__.strip())
+        sys.exit(1)
+    manifest = build(args[0], args[1], update=update)
+    print(f'Bundled {len(manifest["files"])} files of {manifest["id"]} {manifest["version"]} into {args[1]}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""Readiness handshake for processes started by Emergency Upgrader's handover mode.
+
+When a reboot-required upgrade is installed with eupgrader_handover_entry set,
+Emergency Upgrader starts the entry script with EUPGRADER_HANDOVER pointing at
+a local socket. The new process should import and load everything it needs,
+then call ready() right before connecting to Discord. ready() tells the old
+process it can shut down, and returns once it has.
+
+Without EUPGRADER_HANDOVER set, ready() returns immediately, so entry scripts
+can call it unconditionally.
+
+Run this file directly for a stub entry point that imports every cog and
+then waits for the handover, for testing without Discord:
+    python utils/eupgrader_handover.py [--delay SECONDS] [--fail]
+"""
+
+import os
+import sys
+import socket
+import time
+import importlib
+
+ENVIRON = 'EUPGRADER_HANDOVER'
+
+def ready(timeout=None):
+    """Signals readiness to the old process and blocks until it has shut down.
+
+    Returns False if this process wasn't started by a handover."""
+    path = os.environ.pop(ENVIRON, None)
+    if not path:
+        return False
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+        conn.settimeout(timeout)
+        conn.connect(path)
+        conn.sendall(b'ready\n')
+        # the old process closes the connection (or exits) once it is offline
+        while conn.recv(1024):
+            pass
+    return True
+
+def main():
+    args = sys.argv[1:]
+    delay = float(args[args.index('--delay') + 1]) if '--delay' in args else 0
+    # run from the bot's root, not from utils/
+    sys.path[0] = os.getcwd()
+    started = time.perf_counter()
+    loaded = 0
+    for file in sorted(os.listdir('cogs')):
+        if file.endswith('.py'):
+            importlib.import_module('cogs.' + file[:-3])
+            loaded += 1
+    time.sleep(delay)
+    if '--fail' in args:
+        print('Stub entry point failed before becoming ready', flush=True)
+        sys.exit(1)
+    print(f'Loaded {loaded} extensions in {time.perf_counter() - started:.2f}s, waiting for handover', flush=True)
+    handed_over = ready()
+    print('Handover complete, connecting' if handed_over else 'Not started by a handover, connecting', flush=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+"""Restores files from Emergency Upgrader's backups by hand.
+
+Emergency Upgrader keeps backups in old/ as content-addressed blobs
+(old/blobs/XX/SHA256) plus JSON files describing what goes where:
+- old/manifests/ID.json is a full snapshot taken before a system upgrade,
+  mapping each backed up path to the blob with its contents.
+- old/journals/ID.jsonl lists every file an unfinished upgrade wrote, with the
+  blob of its previous contents (or null if it didn't exist before).
+
+If the bot can't start or roll back on its own, stop it and run this from the
+Unifier directory:
+    python utils/eupgrader_restore.py list
+    python utils/eupgrader_restore.py restore SNAPSHOT_ID
+    python utils/eupgrader_restore.py rollback JOURNAL_ID
+
+restore copies every file in a snapshot back into place. rollback undoes the
+writes recorded in a journal, newest first, and removes files the upgrade
+created. Every blob is checked against its hash before anything is written.
+"""
+
+import os
+import sys
+import json
+import shutil
+import hashlib
+
+def blob_path(root, digest):
+    return root + '/blobs/' + digest[:2] + '/' + digest
+
+def check_blob(root, digest, chunk=1048576):
+    """Returns the path of a blob, raising RuntimeError if it is missing or its contents don't match its hash."""
+    path = blob_path(root, digest)
+    result = hashlib.sha256()
+    try:
+        with open(path, 'rb') as file:
+            while True:
+                data = file.read(chunk)
+                if not data:
+                    break
+                result.update(data)
+    except FileNotFoundError:
+        raise RuntimeError(f'Backup blob {digest} is missing')
+    if result.hexdigest() != digest:
+        raise RuntimeError(f'Backup blob {digest} is corrupted')
+    return path
+
+def read_journal(path):
+    entries = []
+    with open(path, 'r') as file:
+        for line in file:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                # torn final entry from a crash, the write it describes never happened
+                break
+    return entries
+
+def put(blob, target):
+    os.makedirs(os.path.dirname(target) or '.', exist_ok=True)
+    shutil.copyfile(blob, target + '.eupgrader-restore')
+    os.replace(target + '.eupgrader-restore', target)
+
+def listing(root):
+    """Returns (snapshots, journals) as lists of (ID, file count), oldest first."""
+    snapshots = []
+    journals = []
+    for name in sorted(os.listdir(root + '/manifests')) if os.path.isdir(root + '/manifests') else []:
+        if name.endswith('.json'):
+            with open(root + '/manifests/' + name, 'r') as file:
+                snapshots.append((name[:-5], len(json.load(file)['files'])))
+    for name in sorted(os.listdir(root + '/journals')) if os.path.isdir(root + '/journals') else []:
+        if name.endswith('.jsonl'):
+            journals.append((name[:-6], len(read_journal(root + '/journals/' + name))))
+    return snapshots, journals
+
+def restore(root, base, snapshot_id):
+    """Copies every file of a snapshot back into base. Returns the number of files restored."""
+    with open(root + '/manifests/' + snapshot_id + '.json', 'r') as file:
+        files = json.load(file)['files']
+    blobs = {path: check_blob(root, digest) for path, digest in files.items()}
+    for path, blob in blobs.items():
+        put(blob, base + '/' + path)
+    return len(blobs)
+
+def rollback(root, base, journal_id):
+    """Undoes the writes recorded in a journal, newest first, then removes it and its checkpoint.
+
+    Returns the number of entries."""
+    path = root + '/journals/' + journal_id + '.jsonl'
+    entries = read_journal(path)
+    blobs = [check_blob(root, entry['old']) if entry['old'] else None for entry in entries]
+    for entry, blob in reversed(list(zip(entries, blobs))):
+        live = base + '/' + entry['path']
+        if blob:
+            put(blob, live)
+        elif os.path.exists(live):
+            os.remove(live)
+    os.remove(path)
+    # the bot would otherwise offer to resume or roll back the upgrade again
+    try:
+        with open(base + '/.eupgrader/checkpoint.json', 'r') as file:
+            checkpoint = json.load(file)
+        if checkpoint.get('journal') == journal_id:
+            os.remove(base + '/.eupgrader/checkpoint.json')
+    except (OSError, ValueError):
+        pass
+    return len(entries)
+
+def main():
+    args = sys.argv[1:]
+    base = os.getcwd()
+    root = base + '/old'
+    if args == ['list']:
+        snapshots, journals = listing(root)
+        print('Snapshots:')
+        for snapshot_id, count in snapshots:
+            print(f'  {snapshot_id} ({count} files)')
+        print('Journals of unfinished upgrades:')
+        for journal_id, count in journals:
+            print(f'  {journal_id} ({count} writes)')
+        return
+    if len(args) != 2 or not args[0] in ['restore', 'rollback']:
+        print(__doc__.strip())
+        sys.exit(1)
+    try:
+        if args[0] == 'restore':
+            print(f'Restored {restore(root, base, args[1])} files from snapshot {args[1]}')
+        else:
+            print(f'Rolled back {rollback(root, base, args[1])} writes from journal {args[1]}')
+    except (OSError, RuntimeError) as e:
+        print(f'Could not {args[0]} {args[1]}: {e}')
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,31 @@
+import importlib.util
+import os
+import sys
+import types
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+@pytest.fixture
+def eupgrader(monkeypatch):
+    # eupgrader imports the host bot's utils package, which none of these tests touch
+    utils = types.ModuleType('utils')
+    utils.ui = types.ModuleType('utils.ui')
+    utils.log = types.ModuleType('utils.log')
+    monkeypatch.setitem(sys.modules, 'utils', utils)
+    monkeypatch.setitem(sys.modules, 'utils.ui', utils.ui)
+    monkeypatch.setitem(sys.modules, 'utils.log', utils.log)
+    spec = importlib.util.spec_from_file_location('eupgrader', ROOT + '/eupgrader.py')
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as file:
+        file.write(data)
+
+def read(path):
+    with open(path, 'r') as file:
+        return file.read()
@@ -0,0 +1,35 @@
+import os
+
+import pytest
+
+PIL = pytest.importorskip('PIL.Image')
+
+def save_image(path, animated, format):
+    # noise, so every source is over the size limit whatever its format compresses to
+    frames = [PIL.frombytes('RGBA', (300, 300), os.urandom(300 * 300 * 4)) for _ in range(3)]
+    if animated:
+        frames[0].save(path, format=format, save_all=True, append_images=frames[1:], duration=100, loop=0)
+    else:
+        frames[0].save(path, format=format)
+
+@pytest.mark.parametrize('source, animated, format, extension', [
+    ('anim.webp', True, 'WEBP', '.gif'),
+    ('anim.png', True, 'PNG', '.gif'),
+    ('anim.gif', True, 'GIF', '.gif'),
+    ('still.webp', False, 'WEBP', '.png'),
+    ('still.png', False, 'PNG', '.png'),
+])
+def test_shrunk_emoji_extension_matches_written_format(eupgrader, tmp_path, source, animated, format, extension):
+    save_image(str(tmp_path / source), animated, format)
+    preprocessor = eupgrader.EmojiPreprocessor(str(tmp_path / 'cache'), max_bytes=20480, workers=1)
+    pack = {'emojis': {'emoji': [source]}}
+
+    output = preprocessor.prepare(str(tmp_path), pack)['emoji']
+
+    assert output.endswith(extension)
+    with open(output, 'rb') as file:
+        header = file.read(8)
+    assert header.startswith(b'GIF') if extension == '.gif' else header == b'\x89PNG\r\n\x1a\n'
+    # a second run reuses the cached image rather than shrinking it again
+    assert preprocessor.prepare(str(tmp_path), pack) == {'emoji': output}
+    assert len(os.listdir(tmp_path / 'cache')) == 1
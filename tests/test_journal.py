@@ -0,0 +1,200 @@
+import json
+import os
+
+import pytest
+
+from conftest import read, write
+
+@pytest.fixture
+def store(eupgrader, tmp_path):
+    copier = eupgrader.CopyEngine(4)
+    yield eupgrader.SnapshotStore(str(tmp_path / 'old'), copier=copier)
+    copier.shutdown()
+
+def test_record_many_identical_files(eupgrader, tmp_path):
+    base = tmp_path / 'tree'
+    files = [f'utils/module{index}/__init__.py' for index in range(32)]
+    for file in files:
+        write(str(base / file), 'identical\n' * 200000)
+    copier = eupgrader.CopyEngine(8)
+
+    # every attempt starts with an empty store, so all 32 stores race for the same blob
+    for attempt in range(5):
+        snapshots = eupgrader.SnapshotStore(str(tmp_path / f'old{attempt}'), copier=copier)
+        journal = eupgrader.UpgradeJournal(snapshots, str(base))
+        journal.record_many([(file, None) for file in files], pool=copier.pool)
+
+        assert len(journal.entries) == len(files)
+        assert len(set([entry['old'] for entry in journal.entries])) == 1
+        blob = snapshots.blob_path(journal.entries[0]['old'])
+        assert read(blob) == 'identical\n' * 200000
+        assert os.listdir(os.path.dirname(blob)) == [os.path.basename(blob)]
+    copier.shutdown()
+
+def test_rollback_restores_identical_files(eupgrader, tmp_path, store):
+    base = tmp_path / 'tree'
+    files = ['cogs/a.py', 'cogs/b.py', 'utils/c.py']
+    for file in files:
+        write(str(base / file), 'old\n')
+    journal = eupgrader.UpgradeJournal(store, str(base))
+    journal.record_many([(file, None) for file in files + ['cogs/new.py']], pool=store.copier.pool)
+    for file in files + ['cogs/new.py']:
+        write(str(base / file), 'new\n')
+
+    journal.rollback()
+
+    assert [read(base / file) for file in files] == ['old\n'] * 3
+    assert not (base / 'cogs/new.py').exists()
+    assert not os.path.exists(journal.path)
+
+def test_entries_are_on_disk_before_the_write(eupgrader, tmp_path, store):
+    write(str(tmp_path / 'tree/cogs/a.py'), 'old\n')
+    journal = eupgrader.UpgradeJournal(store, str(tmp_path / 'tree'))
+
+    journal.record('cogs/a.py', 'newdigest')
+    journal.record('cogs/created.py')
+
+    assert eupgrader.UpgradeJournal.read(journal.path) == journal.entries
+    assert journal.entries[0] == {'path': 'cogs/a.py', 'old': store.hashes.hash(str(tmp_path / 'tree/cogs/a.py')),
+                                  'new': 'newdigest'}
+    assert read(store.blob_path(journal.entries[0]['old'])) == 'old\n'
+    assert journal.entries[1] == {'path': 'cogs/created.py', 'old': None, 'new': None}
+
+def test_rollback_replays_newest_write_first(eupgrader, tmp_path, store):
+    base = tmp_path / 'tree'
+    write(str(base / 'cogs/a.py'), 'v1\n')
+    journal = eupgrader.UpgradeJournal(store, str(base))
+    # a.py is written twice and b.py is created, then written again
+    journal.record('cogs/a.py')
+    write(str(base / 'cogs/a.py'), 'v2\n')
+    journal.record('cogs/b.py')
+    write(str(base / 'cogs/b.py'), 'v2\n')
+    journal.record('cogs/a.py')
+    write(str(base / 'cogs/a.py'), 'v3\n')
+    journal.record('cogs/b.py')
+    write(str(base / 'cogs/b.py'), 'v3\n')
+
+    journal.rollback()
+
+    assert read(base / 'cogs/a.py') == 'v1\n'
+    assert not (base / 'cogs/b.py').exists()
+    assert journal.entries == []
+    assert not os.path.exists(journal.path)
+
+def test_kept_files_are_not_rolled_back(eupgrader, tmp_path, store):
+    base = tmp_path / 'tree'
+    write(str(base / 'cogs/a.py'), 'old\n')
+    journal = eupgrader.UpgradeJournal(store, str(base))
+    journal.record('cogs/a.py')
+    write(str(base / 'cogs/a.py'), 'new\n')
+    write(str(base / 'emojis/pack.json'), 'new\n')
+    journal.keep('emojis/pack.json')
+    journal.keep('emojis/pack.json')
+
+    journal.rollback()
+
+    assert journal.kept == ['emojis/pack.json']
+    assert read(base / 'cogs/a.py') == 'old\n'
+    assert read(base / 'emojis/pack.json') == 'new\n'
+
+def test_resume_rolls_back_an_interrupted_journal(eupgrader, tmp_path, store):
+    base = tmp_path / 'tree'
+    for file in ['cogs/a.py', 'cogs/b.py']:
+        write(str(base / file), 'old\n')
+    journal = eupgrader.UpgradeJournal(store, str(base))
+    journal.record('cogs/a.py')
+    journal.record('cogs/new.py')
+    for file in ['cogs/a.py', 'cogs/new.py']:
+        write(str(base / file), 'new\n')
+    # the process died while appending the entry for b.py, before b.py was written
+    with open(journal.path, 'a') as file:
+        file.write('{"path": "cogs/b.py", "ol')
+
+    resumed = eupgrader.UpgradeJournal(store, str(base), journal.id)
+
+    assert resumed.path == journal.path
+    assert resumed.entries == journal.entries
+    resumed.rollback()
+    assert [read(base / file) for file in ['cogs/a.py', 'cogs/b.py']] == ['old\n'] * 2
+    assert not (base / 'cogs/new.py').exists()
+    assert not os.path.exists(journal.path)
+
+def test_resume_keeps_appending_to_the_journal(eupgrader, tmp_path, store):
+    base = tmp_path / 'tree'
+    for file in ['cogs/a.py', 'cogs/b.py']:
+        write(str(base / file), 'old\n')
+    journal = eupgrader.UpgradeJournal(store, str(base))
+    journal.record('cogs/a.py')
+    write(str(base / 'cogs/a.py'), 'new\n')
+
+    resumed = eupgrader.UpgradeJournal(store, str(base), journal.id)
+    resumed.record('cogs/b.py')
+    write(str(base / 'cogs/b.py'), 'new\n')
+
+    assert [entry['path'] for entry in eupgrader.UpgradeJournal.read(journal.path)] == ['cogs/a.py', 'cogs/b.py']
+    resumed.rollback()
+    assert [read(base / file) for file in ['cogs/a.py', 'cogs/b.py']] == ['old\n'] * 2
+
+def test_close_discards_the_journal(eupgrader, tmp_path, store):
+    write(str(tmp_path / 'tree/cogs/a.py'), 'old\n')
+    journal = eupgrader.UpgradeJournal(store, str(tmp_path / 'tree'))
+    journal.record('cogs/a.py')
+    write(str(tmp_path / 'tree/cogs/a.py'), 'new\n')
+
+    journal.close()
+    journal.close()
+
+    assert journal.entries == []
+    assert not os.path.exists(journal.path)
+    assert read(tmp_path / 'tree/cogs/a.py') == 'new\n'
+
+def test_checkpoint_round_trip(eupgrader, tmp_path):
+    path = str(tmp_path / '.eupgrader/checkpoint.json')
+    checkpoint = eupgrader.UpgradeCheckpoint(path, {'version': 'v2.1.8', 'journal': None})
+    checkpoint.update(journal='20240101-000000-abcdef')
+    checkpoint.complete('download', artifacts={'cogs/a.py': 'digest'})
+    checkpoint.complete('download')
+    checkpoint.complete('install')
+
+    loaded = eupgrader.UpgradeCheckpoint.load(path)
+
+    assert loaded.data == {
+        'version': 'v2.1.8', 'journal': '20240101-000000-abcdef', 'artifacts': {'cogs/a.py': 'digest'},
+        'stages': ['download', 'install']
+    }
+    assert loaded.done('install') and not loaded.done('compile')
+    assert os.listdir(tmp_path / '.eupgrader') == ['checkpoint.json']
+
+def test_checkpoint_clear(eupgrader, tmp_path):
+    path = str(tmp_path / '.eupgrader/checkpoint.json')
+    checkpoint = eupgrader.UpgradeCheckpoint(path)
+    checkpoint.complete('download')
+
+    checkpoint.clear()
+    checkpoint.clear()
+
+    assert eupgrader.UpgradeCheckpoint.load(path) is None
+
+@pytest.mark.parametrize('contents', [None, '', '{"stages": ["download"', 'not json'])
+def test_missing_or_invalid_checkpoint_is_ignored(eupgrader, tmp_path, contents):
+    path = str(tmp_path / '.eupgrader/checkpoint.json')
+    if contents is not None:
+        write(path, contents)
+
+    assert eupgrader.UpgradeCheckpoint.load(path) is None
+
+def test_checkpoint_is_replaced_atomically(eupgrader, tmp_path, monkeypatch):
+    path = str(tmp_path / '.eupgrader/checkpoint.json')
+    checkpoint = eupgrader.UpgradeCheckpoint(path)
+    checkpoint.complete('download')
+
+    def crash(*args):
+        raise OSError('crashed before replacing the checkpoint')
+
+    with monkeypatch.context() as patch:
+        patch.setattr(os, 'replace', crash)
+        with pytest.raises(OSError):
+            checkpoint.complete('install')
+
+    assert json.loads(read(path))['stages'] == ['download']
+    assert eupgrader.UpgradeCheckpoint.load(path).stages == ['download']
@@ -0,0 +1,77 @@
+import os
+
+import pytest
+
+from conftest import read, write
+
+class Crash(Exception):
+    pass
+
+def staged_upgrade(eupgrader, root):
+    for file in ['cogs/a.py', 'utils/b.py', 'unifier.py']:
+        write(str(root / file), 'old\n')
+    staged = eupgrader.StagedInstall(str(root), ['cogs', 'utils'])
+    staged.prepare()
+    for file in ['cogs/a.py', 'utils/b.py', 'unifier.py', 'requirements.txt']:
+        staged.stage_data(file, b'new\n')
+    return staged
+
+def crash_after(monkeypatch, name, calls):
+    real = getattr(os, name)
+    done = []
+
+    def crashing(*args):
+        if len(done) == calls:
+            raise Crash()
+        done.append(args)
+        return real(*args)
+
+    monkeypatch.setattr(os, name, crashing)
+
+def assert_old_tree(root):
+    assert [read(root / file) for file in ['cogs/a.py', 'utils/b.py', 'unifier.py']] == ['old\n'] * 3
+    assert not (root / 'requirements.txt').exists()
+    assert sorted(os.listdir(root)) == ['cogs', 'unifier.py', 'utils']
+
+# 1: cogs moved aside, 2: cogs switched, 3: utils moved aside
+@pytest.mark.parametrize('renames', [1, 2, 3])
+def test_recover_after_crash_between_directory_renames(eupgrader, tmp_path, monkeypatch, renames):
+    staged = staged_upgrade(eupgrader, tmp_path)
+    crash_after(monkeypatch, 'rename', renames)
+    with pytest.raises(Crash):
+        staged.cutover()
+    monkeypatch.undo()
+
+    # a new process only has what is on disk
+    eupgrader.StagedInstall(str(tmp_path), ['cogs', 'utils']).recover()
+    assert_old_tree(tmp_path)
+
+def test_recover_after_crash_between_file_replaces(eupgrader, tmp_path, monkeypatch):
+    staged = staged_upgrade(eupgrader, tmp_path)
+    crash_after(monkeypatch, 'replace', 2)
+    with pytest.raises(Crash):
+        staged.cutover()
+    monkeypatch.undo()
+
+    eupgrader.StagedInstall(str(tmp_path), ['cogs', 'utils']).recover()
+    assert_old_tree(tmp_path)
+
+def test_recover_keeps_finished_cutover(eupgrader, tmp_path):
+    staged = staged_upgrade(eupgrader, tmp_path)
+    staged.cutover()
+
+    eupgrader.StagedInstall(str(tmp_path), ['cogs', 'utils']).recover()
+    assert [read(tmp_path / file) for file in ['cogs/a.py', 'utils/b.py', 'unifier.py', 'requirements.txt']] == [
+        'new\n'
+    ] * 4
+    assert sorted(os.listdir(tmp_path)) == ['cogs', 'requirements.txt', 'unifier.py', 'utils']
+
+def test_rollback_after_failed_cutover(eupgrader, tmp_path, monkeypatch):
+    staged = staged_upgrade(eupgrader, tmp_path)
+    crash_after(monkeypatch, 'rename', 3)
+    with pytest.raises(Crash):
+        staged.cutover()
+    monkeypatch.undo()
+
+    staged.rollback()
+    assert_old_tree(tmp_path)
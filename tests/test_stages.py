@@ -0,0 +1,57 @@
+import asyncio
+import time
+
+def test_cancelled_run_waits_for_running_stages(eupgrader):
+    graph = eupgrader.StageGraph()
+    finished = []
+
+    async def copy():
+        # stands in for a stage copying files in an executor thread
+        await asyncio.get_running_loop().run_in_executor(None, lambda: time.sleep(0.2) or finished.append('copy'))
+
+    async def after():
+        finished.append('after')
+
+    graph.add('copy', copy)
+    graph.add('after', after, after=['copy'])
+
+    async def main():
+        task = asyncio.ensure_future(graph.run())
+        await asyncio.sleep(0.05)
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            # by now the rollback would start, so nothing may still be writing
+            return list(finished)
+        raise AssertionError('run was not cancelled')
+
+    assert asyncio.run(main()) == ['copy']
+
+def test_failed_stage_skips_dependents_and_waits_for_running_stages(eupgrader):
+    graph = eupgrader.StageGraph()
+    ran = []
+
+    async def fail():
+        await asyncio.sleep(0.01)
+        raise RuntimeError('failed')
+
+    async def skipped():
+        ran.append('skipped')
+
+    async def independent():
+        await asyncio.sleep(0.05)
+        ran.append('independent')
+
+    graph.add('fail', fail)
+    graph.add('skipped', skipped, after=['fail'])
+    graph.add('independent', independent)
+
+    try:
+        asyncio.run(graph.run())
+    except RuntimeError:
+        pass
+    else:
+        raise AssertionError('the stage error was not raised')
+    assert ran == ['independent']
+    assert graph.failed == 'fail'